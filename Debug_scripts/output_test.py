@@ -1,7 +1,11 @@
-import json
 import sys
 from pathlib import Path
 
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "utils"))
+from synced_data_store import load_synced_data
+
 def print_section_lengths(data, section_name):
     """
     Print lengths of arrays in a specific section of the JSON data.
@@ -18,7 +22,7 @@ def print_section_lengths(data, section_name):
     print("-" * 40)
     
     for key, value in data.items():
-        if isinstance(value, list):
+        if isinstance(value, (list, np.ndarray)):
             print(f"{key:25} length: {len(value)}")
         elif isinstance(value, dict):
             # Handle nested dictionaries if they exist
@@ -28,7 +32,7 @@ def print_section_lengths(data, section_name):
 
 def demo_print_lengths(json_file):
     """
-    Reads the synced JSON file and prints out the lengths
+    Reads the synced data file (.h5 store or legacy JSON) and prints out the lengths
     of each relevant array inside it.
     """
     json_file = Path(json_file)
@@ -37,9 +41,8 @@ def demo_print_lengths(json_file):
         print(f"File does not exist: {json_file}")
         return
 
-    # Load the JSON
-    with open(json_file, 'r') as f:
-        data = json.load(f)
+    # Load the synced data
+    data = load_synced_data(json_file)
 
     print(f"Reading from: {json_file}")
     
@@ -58,6 +61,6 @@ if __name__ == "__main__":
         output_json = sys.argv[1]
     else:
         # Default path if none provided
-        output_json = r"C:\Users\Tripodi Group\Videos\2501 - openfield experiment output\250116_174334_test1\250116_174334_test1_synced_data.json"
+        output_json = r"C:\Users\Tripodi Group\Videos\2501 - openfield experiment output\250116_174334_test1\250116_174334_test1_synced_data.h5"
     
     demo_print_lengths(output_json)
\ No newline at end of file
@@ -0,0 +1,42 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils.live_data_bus import LiveBusReader, bus_name
+
+def print_live_samples(session_name, source, refresh_interval=0.5):
+    """
+    Prints the newest samples published on a live data bus until interrupted.
+
+    Args:
+        session_name (str): Session folder name (e.g. "251202_181111_T4").
+        source (str): "head", "body" or "daq".
+        refresh_interval (float): Seconds between reads.
+    """
+    reader = LiveBusReader(bus_name(session_name, source))
+    print(f"Attached to '{reader.name}' ({reader.capacity} records, fields: {reader.dtype.names})")
+
+    index = reader.write_index
+    try:
+        while True:
+            records, index, dropped = reader.read_since(index)
+            if dropped:
+                print(f"Reader fell behind, {dropped} records dropped")
+            if len(records):
+                print(f"{len(records)} new records, latest: {records[-1]}")
+            time.sleep(refresh_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+def main():
+    # === Fill in these variables ===
+    session_name = "251202_181111_T4"
+    source = "head"
+
+    print_live_samples(session_name, source)
+
+if __name__ == "__main__":
+    main()
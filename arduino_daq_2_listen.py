@@ -8,20 +8,31 @@ from datetime import datetime
 import os
 import argparse
 from pathlib import Path
-import h5py
 import numpy as np
 import asyncio
-from collections import deque
 import traceback
 import threading
 import tkinter as tk
 from colorama import init, Fore, Style
+from utils.live_data_bus import LiveBusWriter, DAQ_DUE_SAMPLE_DTYPE, bus_name
+from utils.daq_edges import EdgeDetector
+from utils.daq_clock import fit_clock_model, describe_clock_model, block_timestamps, ReadBlockLog
+from utils.daq_frames import decode_due_frames
+from utils.daq_message_store import DAQMessageStore
+from utils.daq_stream_writer import DAQStreamWriter
 init()
 
 exit_key = "esc"
 
 test = False
 
+channel_indices = (
+    "SPOT2", "SPOT3", "SPOT4", "SPOT5", "SPOT6", "SPOT1", "SENSOR6", "SENSOR1",
+    "SENSOR5", "SENSOR2", "SENSOR4", "SENSOR3", "BUZZER4", "LED_3", "LED_4",
+    "BUZZER3", "BUZZER5", "LED_2", "LED_5", "BUZZER2", "BUZZER6", "LED_1",
+    "LED_6", "BUZZER1", "VALVE4", "VALVE3", "VALVE5", "VALVE2", "VALVE6",
+    "VALVE1", "GO_CUE", "NOGO_CUE", "CAMERA_SYNC", "HEADSENSOR_SYNC", "LASER_SYNC"
+)
 
 async def check_signal_files(output_path, stop_event):
     if test:
@@ -71,10 +82,17 @@ async def check_signal_files(output_path, stop_event):
 
 
 
-async def listen(new_mouse_ID=None, new_date_time=None, new_path=None, port=None):
+async def listen(new_mouse_ID=None, new_date_time=None, new_path=None, port=None, live_bus=False):
 
-    messages_from_arduino = deque()
-    backup_buffer = deque()
+    # Messages are decoded in blocks into preallocated NumPy columns (id, state, time)
+    message_store = DAQMessageStore(np.uint64)
+    backed_up_messages = 0
+    read_buffer = bytearray()
+    read_blocks = ReadBlockLog()
+    previous_read_time = 0.0
+
+    # First channel is the least significant bit of the state word
+    edge_detector = EdgeDetector(channel_indices, range(len(channel_indices)))
     
     if new_mouse_ID is None:
         mouse_ID = input(r"Enter mouse ID (no '.'s): ")
@@ -96,6 +114,17 @@ async def listen(new_mouse_ID=None, new_date_time=None, new_path=None, port=None
 
     backup_csv_path = output_path / f"{foldername}-backup.csv"
 
+    # Messages are appended to the HDF5 file while recording, so stopping only flushes the tail
+    stream_writer = DAQStreamWriter(output_path / f"{foldername}-ArduinoDAQ.h5",
+                                    channel_indices, range(len(channel_indices)))
+
+    bus = None
+    if live_bus:
+        try:
+            bus = LiveBusWriter(bus_name(foldername, "daq"), DAQ_DUE_SAMPLE_DTYPE)
+            print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Publishing messages to live data bus '{bus.name}'")
+        except Exception as e:
+            print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Could not create live data bus: {e}")
 
     COM_PORT = port
     
@@ -130,54 +159,50 @@ async def listen(new_mouse_ID=None, new_date_time=None, new_path=None, port=None
     last_backup_time = time.perf_counter()
 
     while not stop_event.is_set():
-        if ser.in_waiting > 9:
-            # Get timestamp as soon as we detect a message
+        waiting = ser.in_waiting
+        if waiting > 9:
+            # Get timestamp as soon as we detect data
             current_time = time.perf_counter() - start
-            
-            # Read and strip the terminator
-            message = ser.read_until(b"\x02\x01")[:-2]
-
-            # Handle first message differently
-            if message_counter == 0:
-                message = message[1:]
-
-            if len(message) == 9:
-                # Extract message number (4 bytes)
-                original_message_ID = (
-                    (message[0] << 24) |
-                    (message[2] << 16) |
-                    (message[4] << 8) |
-                    message[6]
-                )
-
-                # Extract message (5 bytes)
-                original_message = (
-                    (message[1] << 32) |
-                    (message[3] << 24) |
-                    (message[5] << 16) |
-                    (message[7] << 8) |
-                    message[8]
-                )
-
-                # Store message with its timestamp
-                messages_from_arduino.append([original_message_ID, original_message, current_time])
-                backup_buffer.append([original_message_ID, original_message, current_time])
+
+            # Read everything waiting and decode all complete frames in one go
+            read_buffer += ser.read(waiting)
+            message_ids, states, n_consumed, skipped = decode_due_frames(read_buffer)
+            del read_buffer[:n_consumed]
+
+            for segment in skipped:
+                error_messages.append([message_counter, segment.hex(), current_time])
+                message_counter += 1
+
+            n_messages = len(message_ids)
+            if n_messages:
+                # The block's messages arrived since the previous read: one time per message
+                timestamps = block_timestamps(previous_read_time, current_time, n_messages)
+                read_blocks.append(message_store.count, current_time)
+                message_store.extend(message_ids, states, timestamps)
+                edge_detector.update(message_ids, states, timestamps)
+                if bus is not None:
+                    block = np.empty(n_messages, dtype=DAQ_DUE_SAMPLE_DTYPE)
+                    block['message_id'] = message_ids
+                    block['state'] = states
+                    block['timestamp'] = timestamps
+                    bus.publish(block)
 
                 # print message as binary number: ----- SERIAL MONITOR -----
-                # print(f"Time: {current_time:.6f} ID: {original_message_ID:032b} Data: {original_message:040b}")
+                # print(f"Time: {current_time:.6f} ID: {message_ids[-1]:032b} Data: {states[-1]:040b}")
 
-                full_messages += 1
-            else:
-                error_messages.append([message_counter, message.hex(), current_time])
+                full_messages += n_messages
+                message_counter += n_messages
 
-            message_counter += 1
+            previous_read_time = current_time
+
+        stream_writer.stream(message_store)
 
         # Backup the data every minute
         current_time = time.perf_counter()
         if current_time - last_backup_time >= backup_interval:
             last_backup_time = current_time
-            if save_to_backup_csv(backup_csv_path, list(backup_buffer)):
-                backup_buffer.clear()  # Clear backup buffer after confirming successful write
+            if save_to_backup_csv(backup_csv_path, message_store.rows(backed_up_messages)):
+                backed_up_messages = message_store.count  # Only advance after confirming successful write
 
         await asyncio.sleep(0)  # Yield control to allow the event loop to run other tasks
 
@@ -188,38 +213,22 @@ async def listen(new_mouse_ID=None, new_date_time=None, new_path=None, port=None
         ser.write(b"e")  # Send end signal as a byte string
 
     # Call the save function
-    save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, list(messages_from_arduino), message_counter, full_messages, start, end, error_messages)
-
-    ser.close()  # close port
+    save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, message_store, stream_writer, message_counter, full_messages, start, end, error_messages, edge_detector, read_blocks)
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Data file ready {time.perf_counter() - end:.2f}s after stop.")
 
-def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages_from_arduino, message_counter, full_messages, start, end, error_messages):
-    message_ids = np.array([message[0] for message in messages_from_arduino], dtype=np.uint32)
-    message_data = np.array([message[1] for message in messages_from_arduino], dtype=np.uint64)
-    timestamps = np.array([message[2] for message in messages_from_arduino], dtype=np.float64)
+    if bus is not None:
+        bus.close()
 
-    channel_indices = (
-        "SPOT2", "SPOT3", "SPOT4", "SPOT5", "SPOT6", "SPOT1", "SENSOR6", "SENSOR1",
-        "SENSOR5", "SENSOR2", "SENSOR4", "SENSOR3", "BUZZER4", "LED_3", "LED_4",
-        "BUZZER3", "BUZZER5", "LED_2", "LED_5", "BUZZER2", "BUZZER6", "LED_1",
-        "LED_6", "BUZZER1", "VALVE4", "VALVE3", "VALVE5", "VALVE2", "VALVE6",
-        "VALVE1", "GO_CUE", "NOGO_CUE", "CAMERA_SYNC", "HEADSENSOR_SYNC", "LASER_SYNC"
-    )
-
-    num_channels = len(channel_indices)
-    num_messages = len(message_data)
+    ser.close()  # close port
 
-    # Create a 2D NumPy array to hold the channel data
-    channel_data_array = np.zeros((num_messages, num_channels), dtype=np.uint8)
+def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, message_store, stream_writer, message_counter, full_messages, start, end, error_messages, edge_detector=None, read_blocks=None):
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + message_store.memory_report(n_copies=2))
 
-    # Convert message data to binary and populate channel_data_array
-    for i, message in enumerate(message_data):
-        binary_message = np.array(list(np.binary_repr(message, width=num_channels)), dtype=np.uint8)
-        binary_message = binary_message[::-1]  # Reverse bits to align LSB with first channel
-        channel_data_array[i] = binary_message
+    # Fit message ID against host time to remove USB / scheduling jitter from the timestamps
+    clock_model = fit_clock_model(message_store.column(0), message_store.column(2))
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + describe_clock_model(clock_model))
 
-    # Prepare HDF5 file
-    save_file_name = f"{foldername}-ArduinoDAQ.h5"
-    output_file = output_path / save_file_name
+    num_messages = message_store.count
 
     # Prepare JSON file
     json_file_name = f"{foldername}-ArduinoDAQ.json"
@@ -232,9 +241,7 @@ def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages
 
     # print(f"Reliability: {reliability:.2f}%")
 
-    binary_list = [''.join(str(bit) for bit in row) for row in channel_data_array]
-
-    data_to_save = {
+    summary = {
         "mouse_ID": mouse_ID,
         "date_time": date_time,
         "time": str(datetime.now()),
@@ -242,40 +249,25 @@ def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages
         "reliability": reliability,
         "time_taken": end - start,
         "messages_per_second": num_messages / (end - start),
-        "message_ids": message_ids.tolist(),
-        "timestamps": timestamps.tolist(),
-        "channel_data_raw": binary_list,
-        "error_messages": error_messages
     }
 
+    # Flush the last messages and write statistics, clock model and edges into the streamed file
+    finalize_time = stream_writer.finalize(message_store, summary, clock_model, edge_detector, error_messages,
+                                           read_blocks)
+
+    # The per-message data lives in the HDF5 file only; the JSON is a summary
+    data_to_save = dict(summary)
+    data_to_save.update({
+        "h5_file": f"{foldername}-ArduinoDAQ.h5",
+        "finalize_time": finalize_time,
+        "error_messages": error_messages,
+        "clock_model": {k: v for k, v in clock_model.items() if k != "timestamps_corrected"}
+    })
+
     # Write to JSON file
     with open(json_output_file, 'w') as json_file:
         json.dump(data_to_save, json_file, indent=4)
 
-    with h5py.File(output_file, 'w') as h5f:
-        # Save metadata as attributes
-        h5f.attrs['mouse_ID'] = mouse_ID
-        h5f.attrs['date_time'] = date_time
-        h5f.attrs['time'] = str(datetime.now())
-        h5f.attrs['No_of_messages'] = num_messages
-        h5f.attrs['reliability'] = reliability
-        h5f.attrs['time_taken'] = end - start
-        h5f.attrs['messages_per_second'] = num_messages / (end - start)
-
-        # Save message IDs and timestamps
-        h5f.create_dataset('message_ids', data=message_ids, compression='gzip')
-        h5f.create_dataset('timestamps', data=timestamps, compression='gzip')
-
-        # Save channel data under a group
-        channel_group = h5f.create_group('channel_data')
-        for idx, channel in enumerate(channel_indices):
-            channel_group.create_dataset(channel, data=channel_data_array[:, idx], compression='gzip')
-
-        if error_messages:
-            error_messages_str = [str(err_msg) for err_msg in error_messages]
-            error_messages_np = np.array(error_messages_str, dtype=object)
-            h5f.create_dataset('error_messages', data=error_messages_np, compression='gzip', dtype=h5py.string_dtype())
-
 def save_to_backup_csv(backup_csv_path, backup_buffer):
     try:
         with open(backup_csv_path, 'a', newline='') as csvfile:
@@ -299,6 +291,7 @@ def main():
     parser.add_argument('--date', type=str, help='date_time')
     parser.add_argument('--path', type=str, help='path')
     parser.add_argument('--port', type=str, default='COM2', help='COM port (e.g., COM2)')
+    parser.add_argument('--live_bus', action='store_true', help='Publish messages to a shared-memory live data bus')
     args = parser.parse_args()
 
     mouse_ID = args.id if args.id is not None else "NoID"
@@ -308,7 +301,7 @@ def main():
         os.mkdir(path)
 
     try:
-        asyncio.run(listen(new_mouse_ID=mouse_ID, new_date_time=date_time, new_path=path, port=args.port))
+        asyncio.run(listen(new_mouse_ID=mouse_ID, new_date_time=date_time, new_path=path, port=args.port, live_bus=args.live_bus))
     except Exception as e:
         print("Error in main function")
         traceback.print_exc()
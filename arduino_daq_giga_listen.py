@@ -8,14 +8,18 @@ from datetime import datetime
 import os
 import argparse
 from pathlib import Path
-import h5py
 import numpy as np
 import asyncio
-from collections import deque
 import traceback
 import threading
 import tkinter as tk
 from colorama import init, Fore, Style
+from utils.live_data_bus import LiveBusWriter, DAQ_GIGA_SAMPLE_DTYPE, bus_name
+from utils.daq_edges import EdgeDetector
+from utils.daq_clock import fit_clock_model, describe_clock_model, block_timestamps, ReadBlockLog
+from utils.daq_frames import decode_giga_frames
+from utils.daq_message_store import DAQMessageStore
+from utils.daq_stream_writer import DAQStreamWriter
 init()
 
 exit_key = "del"
@@ -57,9 +61,17 @@ async def check_signal_files(output_path, stop_event):
     if test:
         keyboard.unhook_all()
 
-async def listen(channel_names, new_mouse_ID=None, new_date_time=None, new_path=None, port=None):
-    messages_from_arduino = deque()
-    backup_buffer = deque()
+async def listen(channel_names, new_mouse_ID=None, new_date_time=None, new_path=None, port=None, live_bus=False):
+    # Messages are decoded in blocks into preallocated NumPy columns (id, state, time)
+    message_store = DAQMessageStore(np.uint8)
+    backed_up_messages = 0
+    read_buffer = bytearray()
+    read_blocks = ReadBlockLog()
+    previous_read_time = 0.0
+
+    # First channel name is the most significant bit of the state word
+    num_channels = len(channel_names)
+    edge_detector = EdgeDetector(channel_names, [num_channels - 1 - i for i in range(num_channels)])
     
     # Create a backup worker thread and queue for non-blocking file operations
     from queue import Queue
@@ -104,6 +116,18 @@ async def listen(channel_names, new_mouse_ID=None, new_date_time=None, new_path=
 
     backup_csv_path = output_path / f"{foldername}-backup.csv"
     COM_PORT = port
+
+    # Messages are appended to the HDF5 file while recording, so stopping only flushes the tail
+    stream_writer = DAQStreamWriter(output_path / f"{foldername}-ArduinoDAQ.h5",
+                                    channel_names, [num_channels - 1 - i for i in range(num_channels)])
+
+    bus = None
+    if live_bus:
+        try:
+            bus = LiveBusWriter(bus_name(foldername, "daq"), DAQ_GIGA_SAMPLE_DTYPE)
+            print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Publishing messages to live data bus '{bus.name}'")
+        except Exception as e:
+            print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Could not create live data bus: {e}")
     
     try:
         ser = serial.Serial(COM_PORT, 115200, timeout=1)
@@ -138,39 +162,54 @@ async def listen(channel_names, new_mouse_ID=None, new_date_time=None, new_path=
 
     # Read messages until a stop condition is triggered
     while not stop_event.is_set():
-        if ser.in_waiting >= 7:
+        waiting = ser.in_waiting
+        if waiting >= 7:
             current_time = time.perf_counter() - start
-            message = ser.read(7)
-            if len(message) == 7 and message[0] == 0x01 and message[6] == 0x02:
-                msgNum = (
-                    (message[1] << 24) |
-                    (message[2] << 16) |
-                    (message[3] << 8)  |
-                    (message[4])
-                )
-                state = message[5]
-                messages_from_arduino.append([msgNum, state, current_time])
-                backup_buffer.append([msgNum, state, current_time])
-                full_messages += 1
-            else:
-                error_messages.append([message_counter, message.hex(), current_time])
-            message_counter += 1
+
+            # Read everything waiting and decode all complete frames in one go
+            read_buffer += ser.read(waiting)
+            msgNums, states, n_consumed, skipped = decode_giga_frames(read_buffer)
+            del read_buffer[:n_consumed]
+
+            for segment in skipped:
+                error_messages.append([message_counter, segment.hex(), current_time])
+                message_counter += 1
+
+            n_messages = len(msgNums)
+            if n_messages:
+                # The block's messages arrived since the previous read: one time per message
+                timestamps = block_timestamps(previous_read_time, current_time, n_messages)
+                read_blocks.append(message_store.count, current_time)
+                message_store.extend(msgNums, states, timestamps)
+                edge_detector.update(msgNums, states, timestamps)
+                if bus is not None:
+                    block = np.empty(n_messages, dtype=DAQ_GIGA_SAMPLE_DTYPE)
+                    block['message_id'] = msgNums
+                    block['state'] = states
+                    block['timestamp'] = timestamps
+                    bus.publish(block)
+                full_messages += n_messages
+                message_counter += n_messages
+
+            previous_read_time = current_time
+
+        stream_writer.stream(message_store)
 
         # Replace the synchronous backup with the non-blocking queue-based approach
         now = time.perf_counter()
         # if now - last_backup_time >= backup_interval:
         #     last_backup_time = now
-        #     if len(backup_buffer) > 0:  # Only queue if there's data to back up
-        #         backup_queue.put((backup_csv_path, list(backup_buffer)))
-        #         backup_buffer.clear()  # Clear buffer immediately
+        #     if message_store.count > backed_up_messages:  # Only queue if there's data to back up
+        #         backup_queue.put((backup_csv_path, message_store.rows(backed_up_messages)))
+        #         backed_up_messages = message_store.count
 
         await asyncio.sleep(0)
 
     end = time.perf_counter()
 
     # Process any remaining backup data
-    # if len(backup_buffer) > 0:
-    #     backup_queue.put((backup_csv_path, list(backup_buffer)))
+    # if message_store.count > backed_up_messages:
+    #     backup_queue.put((backup_csv_path, message_store.rows(backed_up_messages)))
     
     # Optional: Wait for all backup operations to complete
     # backup_queue.join()
@@ -183,38 +222,36 @@ async def listen(channel_names, new_mouse_ID=None, new_date_time=None, new_path=
         output_path=output_path,
         mouse_ID=mouse_ID,
         date_time=date_time,
-        messages_from_arduino=list(messages_from_arduino),
+        message_store=message_store,
+        stream_writer=stream_writer,
         message_counter=message_counter,
         full_messages=full_messages,
         start=start,
         end=end,
         error_messages=error_messages,
-        channel_names=channel_names
+        channel_names=channel_names,
+        edge_detector=edge_detector,
+        read_blocks=read_blocks
     )
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + f"Data file ready {time.perf_counter() - end:.2f}s after stop.")
+
+    if bus is not None:
+        bus.close()
 
     ser.close()
 
 
 
-def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages_from_arduino,
+def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, message_store, stream_writer,
                           message_counter, full_messages, start, end, error_messages,
-                          channel_names):
-    message_ids = np.array([m[0] for m in messages_from_arduino], dtype=np.uint32)
-    states = np.array([m[1] for m in messages_from_arduino], dtype=np.uint8)
-    timestamps = np.array([m[2] for m in messages_from_arduino], dtype=np.float64)
+                          channel_names, edge_detector=None, read_blocks=None):
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + message_store.memory_report(n_copies=2))
 
-    num_channels = len(channel_names)
-    num_messages = len(states)
-    channel_data_array = np.zeros((num_messages, num_channels), dtype=np.uint8)
-    
-    for i, state in enumerate(states):
-        # If you want the first channel name in the list to be the highest bit:
-        for bit_index in range(num_channels):
-            msb_aligned_bit = num_channels - 1 - bit_index
-            channel_data_array[i, bit_index] = (state >> msb_aligned_bit) & 1
-
-    save_file_name = f"{foldername}-ArduinoDAQ.h5"
-    output_file = output_path / save_file_name
+    # Fit msgNum against host time to remove USB / scheduling jitter from the timestamps
+    clock_model = fit_clock_model(message_store.column(0), message_store.column(2))
+    print(Fore.YELLOW + "ArduinoDAQ:" + Style.RESET_ALL + describe_clock_model(clock_model))
+
+    num_messages = message_store.count
     json_file_name = f"{foldername}-ArduinoDAQ.json"
     json_output_file = output_path / json_file_name
 
@@ -223,9 +260,7 @@ def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages
     except ZeroDivisionError:
         reliability = 0
 
-    binary_list = [''.join(str(bit) for bit in row) for row in channel_data_array]
-
-    data_to_save = {
+    summary = {
         "mouse_ID": mouse_ID,
         "date_time": date_time,
         "time": str(datetime.now()),
@@ -233,37 +268,24 @@ def save_to_hdf5_and_json(foldername, output_path, mouse_ID, date_time, messages
         "reliability": reliability,
         "time_taken": end - start,
         "messages_per_second": (num_messages / (end - start)) if (end - start) else 0,
-        "message_ids": message_ids.tolist(),
-        "timestamps": timestamps.tolist(),
-        "channel_data_raw": binary_list,
-        "error_messages": error_messages,
-        "channel_names": channel_names
     }
 
-    with open(json_output_file, 'w') as json_file:
-        json.dump(data_to_save, json_file, indent=4)
-
-    with h5py.File(output_file, 'w') as h5f:
-        h5f.attrs['mouse_ID'] = mouse_ID
-        h5f.attrs['date_time'] = date_time
-        h5f.attrs['time'] = str(datetime.now())
-        h5f.attrs['No_of_messages'] = num_messages
-        h5f.attrs['reliability'] = reliability
-        h5f.attrs['time_taken'] = end - start
-        h5f.attrs['messages_per_second'] = (num_messages / (end - start)) if (end - start) else 0
+    # Flush the last messages and write statistics, clock model and edges into the streamed file
+    finalize_time = stream_writer.finalize(message_store, summary, clock_model, edge_detector, error_messages,
+                                           read_blocks)
 
-        h5f.create_dataset('message_ids', data=message_ids, compression='gzip')
-        h5f.create_dataset('timestamps', data=timestamps, compression='gzip')
-
-        channel_group = h5f.create_group('channel_data')
-        for ch_index, ch_name in enumerate(channel_names):
-            channel_group.create_dataset(ch_name, data=channel_data_array[:, ch_index], compression='gzip')
+    # The per-message data lives in the HDF5 file only; the JSON is a summary
+    data_to_save = dict(summary)
+    data_to_save.update({
+        "h5_file": f"{foldername}-ArduinoDAQ.h5",
+        "finalize_time": finalize_time,
+        "error_messages": error_messages,
+        "channel_names": channel_names,
+        "clock_model": {k: v for k, v in clock_model.items() if k != "timestamps_corrected"}
+    })
 
-        if error_messages:
-            error_messages_str = [str(err_msg) for err_msg in error_messages]
-            error_messages_np = np.array(error_messages_str, dtype=object)
-            h5f.create_dataset('error_messages', data=error_messages_np,
-                               compression='gzip', dtype=h5py.string_dtype())
+    with open(json_output_file, 'w') as json_file:
+        json.dump(data_to_save, json_file, indent=4)
 
 def save_to_backup_csv(backup_csv_path, backup_buffer):
     try:
@@ -286,6 +308,7 @@ def main():
         type=str,
         help="Comma-separated list of 8 channel names (e.g. 'IN3V3_2_camera,IN3V3_3,IN3V3_4,IN3V3_5,IN5V_6_head_sensor,IN5V_7_laser,IN5V_8,IN5V_9')"
     )
+    parser.add_argument('--live_bus', action='store_true', help='Publish messages to a shared-memory live data bus')
     args = parser.parse_args()
 
     if not args.channels:
@@ -310,7 +333,8 @@ def main():
                 new_mouse_ID=mouse_ID,
                 new_date_time=date_time,
                 new_path=path,
-                port=args.port
+                port=args.port,
+                live_bus=args.live_bus
             )
         )
     except Exception:
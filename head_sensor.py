@@ -10,6 +10,7 @@ import h5py
 import json
 import sys
 from utils.utils import create_end_signal
+from utils.live_data_bus import LiveBusWriter, IMU_SAMPLE_DTYPE, bus_name
 import asyncio
 import threading
 import re
@@ -137,7 +138,8 @@ def read_sensor(head_sensor,
                 output_path,
                 save_file_name,
                 end_signal_name,
-                sensor_location):
+                sensor_location,
+                live_bus=None):
     
     print(Fore.BLUE + f"{sensor_location}: " + Style.RESET_ALL + "Reading sensor data...")
 
@@ -191,6 +193,9 @@ def read_sensor(head_sensor,
 
                         adw.update_display_safe(angle_display, yaw, roll, pitch)
 
+                        if live_bus is not None:
+                            live_bus.publish_sample(message_id, current_time, yaw, roll, pitch)
+
                         message_count += 1
                         full_messages += 1
                 else:
@@ -250,6 +255,9 @@ def read_sensor(head_sensor,
         f.create_dataset('timestamps', data=timestamps)
         print(Fore.BLUE + f"{sensor_location}: " + Style.RESET_ALL + "Data saved to HDF5 file")
 
+    if live_bus is not None:
+        live_bus.close()
+
     angle_display.close()
     head_sensor.close()
 
@@ -262,6 +270,7 @@ def main():
     parser.add_argument('--path', type=str, help='path')
     parser.add_argument('--rotation', type=float, default=90, help='Rotation angle in degrees')
     parser.add_argument('--sensor_location', type=str, default='head', help='Location of the sensor (e.g., head, body)')
+    parser.add_argument('--live_bus', action='store_true', help='Publish samples to a shared-memory live data bus')
     args = parser.parse_args()
 
     angle_display = adw.AngleDisplay(window_title=f"{args.sensor_location.capitalize()} Sensor Angles")
@@ -351,6 +360,14 @@ def main():
 
         # initial_yaw, initial_roll, initial_pitch = 0, 0, 0
 
+        live_bus = None
+        if args.live_bus:
+            try:
+                live_bus = LiveBusWriter(bus_name(foldername, args.sensor_location), IMU_SAMPLE_DTYPE)
+                print(Fore.BLUE + f"{args.sensor_location} " + Style.RESET_ALL + f"Publishing samples to live data bus '{live_bus.name}'")
+            except Exception as e:
+                print(Fore.BLUE + f"{args.sensor_location} " + Style.RESET_ALL + f"Could not create live data bus: {e}")
+
         def sensor_thread():
             read_sensor(head_sensor,
                         initial_yaw, 
@@ -361,7 +378,8 @@ def main():
                         end_signal_name=signal_name,
                         output_path=output_path,
                         save_file_name=save_file_name,
-                        sensor_location=args.sensor_location)
+                        sensor_location=args.sensor_location,
+                        live_bus=live_bus)
 
         # Start sensor reading in a separate thread
         sensor_thread = threading.Thread(target=sensor_thread, daemon=True)
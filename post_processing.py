@@ -10,26 +10,37 @@ import time
 import sys
 import re
 
-from utils.video_processor import process_cohort_videos
+from functools import partial
 from utils.cohort_folder_openfield import Cohort_folder
-from utils.openfield_analysis_manager import Analysis_manager_openfield
+from utils.session_pool import run_sessions_in_pool, DEFAULT_WORKERS
+from utils.session_pipeline import run_session_pipeline, DEFAULT_VIDEO_WORKERS
 
-def sync_with_cephfs(local_dir, remote_dir):
+def sync_with_cephfs(local_dir, remote_dir, relative_path=None):
     """
     Synchronizes local directory with remote CephFS directory using rsync via Cygwin's bash.
+    If relative_path is given, only local_dir/relative_path is synced, to the same relative
+    path under remote_dir (missing parent folders are created).
+    
+    Returns:
+        bool: True if rsync succeeded
     """
     # Ensure trailing slashes for directories
     if not local_dir.endswith('/'):
         local_dir += '/'
     if not remote_dir.endswith('/'):
         remote_dir += '/'
+    relative_flag = ''
+    if relative_path:
+        # The "/./" marks where the path recreated under remote_dir starts
+        local_dir = f"{local_dir}./{relative_path.strip('/')}/"
+        relative_flag = '--relative '
     
     # Full path to Cygwin's bash executable
     bash_path = r"C:\cygwin64\bin\bash.exe"
     
     # Build the rsync command (the paths are in Cygwin format)
     rsync_cmd = (
-        f'rsync -avz --no-group --progress --info=progress2 --stats --partial --delete '
+        f'rsync -avz {relative_flag}--no-group --progress --info=progress2 --stats --partial --delete '
         f'"{local_dir}" "{remote_dir}"'
     )
     
@@ -65,6 +76,7 @@ def sync_with_cephfs(local_dir, remote_dir):
         
         if process.returncode == 0:
             print("\nSync completed successfully.\n")
+            return True
         else:
             print(f"\nError occurred during rsync: Return code {process.returncode}")
             _, stderr = process.communicate()
@@ -76,6 +88,31 @@ def sync_with_cephfs(local_dir, remote_dir):
     except Exception as e:
         print(f"Unexpected error occurred during rsync: {e}")
         print(f"Error details:\n{traceback.format_exc()}")
+    return False
+
+def transfer_session_to_cephfs(session_dict, cohort_directories):
+    """
+    Rsync one post-processed session folder to the CephFS copy of its cohort.
+    
+    Args:
+        session_dict (dict): Session information from Cohort_folder
+        cohort_directories (list): Cohort directory dicts with 'local', 'rsync_local'
+            and 'rsync_cephfs_mapped' paths
+        
+    Returns:
+        bool: True if rsync succeeded
+    """
+    session_dir = Path(session_dict.get("directory", ""))
+    for cd in cohort_directories:
+        if 'rsync_local' not in cd or 'rsync_cephfs_mapped' not in cd:
+            continue
+        try:
+            relative_path = session_dir.relative_to(cd['local']).as_posix()
+        except ValueError:
+            continue
+        return sync_with_cephfs(cd['rsync_local'], cd['rsync_cephfs_mapped'], relative_path=relative_path)
+    print(f"No rsync paths configured for {session_dir}, not transferred.")
+    return False
 
 def wait_until_time(target_hour):
     """
@@ -94,7 +131,7 @@ def wait_until_time(target_hour):
             print(f"Waiting for {remaining_time} more hour(s) until {target_hour}:00. Current time: {current_time.strftime('%H:%M:%S')}")
             time.sleep(60)
 
-def find_sessions_to_process(cohort_directory, refresh=False):
+def find_sessions_to_process(cohort_directory, refresh=False, full_rescan=False):
     """
     Given a cohort directory info dict, return a list of sessions that need processing
     (where raw data is present but preliminary analysis not yet done).
@@ -102,55 +139,53 @@ def find_sessions_to_process(cohort_directory, refresh=False):
     Args:
         cohort_directory (dict): Dictionary containing cohort directory information
         refresh (bool): If True, include sessions that have already been processed for reprocessing
+        full_rescan (bool): If True, list every session folder instead of only those changed
+            since the last scan
         
     Returns:
         list: List of session information dictionaries to process
     """
     print(f"\nExamining directory: {cohort_directory['local']}")
 
-    cohort_folder = Cohort_folder(cohort_directory['local'])
-    cohort_info = cohort_folder.cohort
-    
-    sessions_to_process = []
-    for mouse, mouse_data in cohort_info["mice"].items():
-        for session in mouse_data["sessions"]:
-            session_info = cohort_folder.get_session(session)
-            
-            raw_data_present = session_info["raw_data"].get("is_all_raw_data_present?", False)
-            analysis_done = session_info["processed_data"].get("preliminary_analysis_done?", False)
-            
-            if raw_data_present:
-                if not analysis_done or refresh:
-                    # Include session if:
-                    # - It hasn't been processed yet, OR
-                    # - refresh is True (reprocess even if already done)
-                    sessions_to_process.append(session_info)
-                    
-                    if analysis_done and refresh:
-                        print(f"  Reprocessing session: {session} for mouse {mouse} (refresh requested)")
-                    else:
-                        print(f"  Found unprocessed session: {session} for mouse {mouse}")
-                else:
-                    print(f"  Skipping session {session} for mouse {mouse} - Already processed")
-            else:
-                print(f"  Skipping session {session} for mouse {mouse} - Missing raw data")
+    cohort_folder = Cohort_folder(cohort_directory['local'], full_rescan=full_rescan)
+
+    # Sessions missing required raw data are never processed
+    for session_info in cohort_folder.find_sessions(raw_data_present=False):
+        print(f"  Skipping session {session_info['session_id']} for mouse {session_info['mouse_id']} - Missing raw data")
+
+    # Processed sessions (NWB file present) are only included when refreshing
+    sessions_to_process = cohort_folder.find_sessions(raw_data_present=True, processed=None if refresh else False)
+    for session_info in sessions_to_process:
+        session, mouse = session_info['session_id'], session_info['mouse_id']
+        if session_info["processed_data"].get("processed_data_present?", False):
+            print(f"  Reprocessing session: {session} for mouse {mouse} (refresh requested)")
+        else:
+            print(f"  Found unprocessed session: {session} for mouse {mouse}")
+
+    if not refresh:
+        for session_info in cohort_folder.find_sessions(raw_data_present=True, processed=True):
+            print(f"  Skipping session {session_info['session_id']} for mouse {session_info['mouse_id']} - Already processed")
     
     return sessions_to_process
 
-def run_postprocessing_for_sessions(sessions_to_process):
+def run_postprocessing_for_sessions(sessions_to_process, n_workers=DEFAULT_WORKERS, force=False):
     """
-    For each session in sessions_to_process, run the analysis logic.
+    Run the analysis logic for every session in sessions_to_process, n_workers sessions at a time.
+    Each session logs to <session_id>_postprocessing.log in its folder and a summary table is
+    printed at the end. Stages whose inputs, code and parameters are unchanged since their last
+    run are skipped unless force is True.
+    
+    Returns:
+        list: Per-session results (status, duration, output sizes)
     """
     print(f"Starting processing of {len(sessions_to_process)} sessions...")
-    for session_info in sessions_to_process:
-        Analysis_manager_openfield(session_info)
+    return run_sessions_in_pool(sessions_to_process, n_workers=n_workers, force=force)
 
 def main():
     """
     Main function to process multiple cohort directories and sync with CephFS.
-    We have three cohorts defined. The first two will be processed
-    using the "video-compress-then-postprocess-then-rsync" sequence
-    in one big block, while the third continues with the original logic.
+    Sessions from all cohorts go through one pipeline (video conversion, post-processing,
+    optional rsync), each session advancing as soon as its own previous stage is done.
     """
     # Define cohort directories with both local and remote paths using Windows paths
     cohort_directories = []
@@ -314,42 +349,38 @@ def main():
     # wait_until_time(22)  # Uncomment to enable waiting until 10 PM
 
     # ------------------------------------------------------------------
-    # PART A: For the cohorts, do the "three-phase" approach:
-    #   1) Gather sessions, compress all videos first
-    #   2) Post-process all sessions
-    #   3) Then rsync
+    # PART A: Gather the sessions of every cohort, then pipeline them:
+    #   each session's video is converted, then it is post-processed,
+    #   then (optionally) rsynced, as soon as its own previous stage is
+    #   done. Each stage has its own worker limit.
     # ------------------------------------------------------------------
-    # Store the sessions that need processing for the cohorts
-    sessions_map = {}
-
     refresh = False  # Set to True to reprocess already processed sessions
-
-    # Phase 1: Gather sessions, compress videos for each
-    print("\n=== PHASE 1: Gathering sessions & compressing videos ===")
-    for cd in cohort_directories:
-        sessions_to_process = find_sessions_to_process(cd, refresh=refresh)
-        sessions_map[cd['local']] = sessions_to_process
-        if sessions_to_process:
-            print(f"\nFound {len(sessions_to_process)} sessions needing processing in {cd['local']}. Compressing videos...")
-            process_cohort_videos(cd['local'])
-        else:
-            print(f"No sessions to process in {cd['local']}. Skipping compression.")
-
-    # Phase 2: Post-process all sessions
-    print("\n=== PHASE 2: Post-processing sessions ===")
+    n_workers = DEFAULT_WORKERS  # Number of sessions post-processed in parallel
+    video_workers = DEFAULT_VIDEO_WORKERS  # Number of videos converted in parallel (sharing one pool of all cores)
+    video_encoder = 'mjpg'  # 'mjpg' (chunked OpenCV) or 'h264' / 'hevc' / 'ffv1' (lossless) via one ffmpeg pipe
+    force = False  # Set to True to rerun every stage even if its inputs are unchanged
+    transfer = False  # Set to True to rsync each session to CephFS once it is post-processed
+    full_rescan = False  # Set to True to list every session folder, not only those changed since the last scan
+
+    print("\n=== Gathering sessions ===")
+    sessions_to_process = []
     for cd in cohort_directories:
-        sessions_to_process = sessions_map[cd['local']]
-        if sessions_to_process:
-            run_postprocessing_for_sessions(sessions_to_process)
-        else:
-            print(f"No sessions to post-process in {cd['local']}.")
-
-    # Phase 3: Rsync
-    # print("\n=== PHASE 3: Syncing changes ===")
-    # for cd in cohort_directories:
-    #     print(f"Syncing {cd['rsync_local']} to {cd['rsync_cephfs_mapped']}...")
-    #     sync_with_cephfs(cd['rsync_local'], cd['rsync_cephfs_mapped'])
-    print("\n=== PHASE 3: Syncing switched off. Move files manually. ===")
+        sessions_to_process.extend(find_sessions_to_process(cd, refresh=refresh, full_rescan=full_rescan))
+
+    print("\n=== Converting videos, post-processing and syncing sessions ===")
+    if sessions_to_process:
+        run_session_pipeline(
+            sessions_to_process,
+            video_workers=video_workers,
+            postprocess_workers=n_workers,
+            transfer=partial(transfer_session_to_cephfs, cohort_directories=cohort_directories) if transfer else None,
+            force=force,
+            video_encoder=video_encoder,
+        )
+    else:
+        print("No sessions to process.")
+    if not transfer:
+        print("\nSyncing switched off. Move files manually.")
 
     print("\nAll requested directories have been processed and synced successfully.")
 
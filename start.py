@@ -224,6 +224,7 @@ if __name__ == "__main__":
     run_camera = True
     run_arduino_daq = True
     run_stim_board = True
+    run_live_data_bus = True    # publish live samples to shared memory for monitors / online QC
 
     # Channel list must have exactly 8 entries for the DAQ script
     channel_list = [
@@ -264,6 +265,7 @@ if __name__ == "__main__":
         run_camera=run_camera,
         run_arduino_daq=run_arduino_daq,
         run_stim_board=run_stim_board,
+        live_data_bus=run_live_data_bus,
         channel_list=channel_list,
         camera_serial_number=camera_serial_number,
         camera_fps=camera_fps
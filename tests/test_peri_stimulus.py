@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "utils"))
+from peri_stimulus import peri_stimulus_array
+
+RATE = 100.0
+
+
+def native(timestamps, event_times, window):
+    """Native-sample windows of a ramp (value = time in degrees)."""
+    return peri_stimulus_array(timestamps, timestamps, event_times, window=window, rate=None)
+
+
+def test_window_before_recording_start_is_nan():
+    timestamps = 10.0 + np.arange(1000) / RATE
+    time, data = native(timestamps, [10.2, 12.005], window=(-1.0, 2.0))
+    assert np.isnan(data[0]).all()
+    # A window inside the recording starts at its own first sample
+    event_index = int(np.argmin(np.abs(time)))
+    assert np.isclose(data[1, 0, 0], 11.01, atol=1e-3)
+    assert np.isclose(data[1, event_index, 0], 12.01, atol=1e-3)
+
+
+def test_window_in_gap_or_across_gap_is_nan():
+    timestamps = np.concatenate([np.arange(0, 10.0, 1 / RATE), np.arange(10.5, 20.0, 1 / RATE)])
+    time, data = native(timestamps, [10.3, 10.805, 5.005, 15.0], window=(-0.2, 0.5))
+    assert np.isnan(data[0]).all()        # window starts in the gap
+    assert np.isclose(data[1, 0, 0], 10.61, atol=1e-3)  # window starts after the gap
+    assert np.isfinite(data[2]).all() and np.isclose(data[2, 0, 0], 4.81, atol=1e-3)
+    assert np.isfinite(data[3]).all()
+    _, data = native(timestamps, [9.9], window=(-0.2, 0.5))
+    assert np.isnan(data[0]).all()        # window spans the gap
@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "utils"))
+from stage_manifest import StageManifest
+
+
+def test_missing_optional_input_is_current(tmp_path):
+    """A stage recorded without its optional video ("None" from Cohort_folder) stays current."""
+    synced = tmp_path / "s_synced_data.h5"
+    synced.write_bytes(b"synced")
+    output = tmp_path / "s_headtracker.nwb"
+    output.write_bytes(b"nwb")
+    inputs = {"synced_data": str(synced), "metadata": None, "video": "None",
+              "body_sensor_h5": tmp_path / "missing_Body_sensor.h5"}
+
+    manifest = StageManifest(tmp_path, "s")
+    manifest.record("nwb", inputs, {}, "code", {"nwb": output})
+
+    assert StageManifest(tmp_path, "s").check("nwb", inputs, {}, "code") == \
+        (True, "inputs, code and parameters unchanged")
+
+
+def test_optional_input_appearing_reruns(tmp_path):
+    synced = tmp_path / "s_synced_data.h5"
+    synced.write_bytes(b"synced")
+    output = tmp_path / "s_headtracker.nwb"
+    output.write_bytes(b"nwb")
+    manifest = StageManifest(tmp_path, "s")
+    manifest.record("nwb", {"synced_data": synced, "video": "None"}, {}, "code", {"nwb": output})
+
+    video = tmp_path / "s_output.avi"
+    video.write_bytes(b"video")
+    assert manifest.check("nwb", {"synced_data": synced, "video": video}, {}, "code") == \
+        (False, "input changed: video")
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "utils"))
+from sync_alignment import align_ids_to_pulses
+
+
+def test_camera_late_daq_start():
+    """Camera frames without host times, DAQ recording started 50 pulses late."""
+    rng = np.random.default_rng(0)
+    period = 1 / 30
+    # Frame ids skip where the camera dropped frames; a pulse follows every delivered frame
+    ids = np.cumsum(rng.choice([1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 3], size=3000))
+    ids -= ids[0]
+    pulse_times = ids * period + rng.normal(0, 0.5e-3, len(ids))
+    late = 50
+    pulse_times = pulse_times[late:] + 12.3
+
+    alignment = align_ids_to_pulses(ids, pulse_times, name="camera")
+
+    expected = np.arange(len(ids)) - late
+    expected[expected < 0] = -1
+    np.testing.assert_array_equal(alignment["pulse_index"], expected)
+    assert alignment["offsets"].tolist() == [-late]
+    assert alignment["correlations"][0] > 0.9
+    assert not alignment["poor"]
+
+
+def test_imu_late_daq_start():
+    """IMU messages with host receive times, DAQ recording started 50 pulses late."""
+    rng = np.random.default_rng(1)
+    send_times = np.cumsum(rng.normal(0.01, 1e-3, 3000))
+    ids = np.arange(len(send_times))
+    host_times = send_times + rng.normal(0, 0.2e-3, len(send_times)) + 1000.0
+    late = 50
+    pulse_times = send_times[late:]
+
+    alignment = align_ids_to_pulses(ids, pulse_times, host_times, name="head sensor")
+
+    assert alignment["offsets"].tolist() == [-late]
+    np.testing.assert_array_equal(alignment["pulse_index"][late:], ids[late:] - late)
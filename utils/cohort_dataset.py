@@ -0,0 +1,377 @@
+"""
+cohort_dataset.py - One memory-mappable store of a cohort's synced angles and trial tables
+
+Cross-session analyses used to open every session's synced data or NWB file (across the local
+drive and the W: share) and read whole arrays to use small slices. `CohortDataset.build` walks
+the cohort with `Cohort_folder` and appends each session's uniform-grid angles (the `uniform`
+group of the synced data store, see resampling.py), its trial table and its metadata to a
+single store in `<cohort>/cohort_dataset/`:
+
+    cohort_dataset/
+    ├── index.json           sessions (row ranges per table, metadata, source fingerprint),
+    │                        row counts and dtypes of every column
+    ├── uniform/<column>.bin timestamps, head_/body_ yaw_data, roll_data, pitch_data, valid
+    └── trials/<column>.bin  onset_times, offset_times, durations, duration_class_ms, power_mW,
+                             set_power_mW, n_pulses, session (session number)
+
+Every column is a flat little-endian binary file opened with `np.memmap`, and each session's
+rows are contiguous, so a query is a few slice reads. Builds are incremental: sessions whose
+synced data file has the same size and mtime as when they were added are skipped, new sessions
+are appended, and re-synced sessions are appended again with their old rows left unreferenced
+until `compact` rewrites the store.
+"""
+
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from cohort_folder_openfield import Cohort_folder
+from synced_data_store import load_synced_data
+from peri_stimulus import wrap_at_event
+
+DATASET_DIR_NAME = "cohort_dataset"
+INDEX_VERSION = 1
+SENSOR_PREFIXES = ("head", "body")
+ANGLE_COLUMNS = ("yaw_data", "roll_data", "pitch_data")
+
+TABLE_COLUMNS = {
+    "uniform": {"timestamps": "<f8",
+                **{f"{prefix}_{column}": "<f4" for prefix in SENSOR_PREFIXES for column in ANGLE_COLUMNS},
+                **{f"{prefix}_valid": "u1" for prefix in SENSOR_PREFIXES}},
+    "trials": {"onset_times": "<f8", "offset_times": "<f8", "durations": "<f8", "duration_class_ms": "<f4",
+               "power_mW": "<f4", "set_power_mW": "<f4", "n_pulses": "<i4", "session": "<i4"},
+}
+
+
+class CohortDataset:
+    """
+    Consolidated, memory-mapped store of one cohort's synced data.
+    """
+
+    def __init__(self, cohort_directory, dataset_directory=None):
+        """
+        Args:
+            cohort_directory (str or Path): Cohort folder (as given to Cohort_folder)
+            dataset_directory (str or Path, optional): Where to keep the store; defaults to
+                `<cohort_directory>/cohort_dataset`
+        """
+        self.cohort_directory = Path(cohort_directory)
+        self.directory = Path(dataset_directory) if dataset_directory else self.cohort_directory / DATASET_DIR_NAME
+        self.index_path = self.directory / "index.json"
+        self._memmaps = {}
+
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {
+                "version": INDEX_VERSION,
+                "cohort": self.cohort_directory.name,
+                "next_session_number": 0,
+                "sessions": {},
+                "tables": {table: {"rows": 0, "columns": columns} for table, columns in TABLE_COLUMNS.items()},
+            }
+
+    # ------------------------------------------------------------------
+    # Building
+    # ------------------------------------------------------------------
+    def _column_path(self, table, column):
+        return self.directory / table / f"{column}.bin"
+
+    def _truncate_to_index(self):
+        """Drop rows written after the last saved index (e.g. an interrupted build)."""
+        for table, info in self.index["tables"].items():
+            for column, dtype in info["columns"].items():
+                path = self._column_path(table, column)
+                expected = info["rows"] * np.dtype(dtype).itemsize
+                if path.exists() and path.stat().st_size > expected:
+                    with open(path, 'r+b') as f:
+                        f.truncate(expected)
+
+    def _append(self, table, data):
+        """Append rows to every column of `table`; returns the (start, stop) row range."""
+        info = self.index["tables"][table]
+        n_rows = len(next(iter(data.values())))
+        for column, dtype in info["columns"].items():
+            path = self._column_path(table, column)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(np.ascontiguousarray(data[column], dtype=dtype).tobytes())
+        start = info["rows"]
+        info["rows"] += n_rows
+        return start, info["rows"]
+
+    @staticmethod
+    def _fingerprint(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def add_session(self, session_dict):
+        """
+        Append (or re-append) one session from its synced data store.
+
+        Returns:
+            bool: True if the session was added
+        """
+        session_id = session_dict["session_id"]
+        synced_data_file = session_dict.get("processed_data", {}).get("synced_data_file", "None")
+        if synced_data_file == "None" or not synced_data_file.endswith(".h5"):
+            print(f"  {session_id}: no synced data store (.h5), skipping")
+            return False
+
+        synced_data = load_synced_data(synced_data_file, streams=["uniform", "trials"])
+        uniform = synced_data.get("uniform")
+        if uniform is None:
+            print(f"  {session_id}: synced data has no uniform grid, re-run post-processing; skipping")
+            return False
+
+        previous = self.index["sessions"].get(session_id)
+        number = previous["number"] if previous else self.index["next_session_number"]
+
+        n_samples = len(uniform["timestamps"])
+        columns = {"timestamps": uniform["timestamps"]}
+        for prefix in SENSOR_PREFIXES:
+            for column in ANGLE_COLUMNS:
+                columns[f"{prefix}_{column}"] = uniform.get(f"{prefix}_{column}", np.full(n_samples, np.nan))
+            columns[f"{prefix}_valid"] = uniform.get(f"{prefix}_valid", np.zeros(n_samples, dtype=bool))
+        uniform_rows = self._append("uniform", columns)
+
+        trials = synced_data.get("trials") or {}
+        n_trials = len(trials.get("onset_times", []))
+        trial_columns = {column: trials.get(column, np.zeros(n_trials)) for column in TABLE_COLUMNS["trials"]
+                         if column != "session"}
+        trial_columns["session"] = np.full(n_trials, number)
+        trial_rows = self._append("trials", trial_columns)
+
+        metadata = {}
+        metadata_path = session_dict.get("raw_data", {}).get("metadata", "None")
+        if metadata_path != "None" and Path(metadata_path).exists():
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+
+        timestamps = np.asarray(uniform["timestamps"])
+        self.index["sessions"][session_id] = {
+            "number": number,
+            "mouse_id": session_dict.get("mouse_id"),
+            "body_sensor": bool(session_dict.get("body_sensor", False)),
+            "synced_data_file": str(synced_data_file),
+            "fingerprint": self._fingerprint(synced_data_file),
+            "uniform_rows": list(uniform_rows),
+            "trial_rows": list(trial_rows),
+            "t0": float(timestamps[0]) if n_samples else None,
+            "rate": float(1.0 / np.median(np.diff(timestamps))) if n_samples > 1 else None,
+            "metadata": metadata,
+            "added": str(datetime.now()),
+        }
+        if previous is None:
+            self.index["next_session_number"] += 1
+        return True
+
+    def build(self, cohort=None, refresh=False):
+        """
+        Add new and changed sessions of the cohort to the store.
+
+        Args:
+            cohort (Cohort_folder, optional): Already scanned cohort; scanned here if None
+            refresh (bool): Re-add every session even if its synced data is unchanged
+
+        Returns:
+            int: Number of sessions added or updated
+        """
+        if cohort is None:
+            cohort = Cohort_folder(self.cohort_directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._truncate_to_index()
+        self._memmaps.clear()
+
+        n_added = 0
+        for mouse_id, mouse_data in cohort.cohort["mice"].items():
+            for session_id, session_dict in mouse_data["sessions"].items():
+                entry = self.index["sessions"].get(session_id)
+                synced_data_file = session_dict.get("processed_data", {}).get("synced_data_file", "None")
+                if (entry is not None and not refresh and synced_data_file == entry["synced_data_file"]
+                        and Path(synced_data_file).exists()
+                        and self._fingerprint(synced_data_file) == entry["fingerprint"]):
+                    continue
+                try:
+                    if self.add_session(session_dict):
+                        n_added += 1
+                        print(f"  Added {session_id} (mouse {mouse_id})")
+                except Exception as e:
+                    print(f"  Failed to add {session_id}: {e}")
+
+        self.save()
+        print(f"Cohort dataset: {n_added} session(s) added or updated, {len(self.index['sessions'])} in total "
+              f"({self.index['tables']['uniform']['rows']} samples, {self.index['tables']['trials']['rows']} trials)")
+        return n_added
+
+    def save(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def compact(self):
+        """
+        Rewrite the store without rows left unreferenced by re-added sessions.
+        """
+        for table in self.index["tables"]:
+            info = self.index["tables"][table]
+            key = "uniform_rows" if table == "uniform" else "trial_rows"
+            sessions = sorted(self.index["sessions"].values(), key=lambda s: s[key][0])
+            for column, dtype in info["columns"].items():
+                data = self.column(table, column)
+                path = self._column_path(table, column)
+                tmp_path = path.with_suffix(".tmp")
+                with open(tmp_path, 'wb') as f:
+                    for session in sessions:
+                        f.write(np.ascontiguousarray(data[slice(*session[key])]).tobytes())
+                self._memmaps.pop((table, column), None)
+                del data
+                os.replace(tmp_path, path)
+            row = 0
+            for session in sessions:
+                n = session[key][1] - session[key][0]
+                session[key] = [row, row + n]
+                row += n
+            info["rows"] = row
+        self._memmaps.clear()
+        self.save()
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+    @property
+    def sessions(self):
+        """Session IDs in the store."""
+        return list(self.index["sessions"])
+
+    def column(self, table, column):
+        """
+        Memory-mapped view of a whole column.
+        """
+        key = (table, column)
+        if key not in self._memmaps:
+            info = self.index["tables"][table]
+            dtype = info["columns"][column]
+            if info["rows"] == 0:
+                self._memmaps[key] = np.zeros(0, dtype=dtype)
+            else:
+                self._memmaps[key] = np.memmap(self._column_path(table, column), dtype=dtype, mode='r',
+                                               shape=(info["rows"],))
+        return self._memmaps[key]
+
+    def session_angles(self, session_id, t_start=None, t_stop=None, columns=None):
+        """
+        Uniform-grid angles of one session, optionally between two times.
+
+        Args:
+            session_id (str): Session ID
+            t_start, t_stop (float, optional): Time range (s, synced DAQ time)
+            columns (list, optional): Columns to return (default: all uniform columns)
+
+        Returns:
+            dict: {column: memory-mapped slice}
+        """
+        entry = self.index["sessions"][session_id]
+        start, stop = entry["uniform_rows"]
+        if t_start is not None or t_stop is not None:
+            timestamps = self.column("uniform", "timestamps")[start:stop]
+            lo = np.searchsorted(timestamps, t_start) if t_start is not None else 0
+            hi = np.searchsorted(timestamps, t_stop, side='right') if t_stop is not None else len(timestamps)
+            start, stop = start + lo, start + hi
+        columns = columns or list(TABLE_COLUMNS["uniform"])
+        return {column: self.column("uniform", column)[start:stop] for column in columns}
+
+    def trials(self, session_ids=None, duration_class_ms=None, power_mW=None):
+        """
+        Trial table rows across sessions, optionally filtered.
+
+        Returns:
+            dict: {column: array} plus "session_id" for every matching trial
+        """
+        live = np.zeros(self.index["tables"]["trials"]["rows"], dtype=bool)
+        for session_id, entry in self.index["sessions"].items():
+            if session_ids is None or session_id in session_ids:
+                live[slice(*entry["trial_rows"])] = True
+        table = {column: np.asarray(self.column("trials", column)) for column in TABLE_COLUMNS["trials"]}
+        # Values are stored as float32, so compare with a tolerance
+        for column, wanted in (("duration_class_ms", duration_class_ms), ("power_mW", power_mW)):
+            if wanted is not None:
+                wanted = np.atleast_1d(np.asarray(wanted, dtype=np.float64))
+                live &= np.isclose(table[column][:, None], wanted[None, :], rtol=1e-5).any(axis=1)
+
+        result = {column: values[live] for column, values in table.items()}
+        names = {entry["number"]: session_id for session_id, entry in self.index["sessions"].items()}
+        result["session_id"] = np.array([names[number] for number in result["session"]], dtype=object)
+        return result
+
+    def trial_windows(self, trials, column="head_yaw_data", window=(-1.0, 2.0)):
+        """
+        (trials x time) windows of one uniform column around trial onsets, by index
+        arithmetic on the uniform grid (no interpolation). Angle columns are unwrapped within
+        each window and shifted by a multiple of 360 degrees so their value at the onset is in
+        [-180, 180), as in peri_stimulus.
+
+        Args:
+            trials (dict): Output of `trials`
+            column (str): Uniform column
+            window (tuple): (start, stop) relative to onset (s)
+
+        Returns:
+            tuple: (time, data) - data is NaN where the window leaves the session's rows (and
+                   for sessions without uniform samples)
+
+        Raises:
+            ValueError: If the trials come from sessions with different grid rates (their
+                windows would have different time axes; select sessions of one rate with
+                `trials(session_ids=...)`)
+        """
+        entries = {entry["number"]: entry for entry in self.index["sessions"].values()}
+        session_numbers = np.asarray(trials["session"])
+        rates = sorted({round(entries[n]["rate"], 6) for n in np.unique(session_numbers) if entries[n]["rate"]})
+        if len(rates) > 1:
+            raise ValueError(f"Trials come from sessions with different grid rates ({rates} Hz); "
+                             f"select sessions of a single rate")
+        rate = rates[0] if rates else 1.0
+        offsets = np.arange(int(np.ceil(window[0] * rate)), int(np.floor(window[1] * rate)) + 1)
+
+        starts = np.array([entries[n]["uniform_rows"][0] for n in session_numbers], dtype=np.int64)
+        stops = np.array([entries[n]["uniform_rows"][1] for n in session_numbers], dtype=np.int64)
+        # Sessions without uniform samples have no t0 (and no rows)
+        t0 = np.array([np.nan if entries[n]["t0"] is None else entries[n]["t0"] for n in session_numbers],
+                      dtype=np.float64)
+        onset = (np.asarray(trials["onset_times"], dtype=np.float64) - t0) * rate
+        onset_rows = starts + np.rint(np.nan_to_num(onset)).astype(np.int64)
+
+        rows = onset_rows[:, None] + offsets[None, :]
+        inside = (rows >= starts[:, None]) & (rows < stops[:, None]) & np.isfinite(onset)[:, None]
+        values = self.column("uniform", column)
+        data = np.full(rows.shape, np.nan, dtype=np.float32)
+        data[inside] = values[rows[inside]]
+        if column.endswith(ANGLE_COLUMNS):
+            data = wrap_at_event(offsets / rate, _unwrap_windows(data)[:, :, None])[:, :, 0]
+        return offsets / rate, data
+
+
+if __name__ == "__main__":
+    import sys
+    # Example usage: python cohort_dataset.py <cohort_directory>
+    dataset = CohortDataset(sys.argv[1])
+    dataset.build()
+
+
+def _unwrap_windows(data, period=360.0):
+    """
+    Unwrap each row of `data` (trials x time) along time, skipping NaN samples.
+    """
+    finite = np.isfinite(data)
+    # Carry the last valid sample over NaNs so a wrap across a gap is still seen
+    last_valid = np.maximum.accumulate(np.where(finite, np.arange(data.shape[1]), 0), axis=1)
+    filled = np.nan_to_num(np.take_along_axis(data, last_valid, axis=1))
+    unwrapped = np.unwrap(filled, period=period, axis=1).astype(data.dtype)
+    unwrapped[~finite] = np.nan
+    return unwrapped
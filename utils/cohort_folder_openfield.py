@@ -1,23 +1,57 @@
-import json
+import os
+import time
 import traceback
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+from session_catalog import SessionCatalog, catalog_path
+
+# Folder stats / listings on the network shares are dominated by round-trip latency, so they
+# are issued from this many threads at once
+SCAN_WORKERS = 16
+
 class Cohort_folder:
     """
     Class for managing experiment cohorts, checking raw and processed data files,
     and providing access to session information.
     
     This updated version checks for NWB files and includes them as processing requirements.
+    Each session folder is listed once (`os.scandir`) and every file pattern is matched against
+    that listing, so a scan costs one directory listing per session. Each folder's mtime and
+    listing are kept in the catalog, and later scans only list folders whose mtime changed (new
+    or removed files) plus new folders, unless `full_rescan` is set; folders that cannot be
+    listed (e.g. a share error) store no listing and are listed again next time. The folder
+    stats and listings are issued from a bounded thread pool and merged in session-name order. The scan
+    results are stored in the cohort's SQLite catalog (`cohort_catalog.sqlite`),
+    which `get_session` and `find_sessions` query.
     """
 
-    def __init__(self, cohort_directory):
+    # Raw files to look for: "key": (filename_pattern, is_required); a tuple of patterns takes
+    # the first one found
+    RAW_FILES = {
+        "arduino_daq_h5": ("ArduinoDAQ.h5", True),
+        "head_sensor_h5": ("Head_sensor.h5", True),
+        "metadata_json": ("metadata.json", True),
+        # Add optional files here
+        "video": (("output.avi", "output.mp4"), False),  # MJPG / FFV1 AVI, or h264 / hevc MP4
+        "metadata": ("metadata.json", False),
+    }
+    BODY_SENSOR_FILES = {
+        "body_sensor_h5": ("Body_sensor.h5", True),
+    }
+
+    def __init__(self, cohort_directory, full_rescan=False, scan_workers=SCAN_WORKERS):
         """
         Args:
             cohort_directory (str or Path): Path to the folder containing all sessions.
+            full_rescan (bool): List every session folder, ignoring the listings stored by
+                the previous scan.
+            scan_workers (int): Number of threads listing session folders concurrently.
         """
         self.cohort_directory = Path(cohort_directory)
+        self.scan_workers = max(1, scan_workers)
 
         # Basic directory check
         if not self.cohort_directory.exists():
@@ -28,13 +62,30 @@ class Cohort_folder:
             "Cohort name": self.cohort_directory.name,
             "mice": {}
         }
+        self.catalog = SessionCatalog(catalog_path(self.cohort_directory))
+
+        # Session directory -> names of its entries, listed once per scan
+        self._listings = {}
+        # Session directory -> mtime at this scan, and the listings stored by the previous one
+        self._mtimes = {}
+        self._previous_listings = {} if full_rescan else self.catalog.load_listings(self.cohort["Cohort name"])
+        self.changed_sessions = set()
+        # Session directories that could not be listed in this scan (retried by the next one)
+        self.unreadable_directories = set()
 
         # Main initialization steps
+        start = time.perf_counter()
         self.find_mice()
         self.check_raw_data()
         self.check_for_processed_data()
+        n_sessions = len(self._mtimes)
+        print(f"Scanned {n_sessions} session folders in {time.perf_counter() - start:.2f}s "
+              f"({len(self.changed_sessions)} new or changed, {n_sessions - len(self.changed_sessions)} unchanged)")
+        if self.unreadable_directories:
+            print(f"Warning: could not list {len(self.unreadable_directories)} session folder(s); "
+                  f"they will be listed again on the next scan")
 
-        # Save the final JSONs
+        # Save the scan to the catalog
         self.save_cohort_info()
 
     def get_session(self, session_id):
@@ -43,17 +94,24 @@ class Cohort_folder:
         
         Args:
             session_id (str): The session ID to find.
-            concise (bool): If True, return from the 'concise' dictionary; otherwise return full.
 
         Returns:
             dict or None: The session dictionary, or None if not found.
         """
-        # Search the full cohort dict
-        for _, mouse_data in self.cohort["mice"].items():
-            for sess_id, sess_dict in mouse_data["sessions"].items():
-                if sess_id == session_id:
-                    return sess_dict
-        return None
+        return self.catalog.get_session(session_id)
+
+    def find_sessions(self, **filters):
+        """
+        Returns the sessions of this cohort matching the given filters, ordered by date.
+
+        Args:
+            **filters: Any of SessionCatalog.find_sessions' filters (mouse_id, body_sensor,
+                raw_data_present, processed, power_mW, after, before)
+
+        Returns:
+            list: Session dictionaries.
+        """
+        return self.catalog.find_sessions(cohort=self.cohort["Cohort name"], **filters)
 
     def find_mice(self):
         """
@@ -61,14 +119,27 @@ class Cohort_folder:
         """
         print(f"Finding mice/session folders in {self.cohort_directory}")
 
-        session_folders = [
-            folder for folder in self.cohort_directory.glob('*')
-            if folder.is_dir() and len(folder.name) > 13 and folder.name[13] == "_"
-        ]
+        with os.scandir(self.cohort_directory) as entries:
+            session_folders = sorted(
+                Path(entry.path) for entry in entries
+                if entry.is_dir() and len(entry.name) > 13 and entry.name[13] == "_"
+            )
+
+        # Stat all folders concurrently; map keeps the (sorted) folder order
+        with ThreadPoolExecutor(max_workers=self.scan_workers) as executor:
+            mtimes = list(executor.map(lambda folder: folder.stat().st_mtime, session_folders))
 
         # Build the cohort dictionary
-        for sess_folder in session_folders:
+        for sess_folder, mtime in zip(session_folders, mtimes):
             session_id = sess_folder.name
+
+            # Reuse the previous listing of folders whose mtime has not changed
+            self._mtimes[str(sess_folder)] = mtime
+            previous = self._previous_listings.get(str(sess_folder))
+            if previous is not None and previous[0] == mtime:
+                self._listings[str(sess_folder)] = previous[1]
+            else:
+                self.changed_sessions.add(session_id)
             # Parse mouse ID from session_id
             mouse_id = session_id[14:]  # e.g., "250225_175234_mtaq14-1c" => "mtaq14-1c"
 
@@ -83,6 +154,15 @@ class Cohort_folder:
                 "portable": True,  # Add portable flag for session class
             }
 
+        # List the new / changed folders concurrently; the checks below then only read the cache
+        to_list = [directory for directory in self._mtimes if directory not in self._listings]
+        with ThreadPoolExecutor(max_workers=self.scan_workers) as executor:
+            for directory, names in zip(to_list, executor.map(self._scan_directory, to_list)):
+                if names is None:
+                    self.unreadable_directories.add(directory)
+                else:
+                    self._listings[directory] = names
+
     def check_raw_data(self):
         """
         For each session, check if raw data files exist (both required and optional).
@@ -96,25 +176,20 @@ class Cohort_folder:
                 # Prepare a raw_data dictionary
                 raw_data = {}
 
-                self.body_sensor = False
+                # Match every raw file pattern against one listing of the folder
+                patterns = [alternative for pattern, _ in {**self.RAW_FILES, **self.BODY_SENSOR_FILES}.values()
+                            for alternative in self._alternatives(pattern)]
+                found = self.match_files(session_path, patterns)
+
                 # check if body sensor session:
-                if self.find_file(session_path, "Body_sensor.h5"):
-                    self.body_sensor = True
+                self.body_sensor = found["Body_sensor.h5"] is not None
                 
                 session_dict["body_sensor"] = self.body_sensor
 
                 # Define files with their requirement status
-                # Format: "key": (filename_pattern, is_required)
-                files_to_check = {
-                    "arduino_daq_h5": ("ArduinoDAQ.h5", True),
-                    "head_sensor_h5": ("Head_sensor.h5", True),
-                    "metadata_json": ("metadata.json", True),
-                    # Add optional files here
-                    "video": ("output.avi", False),
-                    "metadata": ("metadata.json", False),
-                }
+                files_to_check = dict(self.RAW_FILES)
                 if self.body_sensor:
-                    files_to_check["body_sensor_h5"] = ("Body_sensor.h5", True)
+                    files_to_check.update(self.BODY_SENSOR_FILES)
 
                 missing_required_files = []
                 missing_optional_files = []
@@ -122,8 +197,9 @@ class Cohort_folder:
 
                 # Check for each file
                 for key, (pattern, is_required) in files_to_check.items():
-                    found_file = self.find_file(session_path, pattern)
-                    
+                    found_file = next((found[p] for p in self._alternatives(pattern) if found[p] is not None), None)
+                    pattern = " or ".join(self._alternatives(pattern))
+
                     if found_file is None:
                         raw_data[key] = "None"
                         # Track missing files separately based on requirement status
@@ -153,16 +229,17 @@ class Cohort_folder:
             for _, session_dict in mouse_data["sessions"].items():
                 session_path = Path(session_dict["directory"])
                 processed_data = {}
+                found = self.match_files(session_path, ['synced_data.h5', 'synced_data.json', 'headtracker.nwb'])
                 
-                # Check for synced data file
-                synced_data_file = self.find_file(session_path, 'synced_data.json')
+                # Check for synced data file (HDF5 store, or legacy JSON from older runs)
+                synced_data_file = found['synced_data.h5'] or found['synced_data.json']
                 if synced_data_file:
                     processed_data["synced_data_file"] = str(synced_data_file)
                 else:
                     processed_data["synced_data_file"] = "None"
                 
                 # Check for NWB file (now looking for headtracker.nwb pattern)
-                nwb_file = self.find_file(session_path, 'headtracker.nwb')
+                nwb_file = found['headtracker.nwb']
                 if nwb_file:
                     processed_data["NWB_file"] = str(nwb_file)
                     processed_data["processed_data_present?"] = True
@@ -175,26 +252,79 @@ class Cohort_folder:
 
     def save_cohort_info(self):
         """
-        Saves the main dictionary (`cohort_info.json`) and the concise dictionary
-        (`concise_cohort_info.json`) in the top-level directory.
+        Writes the scanned cohort dictionary to the cohort catalog (`cohort_catalog.sqlite`)
+        in the top-level directory, replacing the previous scan of this cohort. Only new or
+        changed sessions are rewritten, together with their folder listings. Folders that could
+        not be listed keep no listing, so the next scan lists them again.
         """
-        cohort_info_path = self.cohort_directory / "cohort_info.json"
-
+        required_keys = [key for key, (_, is_required) in {**self.RAW_FILES, **self.BODY_SENSOR_FILES}.items()
+                         if is_required]
+        listings = {}
+        for mouse_data in self.cohort["mice"].values():
+            for session_id, session_dict in mouse_data["sessions"].items():
+                directory = session_dict["directory"]
+                if session_id in self.changed_sessions and directory in self._listings:
+                    listings[session_id] = (directory, self._mtimes[directory], self._listings[directory])
         try:
-            with open(cohort_info_path, 'w') as f:
-                json.dump(self.cohort, f, indent=4)
-            print(f"Saved detailed cohort info to {cohort_info_path}")
+            self.catalog.sync_cohort(self.cohort, required_keys=required_keys,
+                                     changed=self.changed_sessions, listings=listings,
+                                     max_workers=self.scan_workers)
+            print(f"Saved cohort info to {self.catalog.path}")
         except Exception as e:
-            print(f"Failed to save {cohort_info_path}: {e}")
+            print(f"Failed to save {self.catalog.path}: {e}")
             traceback.print_exc()
 
+    def list_directory(self, directory: Path):
+        """
+        Returns the entry names of 'directory', listing it only on first use in this scan.
+        An unreadable directory gives [] and is not cached, so it is tried again.
+        """
+        key = str(directory)
+        if key not in self._listings:
+            names = self._scan_directory(key)
+            if names is None:
+                self.unreadable_directories.add(key)
+                return []
+            self.unreadable_directories.discard(key)
+            self._listings[key] = names
+        return self._listings[key]
+
+    @staticmethod
+    def _alternatives(pattern):
+        """
+        Returns the filename patterns of a RAW_FILES entry as a tuple.
+        """
+        return (pattern,) if isinstance(pattern, str) else tuple(pattern)
+
     @staticmethod
-    def find_file(directory: Path, substring: str):
+    def _scan_directory(directory):
+        """
+        Returns the sorted entry names of 'directory' (one os.scandir call), or None if unreadable.
+        """
+        try:
+            with os.scandir(directory) as entries:
+                return sorted(entry.name for entry in entries)
+        except OSError:
+            return None
+
+    def match_files(self, directory: Path, substrings):
+        """
+        Returns {substring: first file in 'directory' whose name contains it, or None}
+        for all substrings, from a single listing of the directory.
+        """
+        found = dict.fromkeys(substrings)
+        remaining = list(found)
+        for name in self.list_directory(directory):
+            for substring in [s for s in remaining if s in name]:
+                found[substring] = Path(directory) / name
+                remaining.remove(substring)
+            if not remaining:
+                break
+        return found
+
+    def find_file(self, directory: Path, substring: str):
         """
         Returns the first file in 'directory' whose name contains 'substring'.
         If none found, returns None.
         """
-        for file in directory.glob('*'):
-            if substring in file.name:
-                return file
-        return None
\ No newline at end of file
+        return self.match_files(directory, [substring])[substring]
\ No newline at end of file
@@ -0,0 +1,208 @@
+"""
+daq_clock.py - Clock model for Arduino DAQ host timestamps
+
+The DAQ listeners stamp each message with `perf_counter()` when it is read from the serial
+port (spread over the interval since the previous read, see `block_timestamps`), so the stamps
+carry USB scheduling, batching and GIL jitter. The Arduino message number
+advances with the Arduino's own crystal clock, so over a session host time is a linear function
+of the message number plus that jitter. `fit_clock_model` fits this line robustly (iteratively
+reweighted least squares with MAD-based outlier rejection) and returns corrected timestamps
+that are smooth to within the Arduino clock resolution.
+
+If the message number does not track time linearly (e.g. firmware that only counts sent
+messages) the residuals stay large and the model is marked as not usable, in which case
+readers keep using the raw timestamps.
+"""
+
+from array import array
+
+import numpy as np
+
+CORRECTED_DATASET = "timestamps_corrected"
+READ_BLOCKS_DATASET = "read_blocks"
+
+# Above this robust residual spread the linear model is not trusted
+MAX_RESIDUAL_STD_S = 5e-3
+MIN_INLIER_FRACTION = 0.5
+
+
+def unwrap_message_ids(message_ids, bits=32):
+    """
+    Convert wrapping unsigned message counters into a monotonic int64 sequence.
+
+    Args:
+        message_ids (array): Raw message numbers as received
+        bits (int): Width of the counter on the Arduino
+
+    Returns:
+        np.ndarray: int64 message numbers with counter wraps removed
+    """
+    ids = np.asarray(message_ids, dtype=np.int64)
+    if len(ids) < 2:
+        return ids.copy()
+    period = np.int64(1) << bits
+    steps = np.diff(ids)
+    wraps = np.cumsum(steps < -(period // 2))
+    return ids + np.concatenate(([0], wraps)) * period
+
+
+def fit_clock_model(message_ids, timestamps, n_iterations=5, rejection_threshold=4.0):
+    """
+    Robustly fit host time as a linear function of the Arduino message number.
+
+    Args:
+        message_ids (array): Message numbers, one per message
+        timestamps (array): Host timestamps (seconds), one per message
+        n_iterations (int): Number of reweighting iterations
+        rejection_threshold (float): Residuals beyond this many robust SDs are ignored
+
+    Returns:
+        dict: slope, intercept, message_id_origin, residual_std, inlier_fraction, ok
+              and the corrected timestamps (None if fewer than two messages)
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    model = {
+        "slope": np.nan,
+        "intercept": np.nan,
+        "message_id_origin": 0,
+        "residual_std": np.nan,
+        "inlier_fraction": 0.0,
+        "ok": False,
+        "timestamps_corrected": None,
+    }
+    if len(timestamps) < 2:
+        return model
+
+    ids = unwrap_message_ids(message_ids)
+    origin = ids[0]
+    x = (ids - origin).astype(np.float64)
+    if x[-1] == x[0]:
+        return model
+
+    inliers = np.ones(len(x), dtype=bool)
+    for _ in range(n_iterations):
+        slope, intercept = np.polyfit(x[inliers], timestamps[inliers], 1)
+        residuals = timestamps - (intercept + slope * x)
+        centre = np.median(residuals[inliers])
+        spread = 1.4826 * np.median(np.abs(residuals[inliers] - centre))
+        spread = max(spread, 1e-6)
+        new_inliers = np.abs(residuals - centre) <= rejection_threshold * spread
+        if new_inliers.sum() < 2 or np.array_equal(new_inliers, inliers):
+            break
+        inliers = new_inliers
+
+    slope, intercept = np.polyfit(x[inliers], timestamps[inliers], 1)
+    residuals = timestamps[inliers] - (intercept + slope * x[inliers])
+    residual_std = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    inlier_fraction = float(inliers.mean())
+
+    model.update({
+        "slope": float(slope),
+        "intercept": float(intercept),
+        "message_id_origin": int(origin),
+        "residual_std": float(residual_std),
+        "inlier_fraction": inlier_fraction,
+        "ok": bool(slope > 0 and residual_std < MAX_RESIDUAL_STD_S
+                   and inlier_fraction >= MIN_INLIER_FRACTION),
+        "timestamps_corrected": intercept + slope * x,
+    })
+    return model
+
+
+def block_timestamps(previous_time, current_time, n_messages):
+    """
+    Host times for the messages of one serial read.
+
+    The listeners read everything waiting in one call, so all the block's messages arrived
+    between the previous read and this one. They are spread evenly over that interval,
+    the last message getting the current read time, so every message keeps its own time.
+
+    Args:
+        previous_time (float): Host time of the previous read (s)
+        current_time (float): Host time of this read (s)
+        n_messages (int): Number of messages decoded from this read
+
+    Returns:
+        np.ndarray: float64 timestamps, increasing, ending at current_time
+    """
+    step = (current_time - previous_time) / n_messages if n_messages else 0.0
+    return current_time - step * np.arange(n_messages - 1, -1, -1, dtype=np.float64)
+
+
+class ReadBlockLog:
+    """
+    Compact record of the serial reads: index of each read's first message and its host time.
+    """
+
+    def __init__(self):
+        self.first_message = array('q')
+        self.read_time = array('d')
+
+    def append(self, first_message, read_time):
+        self.first_message.append(first_message)
+        self.read_time.append(read_time)
+
+    def save_to_hdf5(self, h5f, compression='gzip'):
+        """
+        Store the reads as an (n_reads, 2) `read_blocks` dataset: first message index, host time.
+        """
+        data = np.column_stack((np.frombuffer(self.first_message, dtype=np.int64).astype(np.float64),
+                                np.frombuffer(self.read_time, dtype=np.float64))) \
+            if len(self.read_time) else np.zeros((0, 2))
+        dataset = h5f.create_dataset(READ_BLOCKS_DATASET, data=data, compression=compression)
+        dataset.attrs['columns'] = ['first_message_index', 'read_time']
+
+
+def save_clock_model(h5f, model, compression='gzip'):
+    """
+    Store the clock model parameters as file attributes and the corrected timestamps
+    next to the raw `timestamps` dataset.
+
+    Args:
+        h5f (h5py.File): Open, writable DAQ HDF5 file
+        model (dict): Result of `fit_clock_model`
+        compression (str): HDF5 compression filter for the corrected timestamps (None to disable)
+    """
+    h5f.attrs['clock_model_slope'] = model["slope"]
+    h5f.attrs['clock_model_intercept'] = model["intercept"]
+    h5f.attrs['clock_model_message_id_origin'] = model["message_id_origin"]
+    h5f.attrs['clock_model_residual_std'] = model["residual_std"]
+    h5f.attrs['clock_model_inlier_fraction'] = model["inlier_fraction"]
+    h5f.attrs['clock_model_ok'] = model["ok"]
+    if model["timestamps_corrected"] is not None:
+        h5f.create_dataset(CORRECTED_DATASET, data=model["timestamps_corrected"], compression=compression)
+
+
+def use_corrected_timestamps(h5f):
+    """
+    True if the file holds corrected timestamps from a clock model that passed its checks.
+    """
+    return bool(h5f.attrs.get('clock_model_ok', False)) and CORRECTED_DATASET in h5f
+
+
+def read_daq_timestamps(h5f, use_corrected=True):
+    """
+    Load the per-message DAQ timestamps, preferring clock-model corrected ones.
+
+    Args:
+        h5f (h5py.File): Open DAQ HDF5 file
+        use_corrected (bool): Use corrected timestamps when the clock model is valid
+
+    Returns:
+        np.ndarray: Timestamps in seconds
+    """
+    if use_corrected and use_corrected_timestamps(h5f):
+        return np.array(h5f[CORRECTED_DATASET])
+    return np.array(h5f['timestamps'])
+
+
+def describe_clock_model(model):
+    """
+    One-line summary of a clock model for the console log.
+    """
+    if model["timestamps_corrected"] is None:
+        return "Clock model: not enough messages to fit."
+    status = "OK" if model["ok"] else "NOT USED (raw timestamps kept)"
+    return (f"Clock model {status}: {model['slope'] * 1e6:.4f} us/message, "
+            f"residual SD {model['residual_std'] * 1e6:.1f} us, "
+            f"{model['inlier_fraction'] * 100:.1f}% inliers")
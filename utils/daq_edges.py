@@ -0,0 +1,135 @@
+"""
+daq_edges.py - Online rising/falling edge extraction for Arduino DAQ state words
+
+The DAQ listeners feed every block of decoded state words to an `EdgeDetector`, which XORs each
+word against the previous one and records a (message id, host time, direction) entry for each channel
+bit that changed. The resulting per-channel edge tables are written to the DAQ HDF5 file
+under `channel_edges/<channel>` so post-processing can read edge times directly instead of
+rescanning every sample of every channel.
+
+An edge is attributed to the first message carrying the new state, which matches the
+`np.where((data[:-1] == 0) & (data[1:] == 1))[0] + 1` scans used in post-processing.
+Each edge also records the index of that message in the stream, so clock-model corrected
+times (see daq_clock.py) can be stored alongside the raw host times.
+"""
+
+import numpy as np
+
+EDGE_GROUP = "channel_edges"
+RISING = 1
+FALLING = -1
+
+
+class EdgeDetector:
+    """
+    Tracks state changes per channel as blocks of DAQ messages arrive.
+    """
+
+    def __init__(self, channel_names, bit_positions):
+        """
+        Args:
+            channel_names (sequence): Channel names
+            bit_positions (sequence): Bit index of each channel within the state word
+        """
+        self.channel_names = list(channel_names)
+        self.bit_positions = [int(bit) for bit in bit_positions]
+        self.previous_state = None
+        self.n_messages = 0
+        self.edges = {name: ([], [], [], []) for name in self.channel_names}
+
+    def update(self, message_ids, states, timestamps):
+        """
+        Record the edges introduced by a block of state words. Must be called with every
+        stored message, in order, so that edges can be mapped back to their position in
+        the message stream.
+
+        Args:
+            message_ids (np.ndarray): Message numbers
+            states (np.ndarray): State words
+            timestamps (np.ndarray): Host timestamps
+        """
+        n = len(states)
+        if n == 0:
+            return
+        states = np.asarray(states, dtype=np.uint64)
+        previous = states[0] if self.previous_state is None else np.uint64(self.previous_state)
+        changed = states ^ np.concatenate(([previous], states[:-1])).astype(np.uint64)
+
+        changed_positions = np.flatnonzero(changed)
+        if len(changed_positions):
+            changed = changed[changed_positions]
+            new_states = states[changed_positions]
+            for channel, bit in zip(self.channel_names, self.bit_positions):
+                mask = np.uint64(1) << np.uint64(bit)
+                hits = (changed & mask) != 0
+                if not hits.any():
+                    continue
+                positions = changed_positions[hits]
+                indices, ids, times, directions = self.edges[channel]
+                indices.append(positions + self.n_messages)
+                ids.append(np.asarray(message_ids)[positions])
+                times.append(np.asarray(timestamps)[positions])
+                directions.append(np.where((new_states[hits] & mask) != 0, RISING, FALLING).astype(np.int8))
+
+        self.previous_state = int(states[-1])
+        self.n_messages += n
+
+    def channel_edges(self, channel):
+        """
+        Return the edges found so far on `channel` as arrays.
+
+        Returns:
+            tuple: (message_index, message_ids, timestamps, direction)
+        """
+        indices, ids, times, directions = self.edges[channel]
+        if not indices:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32),
+                    np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int8))
+        return (np.concatenate(indices).astype(np.int64), np.concatenate(ids).astype(np.uint32),
+                np.concatenate(times).astype(np.float64), np.concatenate(directions))
+
+    def save_to_hdf5(self, h5f, corrected_timestamps=None):
+        """
+        Write one edge table per channel into `h5f[EDGE_GROUP]`.
+
+        Args:
+            h5f (h5py.File): Open, writable DAQ HDF5 file
+            corrected_timestamps (np.ndarray, optional): Clock-model timestamps for every message
+        """
+        edge_group = h5f.create_group(EDGE_GROUP)
+        edge_group.attrs['description'] = ("Per-channel edges detected online: message id, host time "
+                                           "and direction (+1 rising, -1 falling)")
+        for channel in self.channel_names:
+            indices, ids, times, directions = self.channel_edges(channel)
+            channel_group = edge_group.create_group(channel)
+            channel_group.create_dataset('message_index', data=indices)
+            channel_group.create_dataset('message_ids', data=ids)
+            channel_group.create_dataset('timestamps', data=times)
+            channel_group.create_dataset('direction', data=directions)
+            if corrected_timestamps is not None:
+                channel_group.create_dataset('timestamps_corrected', data=corrected_timestamps[indices])
+            channel_group.attrs['n_rising'] = int(np.count_nonzero(directions == RISING))
+            channel_group.attrs['n_falling'] = int(np.count_nonzero(directions == FALLING))
+
+
+def read_edges(h5f, channel_name, use_corrected=True):
+    """
+    Read the edge table of one channel from a DAQ HDF5 file.
+
+    Args:
+        h5f (h5py.File): Open DAQ HDF5 file
+        channel_name (str): Channel name
+        use_corrected (bool): Use clock-model corrected times when the model passed its checks
+
+    Returns:
+        tuple or None: (rising_times, falling_times) arrays, or None if the file has no edge table
+    """
+    if EDGE_GROUP not in h5f or channel_name not in h5f[EDGE_GROUP]:
+        return None
+    channel_group = h5f[EDGE_GROUP][channel_name]
+    if use_corrected and h5f.attrs.get('clock_model_ok', False) and 'timestamps_corrected' in channel_group:
+        times = np.array(channel_group['timestamps_corrected'])
+    else:
+        times = np.array(channel_group['timestamps'])
+    directions = np.array(channel_group['direction'])
+    return times[directions == RISING], times[directions == FALLING]
@@ -0,0 +1,109 @@
+"""
+daq_frames.py - Bulk decoding of Arduino DAQ serial frames
+
+Both DAQ boards send fixed-length frames delimited by a start byte (0x01) and an end byte (0x02):
+
+    Due:  0x01 | 9 bytes, message number and 35-bit state interleaved | 0x02   (11 bytes)
+    Giga: 0x01 | 4 bytes message number (big endian) | 1 byte state | 0x02   (7 bytes)
+
+Instead of reading and decoding one frame at a time, the listeners read everything waiting on
+the port and hand it to these functions, which locate all frames with NumPy and decode their
+fields in one pass. Bytes that do not belong to a frame are returned so they can be logged as
+error messages, and an incomplete trailing frame is left in the buffer for the next read.
+"""
+
+import numpy as np
+
+START_BYTE = 0x01
+END_BYTE = 0x02
+DUE_FRAME_LENGTH = 11
+GIGA_FRAME_LENGTH = 7
+
+
+def find_frames(buffer, frame_length, start_byte=START_BYTE, end_byte=END_BYTE):
+    """
+    Locate consecutive fixed-length frames in a byte buffer.
+
+    Args:
+        buffer (bytes): Raw bytes read from the serial port
+        frame_length (int): Frame length including start and end bytes
+
+    Returns:
+        tuple: (frames, n_consumed, skipped)
+            frames (np.ndarray): uint8 array of shape (n_frames, frame_length)
+            n_consumed (int): Number of leading bytes fully handled (decoded or skipped)
+            skipped (list): Byte strings that were discarded while resynchronising
+    """
+    data = np.frombuffer(bytes(buffer), dtype=np.uint8)
+    n = len(data)
+    empty = np.empty((0, frame_length), dtype=np.uint8)
+    if n < frame_length:
+        return empty, 0, []
+
+    # A position can start a frame if it holds the start byte and the end byte sits frame_length-1 later
+    is_candidate = np.zeros(n, dtype=bool)
+    is_candidate[:n - frame_length + 1] = (data[:n - frame_length + 1] == start_byte) & \
+                                          (data[frame_length - 1:] == end_byte)
+    candidates = np.flatnonzero(is_candidate)
+
+    starts = []
+    skipped = []
+    position = 0
+    while True:
+        j = np.searchsorted(candidates, position)
+        if j == len(candidates):
+            break
+        first = candidates[j]
+        if first > position:
+            skipped.append(data[position:first].tobytes())
+
+        # Follow the run of back-to-back frames starting at `first`
+        run = is_candidate[first:n - frame_length + 1:frame_length]
+        broken = np.flatnonzero(~run)
+        run_length = broken[0] if len(broken) else len(run)
+        starts.append(np.arange(first, first + run_length * frame_length, frame_length))
+        position = first + run_length * frame_length
+        if not len(broken):
+            break
+
+    # Keep a possible partial frame at the end of the buffer for the next read
+    tail_start = max(position, n - frame_length + 1)
+    if tail_start > position:
+        skipped.append(data[position:tail_start].tobytes())
+    n_consumed = tail_start
+
+    if not starts:
+        return empty, n_consumed, skipped
+    starts = np.concatenate(starts)
+    frames = data[starts[:, None] + np.arange(frame_length)]
+    return frames, n_consumed, skipped
+
+
+def decode_due_frames(buffer):
+    """
+    Decode all complete Arduino Due frames in `buffer`.
+
+    Returns:
+        tuple: (message_ids uint32, states uint64, n_consumed, skipped)
+    """
+    frames, n_consumed, skipped = find_frames(buffer, DUE_FRAME_LENGTH)
+    payload = frames[:, 1:-1].astype(np.uint64)
+    message_ids = ((payload[:, 0] << 24) | (payload[:, 2] << 16) |
+                   (payload[:, 4] << 8) | payload[:, 6]).astype(np.uint32)
+    states = ((payload[:, 1] << 32) | (payload[:, 3] << 24) | (payload[:, 5] << 16) |
+              (payload[:, 7] << 8) | payload[:, 8])
+    return message_ids, states, n_consumed, skipped
+
+
+def decode_giga_frames(buffer):
+    """
+    Decode all complete Arduino Giga frames in `buffer`.
+
+    Returns:
+        tuple: (message_ids uint32, states uint8, n_consumed, skipped)
+    """
+    frames, n_consumed, skipped = find_frames(buffer, GIGA_FRAME_LENGTH)
+    payload = frames[:, 1:-1].astype(np.uint32)
+    message_ids = (payload[:, 0] << 24) | (payload[:, 1] << 16) | (payload[:, 2] << 8) | payload[:, 3]
+    states = frames[:, 5].copy()
+    return message_ids, states, n_consumed, skipped
@@ -0,0 +1,144 @@
+"""
+daq_message_store.py - Compact columnar in-memory store for Arduino DAQ messages
+
+Messages used to be kept as `deque`s of three-element Python lists, which costs well over
+150 bytes per message. `DAQMessageStore` keeps them in preallocated NumPy chunks instead
+(uint32 message id, uint64/uint8 state, float64 host time: 13-20 bytes per message) that the
+decoder fills a block at a time. Finalisation iterates over views of the filled chunks, so
+nothing has to be converted or copied again when the data is written out.
+"""
+
+import sys
+
+import numpy as np
+
+# Rough cost of one message as [id, state, time] in a deque, for the memory report
+LIST_BYTES_PER_MESSAGE = (sys.getsizeof([0, 0, 0.0]) + sys.getsizeof(2**31) + sys.getsizeof(2**33)
+                          + sys.getsizeof(0.0) + 8)
+
+
+class DAQMessageStore:
+    """
+    Chunked columnar storage for (message id, state, timestamp) triplets.
+    """
+
+    def __init__(self, state_dtype, chunk_size=1 << 18):
+        """
+        Args:
+            state_dtype (np.dtype): dtype of the state word (uint64 for the Due, uint8 for the Giga)
+            chunk_size (int): Number of messages per preallocated chunk
+        """
+        self.state_dtype = np.dtype(state_dtype)
+        self.chunk_size = int(chunk_size)
+        self.count = 0
+        self._chunks = []
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._chunks.append((
+            np.empty(self.chunk_size, dtype=np.uint32),
+            np.empty(self.chunk_size, dtype=self.state_dtype),
+            np.empty(self.chunk_size, dtype=np.float64),
+        ))
+        self._fill = 0
+
+    def extend(self, message_ids, states, timestamps):
+        """
+        Append a block of decoded messages.
+
+        Args:
+            message_ids (array): Message numbers
+            states (array): State words
+            timestamps (array or float): Host timestamps, or one timestamp for the whole block
+        """
+        n = len(message_ids)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), (n,))
+        offset = 0
+        while offset < n:
+            if self._fill == self.chunk_size:
+                self._new_chunk()
+            ids, sts, tms = self._chunks[-1]
+            take = min(n - offset, self.chunk_size - self._fill)
+            ids[self._fill:self._fill + take] = message_ids[offset:offset + take]
+            sts[self._fill:self._fill + take] = states[offset:offset + take]
+            tms[self._fill:self._fill + take] = timestamps[offset:offset + take]
+            self._fill += take
+            offset += take
+        self.count += n
+
+    def iter_chunks(self, start=0, stop=None):
+        """
+        Yield (message_ids, states, timestamps) views covering messages [start, stop).
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        first_chunk = start // self.chunk_size
+        for chunk_index in range(first_chunk, len(self._chunks)):
+            chunk_start = chunk_index * self.chunk_size
+            if chunk_start >= stop:
+                break
+            lo = max(start - chunk_start, 0)
+            hi = min(stop - chunk_start, self.chunk_size)
+            ids, sts, tms = self._chunks[chunk_index]
+            yield ids[lo:hi], sts[lo:hi], tms[lo:hi]
+
+    def column(self, index):
+        """
+        Return one column (0 = message ids, 1 = states, 2 = timestamps) as a single array.
+        This is a view when all messages fit in the first chunk and a copy otherwise.
+        """
+        parts = [chunk[index] for chunk in self.iter_chunks()]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.empty(0, dtype=self._chunks[0][index].dtype)
+        return np.concatenate(parts)
+
+    def rows(self, start=0, stop=None):
+        """
+        Return messages [start, stop) as a list of [id, state, time] rows (for CSV backups).
+        """
+        rows = []
+        for ids, sts, tms in self.iter_chunks(start, stop):
+            rows.extend(zip(ids.tolist(), sts.tolist(), tms.tolist()))
+        return rows
+
+    @property
+    def nbytes(self):
+        """Bytes currently allocated by the store."""
+        return sum(ids.nbytes + sts.nbytes + tms.nbytes for ids, sts, tms in self._chunks)
+
+    def memory_report(self, n_copies=1):
+        """
+        Summary of the store's memory use next to the equivalent list-of-lists cost.
+
+        Args:
+            n_copies (int): Number of list buffers the old implementation kept per message
+        """
+        list_bytes = self.count * LIST_BYTES_PER_MESSAGE * n_copies
+        return (f"Message store: {self.count} messages in {len(self._chunks)} chunks, "
+                f"{self.nbytes / 1e6:.1f} MB allocated "
+                f"(~{list_bytes / 1e6:.1f} MB as Python lists)")
+
+
+def channel_bits(states, bit_positions):
+    """
+    Expand state words into a (n_messages, n_channels) uint8 matrix of channel levels.
+
+    Args:
+        states (array): State words
+        bit_positions (sequence): Bit index of each channel within the state word
+    """
+    shifts = np.asarray(bit_positions, dtype=np.uint64)
+    return ((states.astype(np.uint64)[:, None] >> shifts) & np.uint64(1)).astype(np.uint8)
+
+
+def append_to_dataset(dataset, data):
+    """
+    Append `data` to a resizable 1D (or row-wise 2D) HDF5 dataset.
+    """
+    n = len(data)
+    if n == 0:
+        return
+    old_size = dataset.shape[0]
+    dataset.resize(old_size + n, axis=0)
+    dataset[old_size:old_size + n] = data
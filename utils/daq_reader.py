@@ -0,0 +1,104 @@
+"""
+daq_reader.py - Session-scoped access to an Arduino DAQ HDF5 file
+
+Post-processing asks the DAQ file for several channels in a row (head sensor, body sensor and
+camera sync pulses, laser events, then the NWB conversion). `DAQReader` opens the file once,
+loads the per-message timestamps at most once (clock-model corrected when available) and
+decodes each channel or edge table only when it is first requested, caching the result for
+later calls.
+"""
+
+import h5py
+import numpy as np
+
+from daq_edges import read_edges
+from daq_clock import read_daq_timestamps
+
+
+class DAQReader:
+    """
+    Lazily cached reader for one ArduinoDAQ HDF5 file.
+    """
+
+    def __init__(self, daq_h5_path, use_corrected=True):
+        """
+        Args:
+            daq_h5_path (Path): Path to the ArduinoDAQ HDF5 file
+            use_corrected (bool): Use clock-model corrected times when the model passed its checks
+        """
+        self.path = daq_h5_path
+        self.use_corrected = use_corrected
+        self.h5f = h5py.File(daq_h5_path, 'r')
+        self._timestamps = None
+        self._channels = {}
+        self._edges = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        """Close the underlying HDF5 file. Cached arrays stay available."""
+        if self.h5f is not None:
+            self.h5f.close()
+            self.h5f = None
+
+    @property
+    def timestamps(self):
+        """Per-message timestamps, loaded on first access."""
+        if self._timestamps is None:
+            self._timestamps = read_daq_timestamps(self.h5f, self.use_corrected)
+        return self._timestamps
+
+    @property
+    def channel_names(self):
+        """Names of the channels stored in the file."""
+        return list(self.h5f['channel_data'].keys())
+
+    def has_channel(self, channel_name):
+        """True if the file holds samples or an edge table for `channel_name`."""
+        if channel_name in self._channels or channel_name in self._edges:
+            return True
+        return channel_name in self.h5f['channel_data']
+
+    def channel(self, channel_name):
+        """
+        Per-message levels of one channel, decoded on first access.
+
+        Args:
+            channel_name (str): Channel name
+
+        Returns:
+            np.ndarray: uint8 array with one value per DAQ message
+        """
+        if channel_name not in self._channels:
+            self._channels[channel_name] = np.array(self.h5f['channel_data'][channel_name])
+        return self._channels[channel_name]
+
+    def edges(self, channel_name):
+        """
+        Rising and falling edge times of one channel. Uses the edge table written by the
+        listener when present and otherwise scans the channel samples.
+
+        Args:
+            channel_name (str): Channel name
+
+        Returns:
+            tuple: (rising_times, falling_times) arrays
+        """
+        if channel_name not in self._edges:
+            edges = read_edges(self.h5f, channel_name, self.use_corrected)
+            if edges is None:
+                channel_data = self.channel(channel_name)
+                # The edge occurs at index+1
+                rising_indices = np.where((channel_data[:-1] == 0) & (channel_data[1:] == 1))[0] + 1
+                falling_indices = np.where((channel_data[:-1] == 1) & (channel_data[1:] == 0))[0] + 1
+                edges = (self.timestamps[rising_indices], self.timestamps[falling_indices])
+            self._edges[channel_name] = edges
+        return self._edges[channel_name]
+
+    def rising_edges(self, channel_name):
+        """Times of the rising edges (pulse onsets) of one channel."""
+        return self.edges(channel_name)[0]
@@ -0,0 +1,154 @@
+"""
+daq_stream_writer.py - Incremental HDF5 writing for the Arduino DAQ listeners
+
+The listeners used to build every dataset only after the stop signal, so the experiment sat in
+`arduino_DAQ_process.wait()` while millions of messages were converted and compressed.
+`DAQStreamWriter` creates the HDF5 file when recording starts and appends new messages from the
+`DAQMessageStore` to chunked, resizable datasets on a background thread while recording.
+At the end, `finalize` only has to flush the messages since the last append and write the
+statistics attributes, clock model, edge tables and error messages.
+
+The file carries a `complete` attribute that is only set to True by `finalize`, so a file left
+behind by a crashed listener can be recognised (its datasets still hold everything streamed so far).
+"""
+
+import threading
+import time
+from queue import Queue
+
+import h5py
+import numpy as np
+
+from .daq_clock import save_clock_model
+from .daq_message_store import channel_bits, append_to_dataset
+
+
+class DAQStreamWriter:
+    """
+    Streams DAQ messages into `message_ids`, `timestamps` and `channel_data/<channel>` datasets.
+    """
+
+    def __init__(self, output_file, channel_names, bit_positions, flush_interval=5.0,
+                 flush_messages=1 << 16, compression='gzip'):
+        """
+        Args:
+            output_file (Path): HDF5 file to create
+            channel_names (sequence): Channel names, in dataset order
+            bit_positions (sequence): Bit index of each channel within the state word
+            flush_interval (float): Seconds between appends while recording
+            flush_messages (int): Append early once this many new messages are waiting
+            compression (str): HDF5 compression filter for the streamed datasets
+        """
+        self.output_file = output_file
+        self.channel_names = list(channel_names)
+        self.bit_positions = list(bit_positions)
+        self.flush_interval = flush_interval
+        self.flush_messages = flush_messages
+        self.queued_messages = 0
+        self.last_flush_time = time.perf_counter()
+        self.error = None
+
+        self.h5f = h5py.File(output_file, 'w')
+        self.h5f.attrs['complete'] = False
+        chunk_rows = min(flush_messages, 1 << 16)
+        self.h5f.create_dataset('message_ids', shape=(0,), maxshape=(None,), dtype=np.uint32,
+                                chunks=(chunk_rows,), compression=compression)
+        self.h5f.create_dataset('timestamps', shape=(0,), maxshape=(None,), dtype=np.float64,
+                                chunks=(chunk_rows,), compression=compression)
+        channel_group = self.h5f.create_group('channel_data')
+        for channel in self.channel_names:
+            channel_group.create_dataset(channel, shape=(0,), maxshape=(None,), dtype=np.uint8,
+                                         chunks=(chunk_rows,), compression=compression)
+
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        channel_group = self.h5f['channel_data']
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:  # Exit signal
+                    break
+                if self.error is not None:
+                    continue
+                message_ids, states, timestamps = block
+                append_to_dataset(self.h5f['message_ids'], message_ids)
+                append_to_dataset(self.h5f['timestamps'], timestamps)
+                bits = channel_bits(states, self.bit_positions)
+                for idx, channel in enumerate(self.channel_names):
+                    append_to_dataset(channel_group[channel], bits[:, idx])
+            except Exception as e:
+                # Keep draining the queue; finalize reports the error
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _queue_new_messages(self, message_store):
+        # Store chunks are never overwritten, so views can be handed to the writer thread directly
+        for block in message_store.iter_chunks(self.queued_messages, message_store.count):
+            self.queue.put(block)
+        self.queued_messages = message_store.count
+        self.last_flush_time = time.perf_counter()
+
+    def stream(self, message_store):
+        """
+        Queue messages added to `message_store` since the last call, if enough time has passed
+        or enough messages are waiting. Call this from the listener loop.
+        """
+        waiting = message_store.count - self.queued_messages
+        if waiting == 0:
+            return
+        if (waiting >= self.flush_messages or
+                time.perf_counter() - self.last_flush_time >= self.flush_interval):
+            self._queue_new_messages(message_store)
+
+    def finalize(self, message_store, attrs, clock_model=None, edge_detector=None, error_messages=None,
+                 read_blocks=None):
+        """
+        Flush the remaining messages, write the summary data and close the file.
+
+        Args:
+            message_store (DAQMessageStore): Store the listener recorded into
+            attrs (dict): File attributes (metadata and statistics)
+            clock_model (dict, optional): Result of `fit_clock_model`
+            edge_detector (EdgeDetector, optional): Edge tables collected while recording
+            error_messages (list, optional): Error messages logged by the listener
+            read_blocks (ReadBlockLog, optional): First message and host time of each serial read
+
+        Returns:
+            float: Seconds spent waiting for the writer thread and writing the summary
+        """
+        t0 = time.perf_counter()
+        self._queue_new_messages(message_store)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            self.h5f.close()
+            raise RuntimeError(f"Streaming DAQ data to {self.output_file} failed: {self.error}")
+
+        for key, value in attrs.items():
+            self.h5f.attrs[key] = value
+
+        corrected_timestamps = None
+        if clock_model is not None:
+            # Written uncompressed: the smoothed times barely compress and this is on the shutdown path
+            save_clock_model(self.h5f, clock_model, compression=None)
+            corrected_timestamps = clock_model["timestamps_corrected"]
+
+        if edge_detector is not None:
+            edge_detector.save_to_hdf5(self.h5f, corrected_timestamps)
+
+        if read_blocks is not None:
+            read_blocks.save_to_hdf5(self.h5f, compression=None)
+
+        if error_messages:
+            error_messages_str = [str(err_msg) for err_msg in error_messages]
+            error_messages_np = np.array(error_messages_str, dtype=object)
+            self.h5f.create_dataset('error_messages', data=error_messages_np,
+                                    compression='gzip', dtype=h5py.string_dtype())
+
+        self.h5f.attrs['complete'] = True
+        self.h5f.close()
+        return time.perf_counter() - t0
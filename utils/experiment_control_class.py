@@ -9,6 +9,7 @@ from colorama import init, Fore, Style
 import sys
 
 from utils import countdown_timer, check_for_signal_file, delete_signal_files, create_end_signal
+from utils.live_data_bus import LiveBusReader, bus_name
 
 init()
 
@@ -26,6 +27,7 @@ class ExperimentControl:
         self.baud_rate = 57600
         self.timeout = 2
         self.stim_board = None
+        self.live_data_bus = False
         self.load_config()
         
         # Default camera settings
@@ -100,16 +102,31 @@ class ExperimentControl:
         brain_laser_power = input("Enter laser power (at brain) (mW): ")
         return set_laser_power, brain_laser_power
 
+    def get_live_bus_reader(self, source):
+        """
+        Attach to the live data bus published by one of the acquisition processes.
+
+        Args:
+            source (str): "head", "body" or "daq"
+
+        Returns:
+            LiveBusReader: Reader for the latest samples of that process
+        """
+        return LiveBusReader(bus_name(self.foldername, source))
+
     def start_arduino_daq(self):
         """Start Arduino DAQ process, passing channel_list as a comma-separated string."""
-        self.arduino_DAQ_process = subprocess.Popen([
+        daq_command = [
             self.python_exe, self.arduino_daq_path,
             '--id', self.mouse_id,
             '--date', self.date_time,
             '--path', self.output_path,
             '--port', self.arduino_daq_port,
             '--channels', ",".join(self.channel_list)
-        ])
+        ]
+        if self.live_data_bus:
+            daq_command.append('--live_bus')
+        self.arduino_DAQ_process = subprocess.Popen(daq_command)
 
         # Name of the signal file that the DAQ script will create
         daq_signal_file = os.path.join(self.output_path, "daq_started.signal")
@@ -138,7 +155,7 @@ class ExperimentControl:
                          signal_name, 
                          rotation_angle, 
                          sensor_location="head"):
-        imu_process = subprocess.Popen([
+        imu_command = [
             self.python_exe, self.head_sensor_script,
             '--id', self.mouse_id,
             '--date', self.date_time,
@@ -146,7 +163,10 @@ class ExperimentControl:
             '--port', port,
             '--rotation', str(rotation_angle),
             '--sensor_location', sensor_location,
-        ])
+        ]
+        if self.live_data_bus:
+            imu_command.append('--live_bus')
+        imu_process = subprocess.Popen(imu_command)
         print(Fore.MAGENTA + "Experiment control:" + Style.RESET_ALL + "Head sensor script started.")
         return imu_process
 
@@ -267,7 +287,8 @@ class ExperimentControl:
         run_body_sensor=False,
         run_camera=True,
         run_arduino_daq=True,
-        run_stim_board=True
+        run_stim_board=True,
+        live_data_bus=False
     ):
         """Main method to run the experiment, requiring exactly 8 channel names."""
 
@@ -286,6 +307,7 @@ class ExperimentControl:
         self.run_camera = run_camera
         self.run_arduino_daq = run_arduino_daq
         self.run_stim_board = run_stim_board
+        self.live_data_bus = live_data_bus
 
         if stim_times_ms is None:
             stim_times_ms = [50, 100, 250, 500, 1000, 2000]
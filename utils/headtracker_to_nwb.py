@@ -5,8 +5,11 @@ This script provides functions to convert head sensor data, camera data, and las
 Neurodata Without Borders (NWB) format, making it compatible with neuroscience data analysis tools.
 
 Important: This converter specifically uses the synchronized timestamps from the post-processing
-pipeline rather than raw pulse data. It relies on the "*_synced_data.json" file generated 
-by the Analysis_manager_openfield class.
+pipeline rather than raw pulse data. It relies on the "*_synced_data.h5" store (or a legacy
+"*_synced_data.json" file) generated by the Analysis_manager_openfield class.
+
+Large datasets are wrapped in H5DataIO so they are written chunked, shuffled and compressed,
+and the video frame timestamps are streamed into the file through a DataChunkIterator.
 """
 
 from pynwb import NWBHDF5IO, NWBFile, TimeSeries
@@ -14,6 +17,8 @@ from pynwb.behavior import SpatialSeries
 from pynwb.file import Subject
 from pynwb.image import ImageSeries
 from hdmf.utils import docval, get_docval, popargs
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.data_utils import DataChunkIterator
 
 from datetime import datetime
 from dateutil import tz
@@ -23,6 +28,11 @@ from pathlib import Path
 import json
 import h5py
 import os
+import time
+
+from daq_reader import DAQReader
+from synced_data_store import load_synced_data
+from stim_trials import extract_stim_trials, print_trial_summary
 
 def detect_rising_edges(signal, timestamps, threshold=0.5):
     """
@@ -106,6 +116,53 @@ def extract_pulse_durations(signal, timestamps, threshold=0.5, min_duration_ms=0
     
     return start_times, durations
 
+def pulse_durations_from_edges(rising_times, falling_times, min_duration_ms=0.01):
+    """
+    Extract start times and durations of pulses from precomputed edge times.
+    Equivalent to `extract_pulse_durations` but works on the DAQ edge table.
+    
+    Args:
+        rising_times (array): Times of rising edges
+        falling_times (array): Times of falling edges
+        min_duration_ms (float): Minimum pulse duration in milliseconds (default 0.01ms)
+        
+    Returns:
+        tuple: (start_times, durations) - arrays of pulse start times and durations in seconds
+    """
+    rising_times = np.asarray(rising_times)
+    falling_times = np.asarray(falling_times)
+
+    # If signal starts high, discard first falling edge
+    if len(falling_times) > 0 and (len(rising_times) == 0 or falling_times[0] < rising_times[0]):
+        falling_times = falling_times[1:]
+
+    # If signal ends high, discard last rising edge
+    if len(rising_times) > len(falling_times):
+        rising_times = rising_times[:len(falling_times)]
+
+    start_times = rising_times
+    durations = falling_times[:len(rising_times)] - start_times
+
+    if min_duration_ms > 0:
+        valid_mask = durations >= (min_duration_ms / 1000.0)
+        start_times = start_times[valid_mask]
+        durations = durations[valid_mask]
+
+    return start_times, durations
+
+def synced_timestamps_array(stream_data):
+    """
+    Synced timestamps of one stream from the synced data as a float64 array,
+    with NaN where no pulse matched (stored as null in the JSON).
+    
+    Args:
+        stream_data (dict): One stream entry of the synced data (e.g. synced_data['head_sensor'])
+        
+    Returns:
+        np.ndarray: Synced timestamps
+    """
+    return np.array(stream_data.get('synced_timestamps', []), dtype=np.float64)
+
 def timeseries_to_intervals(timestamps, signal, HIGH=1, filter_short=False, min_duration_ms=50):
     """
     Convert timestamps and on/off signal to NWB intervals.
@@ -175,6 +232,97 @@ def timeseries_to_intervals(timestamps, signal, HIGH=1, filter_short=False, min_
     
     return intervals, interval_timestamps
 
+# Defaults for how the converter writes large datasets
+DEFAULT_COMPRESSION = "gzip"
+DEFAULT_COMPRESSION_OPTS = 4
+MIN_COMPRESSED_LENGTH = 1000  # Shorter arrays are written contiguous and uncompressed
+ITERATOR_BUFFER_SIZE = 100000  # Elements per DataChunkIterator buffer
+
+def wrap_dataset(data, compression=DEFAULT_COMPRESSION, compression_opts=DEFAULT_COMPRESSION_OPTS,
+                 iterate=False, buffer_size=ITERATOR_BUFFER_SIZE):
+    """
+    Wrap an array for writing chunked, shuffled and compressed (and optionally streamed).
+    
+    Args:
+        data (array): Data to write
+        compression (str): HDF5 compression filter, or None to write the array as is
+        compression_opts (int): Compression level
+        iterate (bool): Stream the array into the file through a DataChunkIterator
+        buffer_size (int): Elements per iterator buffer
+        
+    Returns:
+        H5DataIO or array: Wrapped data, or `data` unchanged if it is too short to benefit
+    """
+    if compression is None or len(data) < MIN_COMPRESSED_LENGTH:
+        return data
+    if iterate:
+        data = DataChunkIterator(data=data, buffer_size=buffer_size)
+        return H5DataIO(data=data, compression=compression, compression_opts=compression_opts,
+                        shuffle=True)
+    return H5DataIO(data=data, compression=compression, compression_opts=compression_opts,
+                    shuffle=True, chunks=True)
+
+ORIENTATION_DESCRIPTIONS = {
+    'yaw': 'Yaw (horizontal rotation, left/right movement) of the {part} in degrees',
+    'pitch': 'Pitch (vertical rotation, up/down movement) of the {part} in degrees',
+    'roll': 'Roll (rotation around long axis, tilting) of the {part} in degrees',
+}
+
+def _add_orientation_module(nwbfile, stream_data, sensor_h5_file, part, write_options=None):
+    """
+    Add the synced yaw/pitch/roll of one orientation sensor as a processing module.
+    
+    Args:
+        nwbfile (NWBFile): File to add the module to
+        stream_data (dict): Synced data of the sensor (e.g. synced_data['head_sensor'])
+        sensor_h5_file (Path or str): Raw sensor HDF5, only read if the synced data lacks the orientation arrays
+        part (str): 'head' or 'body'
+        write_options (dict, optional): Keyword arguments for `wrap_dataset`
+    """
+    write_options = write_options or {}
+    if not stream_data:
+        print(f"Warning: No {part} sensor data found in synced data")
+        return
+
+    # Orientation arrays are part of the synced data; older files may only have them in the raw sensor file
+    if all(f'{axis}_data' in stream_data for axis in ORIENTATION_DESCRIPTIONS):
+        orientation = {axis: np.asarray(stream_data[f'{axis}_data']) for axis in ORIENTATION_DESCRIPTIONS}
+        message_ids = np.asarray(stream_data.get('message_ids', orientation['yaw']))
+    else:
+        with h5py.File(sensor_h5_file, 'r') as h5f:
+            message_ids = np.array(h5f['message_ids'])
+            orientation = {axis: np.array(h5f[f'{axis}_data']) for axis in ORIENTATION_DESCRIPTIONS}
+
+    # Keep only messages with a matching pulse
+    synced_timestamps = synced_timestamps_array(stream_data)
+    valid = ~np.isnan(synced_timestamps)
+    if not valid.any():
+        print(f"Warning: No valid synchronized timestamps found for {part} sensor data")
+        return
+    synced_timestamps = synced_timestamps[valid]
+
+    print(f"Syncing {len(message_ids)} {part} sensor messages with {len(synced_timestamps)} pulses...")
+
+    # Create a behavioral module for the orientation data
+    behavior_module = nwbfile.create_processing_module(
+        name=f'{part}_sensor_data',
+        description=f'{part.capitalize()} orientation tracking data'
+    )
+    # The timestamps are written once, with the first series; the others link to them
+    timestamps = wrap_dataset(synced_timestamps, **write_options)
+    for axis, description in ORIENTATION_DESCRIPTIONS.items():
+        series = SpatialSeries(
+            name=axis,
+            description=description.format(part=part),
+            data=wrap_dataset(orientation[axis][valid], **write_options),
+            timestamps=timestamps,
+            reference_frame='Initial head position at recording start',
+            unit='degrees',
+            conversion=1.0
+        )
+        behavior_module.add_data_interface(series)
+        timestamps = series
+
 def headtracker_to_nwb(
     session_dict,
     session_metadata=None,
@@ -183,6 +331,11 @@ def headtracker_to_nwb(
     lab="",
     subject_species="Mouse",
     session_description="Head tracking experiment with laser pulses",
+    daq=None,
+    synced_data=None,
+    compression=DEFAULT_COMPRESSION,
+    compression_opts=DEFAULT_COMPRESSION_OPTS,
+    stream_video_timestamps=True,
 ):
     """
     Convert head sensor data and Arduino DAQ data to NWB format,
@@ -198,6 +351,13 @@ def headtracker_to_nwb(
         subject_species (str): Species of the subject
         session_description (str): Description of the session
         video_filename (str, optional): Name of video file if available
+        daq (DAQReader, optional): Open reader for the session's DAQ file, so channels already
+            loaded during syncing are reused. Opened here if not given.
+        synced_data (dict, optional): Synced data already in memory (as produced by
+            Analysis_manager_openfield). Loaded from the synced data file if not given.
+        compression (str, optional): HDF5 compression for large datasets (None writes them uncompressed)
+        compression_opts (int): Compression level
+        stream_video_timestamps (bool): Write the video frame timestamps through a DataChunkIterator
         
     Returns:
         Path: Path to the created NWB file
@@ -216,7 +376,13 @@ def headtracker_to_nwb(
     body_sensor = session_dict.get("body_sensor", False)
     
     # Look for required files
-    synced_data_file = session_dict.get("synced_data_json", None)
+    # Synced data store (.h5), or a legacy synced data JSON from older processing runs
+    synced_data_file = session_dict.get("synced_data_file", None) or session_dict.get("synced_data_json", None)
+    if not synced_data_file:
+        # Sessions listed by Cohort_folder carry it under processed_data
+        synced_data_file = session_dict.get("processed_data", {}).get("synced_data_file", None)
+        if synced_data_file == "None":
+            synced_data_file = None
     head_sensor_h5_file = session_dict.get("raw_data", {}).get("head_sensor_h5", None)
     body_sensor_h5_file = session_dict.get("raw_data", {}).get("body_sensor_h5", None)
     arduino_daq_h5_file = session_dict.get("raw_data", {}).get("arduino_daq_h5", None)
@@ -224,7 +390,7 @@ def headtracker_to_nwb(
     session_video = session_dict.get("raw_data", {}).get("video", None)
     
     # Check if we have all necessary files
-    if not synced_data_file:
+    if synced_data is None and not synced_data_file:
         raise FileNotFoundError(f"No synced data file found in {session_directory}")
     
     if not head_sensor_h5_file:
@@ -237,8 +403,8 @@ def headtracker_to_nwb(
         raise FileNotFoundError(f"Body sensor indicated but no body sensor HDF5 file found in {session_directory}")
     
     # Load synced data
-    with open(synced_data_file, 'r') as f:
-        synced_data = json.load(f)
+    if synced_data is None:
+        synced_data = load_synced_data(synced_data_file)
 
     # Load session metadata
     with open(session_metadata_path, 'r') as f:
@@ -291,172 +457,47 @@ def headtracker_to_nwb(
     )
     
     # --------------------------------------------------------------------------
-    # Load head sensor data and add with synced timestamps
+    # Add head sensor data with synced timestamps
     # --------------------------------------------------------------------------
-    # First, load raw head sensor data
-    with h5py.File(head_sensor_h5_file, 'r') as h5f:
-        message_ids = np.array(h5f['message_ids'])
-        yaw_data = np.array(h5f['yaw_data'])
-        roll_data = np.array(h5f['roll_data'])
-        pitch_data = np.array(h5f['pitch_data'])
-    
-    # Extract synchronized head sensor data from synced_data
-    if 'head_sensor' in synced_data and synced_data['head_sensor']:
-        head_synced_timestamps = np.array(synced_data['head_sensor'].get('synced_timestamps', []))
-        
-        # Filter out None/null values from synced timestamps (keep only valid entries)
-        valid_indices = [i for i, val in enumerate(head_synced_timestamps) if val is not None]
-        if valid_indices:
-            # Create synchronized arrays
-            synced_yaw = np.array([yaw_data[i] for i in valid_indices])
-            synced_roll = np.array([roll_data[i] for i in valid_indices])
-            synced_pitch = np.array([pitch_data[i] for i in valid_indices])
-            synced_timestamps = np.array([head_synced_timestamps[i] for i in valid_indices])
-
-            print(f"Syncing {len(message_ids)} head sensor messages with {len(synced_timestamps)} pulses...")
-            
-            # Create a behavioral module for head tracking data
-            behavior_module = nwbfile.create_processing_module(
-                name='head_sensor_data',
-                description='Head orientation tracking data'
-            )
-            
-            # Create and add yaw spatial series
-            yaw_series = SpatialSeries(
-                name='yaw',
-                description='Yaw (horizontal rotation, left/right movement) of the head in degrees',
-                data=synced_yaw,
-                timestamps=synced_timestamps,
-                reference_frame='Initial head position at recording start',
-                unit='degrees',
-                conversion=1.0
-            )
-            behavior_module.add_data_interface(yaw_series)
-            
-            # Create and add pitch spatial series
-            pitch_series = SpatialSeries(
-                name='pitch',
-                description='Pitch (vertical rotation, up/down movement) of the head in degrees',
-                data=synced_pitch,
-                timestamps=synced_timestamps,
-                reference_frame='Initial head position at recording start',
-                unit='degrees',
-                conversion=1.0
-            )
-            behavior_module.add_data_interface(pitch_series)
-            
-            # Create and add roll spatial series
-            roll_series = SpatialSeries(
-                name='roll',
-                description='Roll (rotation around long axis, tilting) of the head in degrees',
-                data=synced_roll,
-                timestamps=synced_timestamps,
-                reference_frame='Initial head position at recording start',
-                unit='degrees',
-                conversion=1.0
-            )
-            behavior_module.add_data_interface(roll_series)
-        else:
-            print("Warning: No valid synchronized timestamps found for head sensor data")
-    else:
-        print("Warning: No head sensor data found in synced_data.json")
-
+    write_options = {"compression": compression, "compression_opts": compression_opts}
+    _add_orientation_module(nwbfile, synced_data.get('head_sensor'), head_sensor_h5_file, 'head', write_options)
     print("Head sensor data added to NWB file")
+
     # --------------------------------------------------------------------------
-    # If present, load body sensor data and add with synced timestamps
+    # If present, add body sensor data with synced timestamps
     # --------------------------------------------------------------------------
-    # Load raw body sensor data
     if body_sensor and body_sensor_h5_file:
-        with h5py.File(body_sensor_h5_file, 'r') as h5f:
-            message_ids = np.array(h5f['message_ids'])
-            yaw_data = np.array(h5f['yaw_data'])
-            roll_data = np.array(h5f['roll_data'])
-            pitch_data = np.array(h5f['pitch_data'])
-        
-        # Extract synchronized head sensor data from synced_data
-        if 'body_sensor' in synced_data and synced_data['body_sensor']:
-            body_synced_timestamps = np.array(synced_data['body_sensor'].get('synced_timestamps', []))
-            
-            # Filter out None/null values from synced timestamps (keep only valid entries)
-            valid_indices = [i for i, val in enumerate(body_synced_timestamps) if val is not None]
-            if valid_indices:
-                # Create synchronized arrays
-                synced_yaw = np.array([yaw_data[i] for i in valid_indices])
-                synced_roll = np.array([roll_data[i] for i in valid_indices])
-                synced_pitch = np.array([pitch_data[i] for i in valid_indices])
-                synced_timestamps = np.array([body_synced_timestamps[i] for i in valid_indices])
-
-                print(f"Syncing {len(message_ids)} body sensor messages with {len(synced_timestamps)} pulses...")
-                
-                # Create a behavioral module for body tracking data
-                behavior_module = nwbfile.create_processing_module(
-                    name='body_sensor_data',
-                    description='Body orientation tracking data'
-                )
-                
-                # Create and add yaw spatial series
-                yaw_series = SpatialSeries(
-                    name='yaw',
-                    description='Yaw (horizontal rotation, left/right movement) of the body in degrees',
-                    data=synced_yaw,
-                    timestamps=synced_timestamps,
-                    reference_frame='Initial head position at recording start',
-                    unit='degrees',
-                    conversion=1.0
-                )
-                behavior_module.add_data_interface(yaw_series)
-                
-                # Create and add pitch spatial series
-                pitch_series = SpatialSeries(
-                    name='pitch',
-                    description='Pitch (vertical rotation, up/down movement) of the body in degrees',
-                    data=synced_pitch,
-                    timestamps=synced_timestamps,
-                    reference_frame='Initial head position at recording start',
-                    unit='degrees',
-                    conversion=1.0
-                )
-                behavior_module.add_data_interface(pitch_series)
-                
-                # Create and add roll spatial series
-                roll_series = SpatialSeries(
-                    name='roll',
-                    description='Roll (rotation around long axis, tilting) of the body in degrees',
-                    data=synced_roll,
-                    timestamps=synced_timestamps,
-                    reference_frame='Initial head position at recording start',
-                    unit='degrees',
-                    conversion=1.0
-                )
-                behavior_module.add_data_interface(roll_series)
-            else:
-                print("Warning: No valid synchronized timestamps found for body sensor data")
-        else:
-            print("Warning: No body sensor data found in synced_data.json")
+        _add_orientation_module(nwbfile, synced_data.get('body_sensor'), body_sensor_h5_file, 'body', write_options)
     
     # --------------------------------------------------------------------------
     # Process stimulation data from the Arduino DAQ channels
     # --------------------------------------------------------------------------
-    # Load the Arduino DAQ data to get channel information
-    with h5py.File(arduino_daq_h5_file, 'r') as h5f:
-        daq_timestamps = np.array(h5f['timestamps'])
-        
-        # Get list of available channels
-        available_channels = list(h5f['channel_data'].keys())
-        
-        # Get channel data (we'll use this for event extraction, not for direct timestamps)
-        channel_data = {}
-        for channel_name in available_channels:
-            channel_data[channel_name] = np.array(h5f['channel_data'][channel_name])
+    # Laser edges are part of the synced data; otherwise read only LASER_SYNC from the DAQ file,
+    # reusing the caller's DAQ reader if given
+    laser_data = synced_data.get('laser') or {}
+    if 'rising_times' in laser_data and 'falling_times' in laser_data:
+        has_laser_channel = True
+        laser_edges = (np.asarray(laser_data['rising_times'], dtype=np.float64),
+                       np.asarray(laser_data['falling_times'], dtype=np.float64))
+    else:
+        own_daq = daq is None
+        if own_daq:
+            daq = DAQReader(arduino_daq_h5_file)
+        try:
+            has_laser_channel = daq.has_channel('LASER_SYNC')
+            if has_laser_channel:
+                laser_edges = daq.edges('LASER_SYNC')
+        finally:
+            if own_daq:
+                daq.close()
     
     # --------------------------------------------------------------------------
     # Add LASER channel events with accurate durations
     # --------------------------------------------------------------------------
-    if 'LASER_SYNC' in channel_data:
-        # Extract pulse start times and durations using the improved method
-        laser_start_times, laser_durations = extract_pulse_durations(
-            channel_data['LASER_SYNC'], 
-            daq_timestamps,
+    if has_laser_channel:
+        # Extract pulse start times and durations from the edge times
+        laser_start_times, laser_durations = pulse_durations_from_edges(
+            *laser_edges,
             min_duration_ms=0.01  # Very low minimum to capture all pulses
         )
         
@@ -465,8 +506,8 @@ def headtracker_to_nwb(
             laser_ts = TimeSeries(
                 name='laser_stimulation',
                 description='Laser stimulation events with accurate pulse durations',
-                data=laser_durations,  # Now using actual durations instead of just 1s
-                timestamps=laser_start_times,
+                data=wrap_dataset(laser_durations, **write_options),  # Now using actual durations instead of just 1s
+                timestamps=wrap_dataset(laser_start_times, **write_options),
                 unit='seconds',
                 comments=(f"Laser power: {brain_laser_power_mW}mW, {len(laser_start_times)} events detected. "
                           f"Data values represent actual pulse durations in seconds.")
@@ -479,35 +520,27 @@ def headtracker_to_nwb(
             print("  Duration distribution (seconds):")
             for p, val in zip(percentiles, duration_percentiles):
                 print(f"    {p}th percentile: {val:.6f}s")
-            
-            # Try to identify typical pulse durations (clusters)
-            from scipy.cluster.vq import kmeans, vq
-            
-            # Use k-means to find the main duration clusters (if scipy is available)
-            try:
-                # Only use k-means if we have enough unique durations
-                unique_durations = np.unique(laser_durations)
-                if len(unique_durations) >= 2:
-                    # Estimate k (number of clusters) based on expected stim durations from metadata
-                    k = len(stim_times_ms) if stim_times_ms else min(5, len(unique_durations))
-                    k = max(2, min(k, len(unique_durations)))  # At least 2, at most unique values
-                    
-                    # Run k-means clustering on durations
-                    centroids, _ = kmeans(laser_durations.reshape(-1, 1), k)
-                    centroids = centroids.flatten()
-                    centroids.sort()
-                    
-                    # Assign each duration to a cluster
-                    idx, _ = vq(laser_durations.reshape(-1, 1), centroids.reshape(-1, 1))
-                    
-                    # Count pulses in each cluster
-                    print("  Identified pulse duration patterns:")
-                    for i, centroid in enumerate(centroids):
-                        count = np.sum(idx == i)
-                        print(f"    ~{centroid*1000:.2f}ms: {count} pulses ({count/len(laser_durations)*100:.1f}%)")
-            except (ImportError, Exception) as e:
-                # Skip clustering if scipy is not available or other error occurs
-                pass
+
+        # Stimulation trials: pulse trains grouped into epochs with their duration class and power,
+        # from the synced data if present (otherwise built from the laser edges here)
+        trials = synced_data.get('trials')
+        if not trials:
+            trials = extract_stim_trials(*laser_edges, metadata=session_metadata)
+        print_trial_summary(trials)
+        if len(trials['onset_times']) > 0:
+            nwbfile.add_trial_column(name='duration_class_ms', description='Nearest stimulus duration from stim_times_ms (ms)')
+            nwbfile.add_trial_column(name='power_mW', description='Laser power at the brain (mW)')
+            nwbfile.add_trial_column(name='set_power_mW', description='Laser power set on the laser (mW)')
+            nwbfile.add_trial_column(name='n_pulses', description='Number of laser pulses in the trial')
+            for i in range(len(trials['onset_times'])):
+                nwbfile.add_trial(
+                    start_time=float(trials['onset_times'][i]),
+                    stop_time=float(trials['offset_times'][i]),
+                    duration_class_ms=float(trials['duration_class_ms'][i]),
+                    power_mW=float(trials['power_mW'][i]),
+                    set_power_mW=float(trials['set_power_mW'][i]),
+                    n_pulses=int(trials['n_pulses'][i]),
+                )
     else:
         print("Warning: No LASER_SYNC channel found in Arduino DAQ data")
     
@@ -515,14 +548,14 @@ def headtracker_to_nwb(
     # Add video data if available
     # --------------------------------------------------------------------------
     if 'camera' in synced_data and synced_data['camera']:
-        camera_synced_timestamps = synced_data['camera'].get('synced_timestamps', [])
+        camera_synced_timestamps = synced_timestamps_array(synced_data['camera'])
         
-        # Find valid timestamps (not None/null)
-        valid_indices = [i for i, val in enumerate(camera_synced_timestamps) if val is not None]
+        # Find valid timestamps (frames with a matching pulse)
+        valid = ~np.isnan(camera_synced_timestamps)
         
-        if valid_indices and session_video:            
+        if valid.any() and session_video:            
             # Get valid timestamps
-            valid_timestamps = [camera_synced_timestamps[i] for i in valid_indices]
+            valid_timestamps = camera_synced_timestamps[valid]
             
             # Create ImageSeries for video
             video_series = ImageSeries(
@@ -531,7 +564,7 @@ def headtracker_to_nwb(
                 external_file=[f'./{session_video}'],
                 format='external',
                 starting_frame=[0],
-                timestamps=valid_timestamps,
+                timestamps=wrap_dataset(valid_timestamps, iterate=stream_video_timestamps, **write_options),
                 unit='n.a.'
             )
             nwbfile.add_acquisition(video_series)
@@ -541,8 +574,12 @@ def headtracker_to_nwb(
     output_path = session_directory / output_filename
     
     # Write the NWB file
+    write_start = time.perf_counter()
     with NWBHDF5IO(output_path, 'w') as io:
         io.write(nwbfile)
+    write_time = time.perf_counter() - write_start
     
     print(f"Created NWB file: {output_path}")
+    print(f"  {os.path.getsize(output_path) / 1e6:.1f} MB written in {write_time:.2f}s "
+          f"(compression: {compression}, level {compression_opts})")
     return output_path
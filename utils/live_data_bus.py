@@ -0,0 +1,272 @@
+"""
+live_data_bus.py - Shared-memory ring buffers for sharing live samples between processes
+
+Each acquisition process (head sensor, body sensor, Arduino DAQ) can publish its decoded
+samples into a named `multiprocessing.shared_memory` block. Any other process on the same
+machine (a live monitor, an online QC check or a closed-loop controller) can attach to the
+block by name and read the most recent samples without serialisation or file I/O.
+
+Block layout:
+    [0:8]    magic bytes
+    [8:16]   write index (uint64, total number of records ever written)
+    [16:24]  capacity (uint64, number of records the ring can hold)
+    [24:32]  record size in bytes (uint64)
+    [32:40]  epoch (float64, time.time() when the writer was created)
+    [40:48]  reserve index (uint64, write index after the block currently being written)
+    [48:52]  length of the dtype description (uint32)
+    [52:...] dtype description as JSON
+    [HEADER_SIZE:] ring of records
+
+The writer raises the reserve index before copying a block into the ring and the write index
+after, so a reader knows its copy is intact if the reserve index has not passed its first record
+plus the capacity by the time the copy is done.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+HEADER_SIZE = 512
+MAGIC = b"HSBUS002"
+_HEADER_STRUCT = struct.Struct("<8sQQQdQI")
+_WRITE_INDEX_OFFSET = 8
+_RESERVE_INDEX_OFFSET = 40
+
+# Record layouts published by the acquisition scripts
+IMU_SAMPLE_DTYPE = np.dtype([
+    ("message_id", "<u4"),
+    ("timestamp", "<f8"),
+    ("yaw", "<f8"),
+    ("roll", "<f8"),
+    ("pitch", "<f8"),
+])
+
+DAQ_DUE_SAMPLE_DTYPE = np.dtype([
+    ("message_id", "<u4"),
+    ("state", "<u8"),
+    ("timestamp", "<f8"),
+])
+
+DAQ_GIGA_SAMPLE_DTYPE = np.dtype([
+    ("message_id", "<u4"),
+    ("state", "<u1"),
+    ("timestamp", "<f8"),
+])
+
+
+def bus_name(session_name, source):
+    """
+    Build the shared memory name for a given session and data source.
+
+    Shared memory names are limited to ~30 characters on some platforms, so the
+    session folder name is hashed rather than used directly.
+
+    Args:
+        session_name (str): Session folder name (e.g. "250225_175234_mtaq14-1c")
+        source (str): Data source (e.g. "head", "body", "daq")
+
+    Returns:
+        str: Name of the shared memory block
+    """
+    digest = hashlib.sha1(str(session_name).encode("utf-8")).hexdigest()[:10]
+    return f"hsbus_{source}_{digest}"
+
+
+class LiveBusWriter:
+    """
+    Owner of a shared-memory ring buffer. Only one writer should exist per bus name.
+    """
+
+    def __init__(self, name, dtype, capacity=2**16):
+        """
+        Args:
+            name (str): Shared memory name (see `bus_name`)
+            dtype (np.dtype): Structured dtype of the published records
+            capacity (int): Number of records held in the ring before old ones are overwritten
+        """
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        size = HEADER_SIZE + self.capacity * self.dtype.itemsize
+
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a crashed run with the same session name
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        descr = json.dumps(np.lib.format.dtype_to_descr(self.dtype)).encode("utf-8")
+        if _HEADER_STRUCT.size + len(descr) > HEADER_SIZE:
+            raise ValueError("Record dtype description is too long for the bus header.")
+
+        self.epoch = time.time()
+        _HEADER_STRUCT.pack_into(self.shm.buf, 0, MAGIC, 0, self.capacity,
+                                 self.dtype.itemsize, self.epoch, 0, len(descr))
+        self.shm.buf[_HEADER_STRUCT.size:_HEADER_STRUCT.size + len(descr)] = descr
+
+        self._write_index = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf,
+                                       offset=_WRITE_INDEX_OFFSET)
+        self._reserve_index = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf,
+                                         offset=_RESERVE_INDEX_OFFSET)
+        self._ring = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.shm.buf,
+                                offset=HEADER_SIZE)
+        self._single = np.zeros(1, dtype=self.dtype)
+
+    def publish(self, records):
+        """
+        Write a block of records into the ring and advance the write index.
+
+        Args:
+            records (np.ndarray): Structured array with the bus dtype
+        """
+        records = np.atleast_1d(np.asarray(records, dtype=self.dtype))
+        n = len(records)
+        if n == 0:
+            return
+
+        write_index = int(self._write_index[0])
+        if n > self.capacity:
+            # Only the newest `capacity` records can survive anyway
+            write_index += n - self.capacity
+            records = records[-self.capacity:]
+            n = self.capacity
+
+        # Announce the block first: readers whose copy overlaps it will see it as overwritten
+        self._reserve_index[0] = write_index + n
+
+        start = write_index % self.capacity
+        first = min(n, self.capacity - start)
+        self._ring[start:start + first] = records[:first]
+        if first < n:
+            self._ring[:n - first] = records[first:]
+
+        # Advance the index only once the data is in place so readers never see partial records
+        self._write_index[0] = write_index + n
+
+    def publish_sample(self, *fields):
+        """
+        Write a single record given its field values in dtype order.
+        """
+        self._single[0] = fields
+        self.publish(self._single)
+
+    def close(self):
+        """
+        Release and remove the shared memory block.
+        """
+        self._write_index = None
+        self._reserve_index = None
+        self._ring = None
+        try:
+            self.shm.close()
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class LiveBusReader:
+    """
+    Read-only view of a ring buffer created by a `LiveBusWriter` in another process.
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name (str): Shared memory name (see `bus_name`)
+        """
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            # The resource tracker would otherwise unlink the writer's block when this process exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        magic, _, capacity, record_size, epoch, _, descr_len = _HEADER_STRUCT.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC:
+            self.shm.close()
+            raise ValueError(f"Shared memory block '{name}' is not a live data bus.")
+
+        descr = json.loads(bytes(self.shm.buf[_HEADER_STRUCT.size:_HEADER_STRUCT.size + descr_len]))
+        self.dtype = np.lib.format.descr_to_dtype([tuple(field) for field in descr])
+        if self.dtype.itemsize != record_size:
+            self.shm.close()
+            raise ValueError(f"Record size mismatch on live data bus '{name}'.")
+
+        self.capacity = int(capacity)
+        self.epoch = epoch
+        self._write_index = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf,
+                                       offset=_WRITE_INDEX_OFFSET)
+        self._reserve_index = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf,
+                                         offset=_RESERVE_INDEX_OFFSET)
+        self._ring = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.shm.buf,
+                                offset=HEADER_SIZE)
+
+    @property
+    def write_index(self):
+        """Total number of records written to the bus so far."""
+        return int(self._write_index[0])
+
+    def _copy_range(self, start, stop):
+        """Copy records [start, stop) (absolute indices) out of the ring."""
+        n = stop - start
+        out = np.empty(n, dtype=self.dtype)
+        ring_start = start % self.capacity
+        first = min(n, self.capacity - ring_start)
+        out[:first] = self._ring[ring_start:ring_start + first]
+        if first < n:
+            out[first:] = self._ring[:n - first]
+        return out
+
+    def read_since(self, index, max_retries=3):
+        """
+        Return every record written after absolute index `index`.
+
+        If the reader has fallen more than `capacity` records behind, the oldest
+        records are lost and only the newest `capacity` records are returned. If a copy
+        is overwritten while it is taken, the reader skips ahead to half a ring behind the
+        writer and retries; the skipped records are counted as dropped.
+
+        Args:
+            index (int): Absolute index returned by the previous call (0 for the start)
+            max_retries (int): Attempts before giving up on a copy that keeps being overwritten
+
+        Returns:
+            tuple: (records, new_index, n_dropped)
+        """
+        floor = index
+        for _ in range(max_retries):
+            stop = self.write_index
+            start = max(floor, stop - self.capacity)
+            records = self._copy_range(start, stop)
+            # Valid only if no block written (or being written) meanwhile reached our first record
+            if int(self._reserve_index[0]) - start <= self.capacity:
+                return records, stop, start - index
+            floor = max(index, self.write_index - self.capacity // 2)
+        # Give up on this call but move past the lost records so the next call can catch up
+        return np.empty(0, dtype=self.dtype), floor, floor - index
+
+    def latest(self, n=1):
+        """
+        Return a copy of the `n` most recent records (fewer if not yet written, or if the
+        oldest of them were being overwritten while copying).
+        """
+        stop = self.write_index
+        records, _, _ = self.read_since(max(0, stop - min(n, self.capacity)))
+        return records[-n:]
+
+    def close(self):
+        """
+        Detach from the shared memory block (the writer owns and removes it).
+        """
+        self._write_index = None
+        self._reserve_index = None
+        self._ring = None
+        self.shm.close()
@@ -6,17 +6,60 @@ from pathlib import Path
 import os
 
 # Import the NWB conversion utility
-from headtracker_to_nwb import headtracker_to_nwb
+from headtracker_to_nwb import headtracker_to_nwb, DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_OPTS
 from cohort_folder_openfield import Cohort_folder
+from daq_reader import DAQReader
+from synced_data_store import save_synced_data, load_synced_data, synced_data_paths
+from session_pool import run_sessions_in_pool, DEFAULT_WORKERS
+from stage_manifest import StageManifest, code_version, local_modules
+from stim_trials import pair_edges, extract_stim_trials, print_trial_summary
+from sync_alignment import align_ids_to_pulses
+from resampling import resample_sensor, sensor_samples, uniform_grid, DEFAULT_UNIFORM_RATE
+
+# Source files whose changes invalidate each stage's outputs: the modules implementing the stage
+# plus everything they import from utils/ (this manager's own imports are not followed, since it
+# also pulls in the pool, catalog and cohort scanning code)
+UTILS_DIR = Path(__file__).resolve().parent
+SYNC_STAGE_CODE = [Path(__file__).resolve()] + local_modules(*[UTILS_DIR / name for name in (
+    "daq_reader.py", "daq_edges.py", "daq_clock.py", "synced_data_store.py",
+    "stim_trials.py", "resampling.py", "sync_alignment.py")])
+NWB_STAGE_CODE = local_modules(UTILS_DIR / "headtracker_to_nwb.py")
+
+
+def map_ids_to_pulses(ids, pulse_times):
+    """
+    Look up the DAQ pulse time for each message / frame (id n was sent with pulse n, so pass
+    the pulse indices from sync_alignment.py to correct for a late DAQ start or a restart).
+    
+    Args:
+        ids (array): Message or frame ids, or their aligned pulse indices
+        pulse_times (array): Pulse times from the DAQ
+        
+    Returns:
+        tuple: (synced_timestamps, valid) - float64 array with NaN where the id has no pulse,
+               and the boolean mask of ids that do
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    pulse_times = np.asarray(pulse_times, dtype=np.float64)
+    valid = (ids >= 0) & (ids < len(pulse_times))
+    synced_timestamps = np.full(len(ids), np.nan)
+    synced_timestamps[valid] = pulse_times[ids[valid]]
+    return synced_timestamps, valid
+
 
 class Analysis_manager_openfield:
-    def __init__(self, session_dict, create_nwb=True):
+    def __init__(self, session_dict, create_nwb=True, force=False, uniform_rate=DEFAULT_UNIFORM_RATE):
         """
         Initialize the analysis manager and process data.
         
+        Stages whose inputs, code and parameters are unchanged since their last run (see
+        stage_manifest.py) are skipped and their outputs reused.
+        
         Args:
             session_dict (dict): Dictionary containing session information
             create_nwb (bool): Whether to create an NWB file after synchronization
+            force (bool): Rerun every stage regardless of the stage manifest
+            uniform_rate (float): Rate (Hz) of the uniform time grid the sensors are resampled onto
         """
         # Basic attributes
         self.session_id = session_dict.get("session_id")
@@ -32,42 +75,126 @@ class Analysis_manager_openfield:
         
         # Add path for tracker data JSON
         self.tracker_json = self.session_dir / f"{self.session_id}_Tracker_data.json"
+        # Session metadata (stimulation protocol), used for the trial table
+        metadata = raw_data.get("metadata")
+        self.metadata_json = Path(metadata) if metadata and metadata != "None" else None
+
+        # Outcome, for batch runs (see session_pool.py)
+        self.status = "failed"
+        self.error = None
+        self.synced_data_file = None
+        self.nwb_path = None
+        self.stages_run = []
+
+        self.force = force
+        self.uniform_rate = uniform_rate
+        self.manifest = StageManifest(self.session_dir, self.session_id)
 
         # Run the main sync functions
+        self.daq = None
         try:
-            # Sync head sensor, camera frame, and laser data
-            self.sync_data = self.sync_all_data()
-            session_dict = self.save_synced_data(self.sync_data, session_dict)
+            session_dict = self.run_sync_stage(session_dict)
             
             # Create NWB file if requested
             if create_nwb:
-                self.create_nwb_file(session_dict)
+                self.nwb_path = self.run_nwb_stage(session_dict)
+                self.status = "ok" if self.nwb_path else "nwb_failed"
+            else:
+                self.status = "ok"
                 
         except Exception as e:
             print(f"Error processing data for {self.session_dir}: {e}")
             traceback.print_exc()
+            self.error = str(e)
+        finally:
+            if self.daq is not None:
+                self.daq.close()
+
+    def stage_is_current(self, stage, inputs, params, code):
+        """
+        Check the stage manifest and report whether `stage` can be skipped.
+        """
+        if self.force:
+            print(f"Running {stage} stage (forced)")
+            return False
+        up_to_date, reason = self.manifest.check(stage, inputs, params, code)
+        print(f"{'Skipping' if up_to_date else 'Running'} {stage} stage ({reason})")
+        return up_to_date
+
+    def run_sync_stage(self, session_dict):
+        """
+        Sync and save the session data, or load the existing synced data store if its inputs
+        are unchanged.
+        """
+        synced_h5, _ = synced_data_paths(self.session_dir, self.session_id)
+        inputs = {
+            "arduino_daq_h5": self.arduino_daq_h5,
+            "head_sensor_h5": self.head_sensor_h5,
+            "body_sensor_h5": self.body_sensor_h5 if self.body_sensor else None,
+            "tracker_json": self.tracker_json,
+            "metadata": self.metadata_json,
+        }
+        params = {"body_sensor": bool(self.body_sensor), "uniform_rate": self.uniform_rate}
+        code = code_version(*SYNC_STAGE_CODE)
+
+        if self.stage_is_current("sync", inputs, params, code):
+            self.sync_data = load_synced_data(synced_h5)
+            self.synced_data_file = synced_h5
+            session_dict['synced_data_file'] = str(synced_h5)
+            return session_dict
+
+        # Open the DAQ file once; channels and timestamps are loaded on first use and cached
+        self.daq = DAQReader(self.arduino_daq_h5)
+
+        # Sync head sensor, camera frame, and laser data, then resample the sensors onto common times
+        self.sync_data = self.sync_all_data()
+        self.sync_data.update(self.resample_sensors(self.sync_data))
+        session_dict = self.save_synced_data(self.sync_data, session_dict)
+        if self.synced_data_file is not None:
+            self.manifest.record("sync", inputs, params, code, {"synced_data": synced_h5})
+            self.stages_run.append("sync")
+        return session_dict
+
+    def run_nwb_stage(self, session_dict):
+        """
+        Create the NWB file, unless the existing one was built from the current synced data,
+        metadata and converter code.
+        """
+        raw_data = session_dict.get("raw_data", {})
+        nwb_file = self.session_dir / f"{self.session_dir.name}_headtracker.nwb"
+        inputs = {
+            "synced_data": session_dict.get("synced_data_file"),
+            "metadata": raw_data.get("metadata"),
+            "video": raw_data.get("video"),
+        }
+        params = {"compression": DEFAULT_COMPRESSION, "compression_opts": DEFAULT_COMPRESSION_OPTS}
+        code = code_version(*NWB_STAGE_CODE)
+
+        if self.stage_is_current("nwb", inputs, params, code):
+            return nwb_file
+
+        nwb_path = self.create_nwb_file(session_dict)
+        if nwb_path:
+            self.manifest.record("nwb", inputs, params, code, {"nwb": nwb_path})
+            self.stages_run.append("nwb")
+        return nwb_path
 
     def get_sync_pulses(self, channel_name):
         """
         Helper function to get sync pulses for a given channel from ArduinoDAQ.
+        Uses the edge table written by the DAQ listener if available, otherwise
+        scans the full channel for transitions.
         
         Args:
             channel_name (str): Name of the channel in ArduinoDAQ file
             
         Returns:
-            tuple: (pulse_times, timestamps from DAQ)
+            np.ndarray: Pulse (rising edge) times
         """
-        with h5py.File(self.arduino_daq_h5, 'r') as daq_h5:
-            channel_data = np.array(daq_h5['channel_data'][channel_name])
-            daq_timestamps = np.array(daq_h5['timestamps'])
-
-        # Detect low-to-high transitions
-        pulse_indices = np.where((channel_data[:-1] == 0) & (channel_data[1:] == 1))[0]
-        # The pulse occurs at index+1
-        pulse_times = daq_timestamps[pulse_indices + 1]
+        pulse_times = self.daq.rising_edges(channel_name)
         
         print(f"Found {len(pulse_times)} pulses in ArduinoDAQ for {channel_name} channel.")
-        return pulse_times, daq_timestamps
+        return pulse_times
 
     def get_laser_events(self, channel_name='LASER_SYNC'):
         """
@@ -79,43 +206,32 @@ class Analysis_manager_openfield:
         Returns:
             dict: Dictionary containing laser event data
         """
-        with h5py.File(self.arduino_daq_h5, 'r') as daq_h5:
-            channel_data = np.array(daq_h5['channel_data'][channel_name])
-            daq_timestamps = np.array(daq_h5['timestamps'])
-
-        # Detect both rising and falling edges
-        rising_indices = np.where((channel_data[:-1] == 0) & (channel_data[1:] == 1))[0]
-        falling_indices = np.where((channel_data[:-1] == 1) & (channel_data[1:] == 0))[0]
+        rising_times, falling_times = self.daq.edges(channel_name)
         
-        # The edge occurs at index+1
-        rising_times = daq_timestamps[rising_indices + 1]
-        falling_times = daq_timestamps[falling_indices + 1]
-        
-        # Handle case where we have unequal number of rising and falling edges
-        min_len = min(len(rising_times), len(falling_times))
-        
-        # Calculate pulse durations (if we have matching rising and falling edges)
-        durations = []
-        if min_len > 0:
-            # If first falling edge comes before first rising edge, skip it
-            if len(falling_times) > 0 and len(rising_times) > 0 and falling_times[0] < rising_times[0]:
-                falling_times = falling_times[1:]
-                min_len = min(len(rising_times), len(falling_times))
-                
-            # Calculate durations for matching edges
-            if min_len > 0:
-                for i in range(min_len):
-                    duration = falling_times[i] - rising_times[i]
-                    durations.append(duration)
+        # Drop a leading falling edge and pair the rest with the rising edges
+        if len(falling_times) > 0 and len(rising_times) > 0 and falling_times[0] < rising_times[0]:
+            falling_times = falling_times[1:]
+        onsets, offsets = pair_edges(rising_times, falling_times)
+        durations = offsets - onsets
         
         print(f"Found {len(rising_times)} rising and {len(falling_times)} falling edges for {channel_name}")
         
         return {
-            "rising_times": rising_times.tolist(),
-            "falling_times": falling_times.tolist(),
+            "rising_times": rising_times,
+            "falling_times": falling_times,
             "durations": durations,
         }
 
+    def load_session_metadata(self):
+        """
+        Load the session metadata JSON (stimulation protocol), or an empty dict if missing.
+        """
+        if self.metadata_json is None or not self.metadata_json.exists():
+            print("No session metadata found; trials will not be classified")
+            return {}
+        with open(self.metadata_json, 'r') as f:
+            return json.load(f)
+
     def sync_sensor_data(self, sensor_data_file, pulse_times, sensor_location):
         """
         Sync sensor data with DAQ pulse times.
@@ -127,22 +243,35 @@ class Analysis_manager_openfield:
             pitch_data = np.array(sensor_h5['pitch_data'])
             sensor_ts = np.array(sensor_h5['timestamps'])
 
-        # Build pulse dictionary
-        pulse_dict = {i: pulse_time for i, pulse_time in enumerate(pulse_times)}
-
         # Print the number of head sensor messages being synced
         print(f"Syncing {len(message_ids)} {sensor_location} sensor messages with {len(pulse_times)} pulses...")
 
-        # Sync timestamps
-        synced_timestamps = [pulse_dict.get(msg_id, None) for msg_id in message_ids]
+        # Find the pulse of each message (robust to a late DAQ start or a sensor restart), then
+        # sync timestamps (NaN for messages without a matching pulse)
+        alignment = align_ids_to_pulses(message_ids, pulse_times, sensor_ts, name=f"{sensor_location} sensor")
+        synced_timestamps, synced_valid = map_ids_to_pulses(alignment["pulse_index"], pulse_times)
 
         return {
-            "message_ids": message_ids.tolist(),
-            "yaw_data": yaw_data.tolist(),
-            "roll_data": roll_data.tolist(),
-            "pitch_data": pitch_data.tolist(),
-            f"{sensor_location}_sensor_timestamps": sensor_ts.tolist(),
+            "message_ids": message_ids,
+            "yaw_data": yaw_data,
+            "roll_data": roll_data,
+            "pitch_data": pitch_data,
+            f"{sensor_location}_sensor_timestamps": sensor_ts,
             "synced_timestamps": synced_timestamps,
+            "synced_valid": synced_valid,
+            **self.alignment_fields(alignment),
+        }
+
+    @staticmethod
+    def alignment_fields(alignment):
+        """
+        Alignment results stored with a synced stream.
+        """
+        return {
+            "pulse_index": alignment["pulse_index"],
+            "alignment_offsets": alignment["offsets"],
+            "alignment_residual_std_ms": alignment["residual_std_ms"],
+            "alignment_poor": alignment["poor"],
         }
 
     def sync_camera_data(self, pulse_times):
@@ -158,18 +287,18 @@ class Analysis_manager_openfield:
             print(f"Error loading tracker data: {e}")
             return None
 
-        # Build pulse dictionary
-        pulse_dict = {i: pulse_time for i, pulse_time in enumerate(pulse_times)}
-
         # Print the number of camera frames being synced
         print(f"Syncing {len(frame_ids)} camera frames with {len(pulse_times)} pulses...")
 
-        # Sync timestamps
-        synced_timestamps = [pulse_dict.get(frame_id, None) for frame_id in frame_ids]
+        # Find the pulse of each frame, then sync timestamps (NaN for frames without a matching pulse)
+        alignment = align_ids_to_pulses(frame_ids, pulse_times, name="camera")
+        synced_timestamps, synced_valid = map_ids_to_pulses(alignment["pulse_index"], pulse_times)
 
         return {
-            "frame_ids": frame_ids.tolist(),
+            "frame_ids": frame_ids,
             "synced_timestamps": synced_timestamps,
+            "synced_valid": synced_valid,
+            **self.alignment_fields(alignment),
         }
 
     def sync_all_data(self):
@@ -177,15 +306,20 @@ class Analysis_manager_openfield:
         Sync head sensor, camera frame, and laser event data with their respective pulses.
         """
         # Get pulse times for head sensor and camera channels
-        head_sensor_pulses, _ = self.get_sync_pulses('HEADSENSOR_SYNC')
+        head_sensor_pulses = self.get_sync_pulses('HEADSENSOR_SYNC')
         if self.body_sensor:
-            body_sensor_pulses, _ = self.get_sync_pulses('BODYSENSOR_SYNC')
+            body_sensor_pulses = self.get_sync_pulses('BODYSENSOR_SYNC')
 
-        camera_pulses, _ = self.get_sync_pulses('CAMERA_SYNC')
+        camera_pulses = self.get_sync_pulses('CAMERA_SYNC')
         
         # Get laser events (rising and falling edges)
         laser_events = self.get_laser_events('LASER_SYNC')
 
+        # Group laser pulses into stimulation trials
+        trials = extract_stim_trials(laser_events["rising_times"], laser_events["falling_times"],
+                                     self.load_session_metadata())
+        print_trial_summary(trials)
+
         # Sync head sensor data
         head_sensor_data = self.sync_sensor_data(self.head_sensor_h5, head_sensor_pulses, sensor_location='head')
         if self.body_sensor:
@@ -199,49 +333,89 @@ class Analysis_manager_openfield:
             synced_data = {
                 "session_id": self.session_id,
                 "head_sensor": {
-                    "pulse_times": head_sensor_pulses.tolist(),
+                    "pulse_times": head_sensor_pulses,
                     **head_sensor_data
                 },
                 "body_sensor": {
-                    "pulse_times": body_sensor_pulses.tolist(),
+                    "pulse_times": body_sensor_pulses,
                     **body_sensor_data
                 },
                 "camera": {
-                    "pulse_times": camera_pulses.tolist(),
+                    "pulse_times": camera_pulses,
                     **camera_data
                 } if camera_data is not None else None,
-                "laser": laser_events
+                "laser": laser_events,
+                "trials": trials
             }
         else:
             synced_data = {
                 "session_id": self.session_id,
                 "head_sensor": {
-                    "pulse_times": head_sensor_pulses.tolist(),
+                    "pulse_times": head_sensor_pulses,
                     **head_sensor_data
                 },
                 "camera": {
-                    "pulse_times": camera_pulses.tolist(),
+                    "pulse_times": camera_pulses,
                     **camera_data
                 } if camera_data is not None else None,
-                "laser": laser_events
+                "laser": laser_events,
+                "trials": trials
             }
 
         return synced_data
 
+    def resample_sensors(self, synced_data):
+        """
+        Interpolate the sensors' yaw / roll / pitch onto the camera frame times and onto a
+        uniform time grid, so video overlays and cross-session comparisons can use them directly.
+        
+        Returns:
+            dict: {"camera_aligned": {...} or None, "uniform": {...} or None}
+        """
+        sensors = [("head", synced_data.get("head_sensor"))]
+        if self.body_sensor:
+            sensors.append(("body", synced_data.get("body_sensor")))
+        sensors = [(prefix, stream) for prefix, stream in sensors if stream is not None]
+        if not sensors:
+            return {"camera_aligned": None, "uniform": None}
+
+        # Camera frames: one entry per frame, NaN (invalid) for frames without a synced timestamp
+        camera_aligned = None
+        camera = synced_data.get("camera")
+        if camera is not None:
+            frame_times = np.asarray(camera["synced_timestamps"], dtype=np.float64)
+            camera_aligned = {"frame_ids": camera["frame_ids"], "timestamps": frame_times}
+            for prefix, stream in sensors:
+                camera_aligned.update(resample_sensor(stream, frame_times, prefix))
+            print(f"Resampled {len(sensors)} sensor(s) onto {len(frame_times)} camera frames "
+                  f"({np.count_nonzero(camera_aligned['head_valid'])} with head data)")
+
+        # Uniform grid over the span of the head sensor recording
+        head_times, _ = sensor_samples(sensors[0][1])
+        uniform = None
+        if len(head_times) > 1:
+            grid = uniform_grid(head_times[0], head_times[-1], self.uniform_rate)
+            uniform = {"timestamps": grid}
+            for prefix, stream in sensors:
+                uniform.update(resample_sensor(stream, grid, prefix))
+            print(f"Resampled {len(sensors)} sensor(s) onto a {self.uniform_rate:g} Hz grid ({len(grid)} points)")
+
+        return {"camera_aligned": camera_aligned, "uniform": uniform}
+
     def save_synced_data(self, synced_data, session_dict):
         """
-        Save the synced data to JSON.
+        Save the synced data to the HDF5 synced data store, with a small JSON manifest.
         """
         print("Saving synced data...")
-        output_path = self.session_dir / f"{self.session_id}_synced_data.json"
+        output_path, manifest_path = synced_data_paths(self.session_dir, self.session_id)
         try:
-            with open(output_path, 'w') as fp:
-                json.dump(synced_data, fp, indent=4)
+            save_synced_data(synced_data, output_path, manifest_path)
+            self.synced_data_file = output_path
             print(f"Synced data saved to {output_path}")
         except Exception as e:
             print(f"Failed to save synced data: {e}")
         
-        session_dict['synced_data_json'] = str(output_path)
+        session_dict['synced_data_file'] = str(output_path)
         return session_dict
             
     def create_nwb_file(self, session_dict):
@@ -250,15 +424,16 @@ class Analysis_manager_openfield:
         """
         print(f"Creating NWB file for session {self.session_id}...")
         
-        # Check if synced data JSON exists
-        synced_data_file = Path(session_dict.get('synced_data_json', None))
+        # Check if synced data file exists
+        synced_data_file = Path(session_dict.get('synced_data_file', ""))
         if not synced_data_file.exists():
             print(f"Synced data file not found: {synced_data_file}")
             return None
         
         try:
             # Call the NWB conversion function
-            nwb_path = headtracker_to_nwb(session_dict)
+            # Reuse the DAQ reader and the synced arrays already in memory
+            nwb_path = headtracker_to_nwb(session_dict, daq=self.daq, synced_data=self.sync_data)
             
             if nwb_path:
                 print(f"Successfully created NWB file: {nwb_path}")
@@ -272,13 +447,16 @@ class Analysis_manager_openfield:
             traceback.print_exc()
             return None
         
-def main(cohort_folders=None, refresh=False):
+def main(cohort_folders=None, refresh=False, n_workers=DEFAULT_WORKERS, force=False):
     """
     Process multiple cohort folders and run analysis on each unprocessed session.
     
     Args:
         cohort_folders (list): List of paths to cohort folders. If None, uses default locations.
         refresh (bool): If True, reprocess sessions even if they've already been processed.
+            Stages whose inputs are unchanged are still skipped unless `force` is set.
+        n_workers (int): Number of sessions processed in parallel.
+        force (bool): Rerun every stage, ignoring the stage manifests.
     """
     if cohort_folders is None:
         # Default cohort folders if none provided
@@ -300,27 +478,13 @@ def main(cohort_folders=None, refresh=False):
             cohort = Cohort_folder(folder_path)
             
             # Find sessions that need processing
-            sessions_to_process = []
-            for mouse_id, mouse_data in cohort.cohort["mice"].items():
-                for session_id, session_dict in mouse_data["sessions"].items():
-                    raw_data_present = session_dict["raw_data"].get("is_all_raw_data_present?", False)
-                    processed_data_present = session_dict["processed_data"].get("processed_data_present?", False)
-                    
-                    if raw_data_present and (not processed_data_present or refresh):
-                        sessions_to_process.append(session_dict)
-                        print(f"Queued for processing: {session_id} (Mouse: {mouse_id})")
+            sessions_to_process = cohort.find_sessions(raw_data_present=True, processed=None if refresh else False)
+            for session_dict in sessions_to_process:
+                print(f"Queued for processing: {session_dict['session_id']} (Mouse: {session_dict['mouse_id']})")
             
-            # Process each session
+            # Process the sessions in parallel; each one logs to its own file
             print(f"\nFound {len(sessions_to_process)} sessions to process in {folder_path}")
-            for i, session_dict in enumerate(sessions_to_process):
-                print(f"\n[{i+1}/{len(sessions_to_process)}] Processing session: {session_dict['session_id']}")
-                try:
-                    # Run analysis on this session
-                    analyzer = Analysis_manager_openfield(session_dict, create_nwb=True)
-                    print(f"Completed processing for {session_dict['session_id']}")
-                except Exception as e:
-                    print(f"Error processing session {session_dict['session_id']}: {e}")
-                    traceback.print_exc()
+            run_sessions_in_pool(sessions_to_process, n_workers=n_workers, create_nwb=True, force=force)
         
         except Exception as e:
             print(f"Error processing cohort folder {folder_path}: {e}")
@@ -0,0 +1,194 @@
+"""
+peri_stimulus.py - Head angles aligned to laser onsets, as a (trials x time x axis) array
+
+`peri_stimulus_array` cuts a window around each event out of a session's synced yaw / roll /
+pitch without looping over events:
+
+    - with a resampling `rate`, the window is a fixed time grid around each event and the angles
+      are interpolated onto all trials' grids in one call (`resampling.interpolate_angles`:
+      one `np.searchsorted` for the gap mask, `np.interp` per axis; grid points inside gaps
+      longer than `max_gap` become NaN);
+    - with `rate=None`, the native samples are used: each trial is the run of samples starting
+      at the first sample inside the window, taken from a strided (zero-copy) sliding-window
+      view of the data. Trials whose first or last sample is more than `max_gap` from where
+      the window puts it (window outside the recording, or across a gap) are NaN.
+
+Angles are unwrapped (period 360 degrees) before interpolation, so traces crossing +-180
+degrees stay continuous within each window. Unwrapping over the whole session leaves each
+trial offset by a session-dependent multiple of 360 degrees, so every trial is then shifted by
+a multiple of 360 that puts its value at the event (time 0, or its first valid sample if
+that one is missing) in [-180, 180). Trials therefore keep absolute headings and can be
+averaged across trials and sessions.
+
+`session_peri_stimulus` does this for one session's synced data store, using the trial table
+onsets (or the raw laser rising edges) as events, and caches the result as
+`peri_stimulus/<session_id>_<sensor>_<key>.npz` next to the synced data. The key covers the
+parameters and the synced data file's size and mtime, so re-plotting a cohort loads the
+cached arrays and a re-synced session is recomputed.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from synced_data_store import load_synced_data, SYNCED_DATA_SUFFIX
+from resampling import interpolate_angles, sensor_samples
+
+AXES = ("yaw", "roll", "pitch")
+DEFAULT_WINDOW = (-1.0, 2.0)   # seconds around the event
+DEFAULT_RATE = 100.0           # Hz of the resampled time grid
+CACHE_DIR_NAME = "peri_stimulus"
+
+
+def peri_stimulus_array(timestamps, values, event_times, window=DEFAULT_WINDOW, rate=DEFAULT_RATE, max_gap=None):
+    """
+    Build the (trials x time x axis) array of `values` around each event.
+
+    Args:
+        timestamps (array): Sample times (s), increasing
+        values (array): Samples, shape (n_samples,) or (n_samples, n_axes), in degrees
+        event_times (array): Event times (s)
+        window (tuple): (start, stop) of the window relative to each event (s)
+        rate (float or None): Resampling rate (Hz); None keeps the native samples
+        max_gap (float, optional): Longest gap (s) to interpolate across; defaults to 5 median
+            sample intervals
+
+    Returns:
+        tuple: (time, data) - time (n_time,) relative to the event (for rate=None, the nominal
+               time of each native sample offset), data (n_trials, n_time, n_axes) float32 with
+               NaN outside the recording and across gaps; each trial continuous, with its value
+               at the event in [-180, 180) degrees
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    event_times = np.asarray(event_times, dtype=np.float64)
+    n_axes = values.shape[1]
+
+    dt = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else np.nan
+    if max_gap is None:
+        max_gap = 5 * dt
+
+    if rate is None:
+        values = np.unwrap(values, period=360.0, axis=0)
+        # Native samples: fixed number of samples per trial, starting at the first sample in the window
+        n_time = max(int(round((window[1] - window[0]) / dt)), 1) if np.isfinite(dt) else 0
+        time = window[0] + np.arange(n_time) * dt
+        data = np.full((len(event_times), n_time, n_axes), np.nan, dtype=np.float32)
+        if n_time == 0 or len(timestamps) < n_time:
+            return time, data
+        start = np.searchsorted(timestamps, event_times + window[0])
+        inside = start + n_time <= len(timestamps)
+        windows = sliding_window_view(values, n_time, axis=0)         # (n_windows, n_axes, n_time)
+        data[inside] = windows[start[inside]].transpose(0, 2, 1)
+        # Drop trials whose first or last sample is more than max_gap from its nominal time: the
+        # window starts before the recording or in a gap, or its samples span a gap
+        first = timestamps[np.minimum(start, len(timestamps) - 1)]
+        last = timestamps[np.minimum(start + n_time - 1, len(timestamps) - 1)]
+        late_start = first - (event_times + time[0]) > max_gap
+        late_end = np.abs(last - (event_times + time[-1])) > max_gap
+        data[~inside | late_start | late_end] = np.nan
+        return time, wrap_at_event(time, data)
+
+    # Resampled: interpolate the unwrapped angles onto every trial's time grid at once
+    time = np.arange(int(np.ceil(window[0] * rate)), int(np.floor(window[1] * rate)) + 1) / rate
+    query = (event_times[:, None] + time[None, :]).ravel()
+    data, _ = interpolate_angles(timestamps, values, query, max_gap=max_gap, rewrap=False)
+    data = data.reshape(len(event_times), len(time), n_axes).astype(np.float32)
+    return time, wrap_at_event(time, data)
+
+
+def wrap_at_event(time, data, period=360.0):
+    """
+    Shift each trial by a multiple of `period` so its value at the event lies in
+    [-period/2, period/2), keeping the trace continuous within the window.
+
+    Args:
+        time (array): (n_time,) times relative to the event
+        data (array): (n_trials, n_time, n_axes) unwrapped angles, NaN where missing
+
+    Returns:
+        np.ndarray: data, shifted in place
+    """
+    if data.size == 0:
+        return data
+    event_index = int(np.argmin(np.abs(time)))
+    reference = data[:, event_index, :]
+    # Fall back to each trial's first valid sample when the one at the event is missing
+    finite = np.isfinite(data)
+    first = np.take_along_axis(data, finite.argmax(axis=1)[:, None, :], axis=1)[:, 0, :]
+    reference = np.where(np.isfinite(reference), reference, first)
+    shift = period * np.floor((reference + period / 2) / period)
+    data -= np.nan_to_num(shift)[:, None, :].astype(data.dtype)
+    return data
+
+
+def _cache_key(synced_data_file, params):
+    stat = os.stat(synced_data_file)
+    key = json.dumps({"params": params, "size": stat.st_size, "mtime": stat.st_mtime}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def session_peri_stimulus(synced_data_file, window=DEFAULT_WINDOW, rate=DEFAULT_RATE, sensor='head',
+                          events='trials', cache=True):
+    """
+    Peri-stimulus head (or body) angles of one session, from its synced data store.
+
+    Args:
+        synced_data_file (Path): `<session_id>_synced_data.h5`
+        window (tuple): (start, stop) around each event (s)
+        rate (float or None): Resampling rate (Hz); None keeps the native samples
+        sensor (str): 'head' or 'body'
+        events (str): 'trials' (stimulation epoch onsets) or 'pulses' (every laser rising edge)
+        cache (bool): Load from / save to the per-session cache
+
+    Returns:
+        dict: time, data (trials x time x axis), axes, event_times, plus duration_class_ms,
+              power_mW and n_pulses per trial when events='trials'
+    """
+    synced_data_file = Path(synced_data_file)
+    session_id = synced_data_file.name[:-len(SYNCED_DATA_SUFFIX)]
+    params = {"window": list(window), "rate": rate, "sensor": sensor, "events": events, "angles": "wrapped_at_event"}
+    cache_file = (synced_data_file.parent / CACHE_DIR_NAME /
+                  f"{session_id}_{sensor}_{_cache_key(synced_data_file, params)}.npz")
+
+    if cache and cache_file.exists():
+        with np.load(cache_file) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    stream = f"{sensor}_sensor"
+    synced_data = load_synced_data(synced_data_file, streams=[stream, "laser", "trials"])
+    sensor_data = synced_data.get(stream)
+    if sensor_data is None:
+        raise ValueError(f"No {stream} data in {synced_data_file}")
+
+    timestamps, values = sensor_samples(sensor_data)
+
+    result = {}
+    trials = synced_data.get("trials")
+    if events == 'trials' and trials:
+        event_times = np.asarray(trials["onset_times"])
+        for field in ("duration_class_ms", "power_mW", "n_pulses"):
+            result[field] = np.asarray(trials[field])
+    else:
+        event_times = np.asarray((synced_data.get("laser") or {}).get("rising_times", []))
+
+    time, data = peri_stimulus_array(timestamps, values, event_times, window, rate)
+    result.update({"time": time, "data": data, "axes": np.array(AXES), "event_times": event_times})
+
+    if cache:
+        cache_file.parent.mkdir(exist_ok=True)
+        # Remove entries for the same parameters computed from an older synced data file
+        for stale in cache_file.parent.glob(f"{session_id}_{sensor}_*.npz"):
+            with np.load(stale) as cached:
+                stale_params = json.loads(str(cached["params"])) if "params" in cached.files else None
+            if stale_params == params:
+                stale.unlink()
+        np.savez(cache_file, params=json.dumps(params), **result)
+        result["params"] = np.array(json.dumps(params))
+    return result
@@ -0,0 +1,120 @@
+"""
+resampling.py - Interpolate IMU angles onto camera frame times and uniform time grids
+
+Head sensor samples, body sensor samples and camera frames each have their own irregular synced
+timestamps, with NaN wherever no sync pulse matched. The functions here put yaw / roll / pitch
+onto any set of target times in bulk:
+
+    1. drop samples without a synced timestamp and sort by time,
+    2. unwrap the angles (period 360 degrees) so an interpolation across +-180 does not sweep
+       through 0,
+    3. interpolate every axis with `np.interp`,
+    4. rewrap to [-180, 180) degrees (optional),
+    5. mask targets outside the recording or inside a gap longer than `max_gap`.
+"""
+
+import numpy as np
+
+ANGLE_FIELDS = ("yaw_data", "roll_data", "pitch_data")
+DEFAULT_UNIFORM_RATE = 100.0   # Hz
+GAP_FACTOR = 5                 # default max_gap, in median sample intervals
+
+
+def wrap_angles(values, period=360.0):
+    """Wrap angles to [-period/2, period/2)."""
+    return (np.asarray(values) + period / 2) % period - period / 2
+
+
+def uniform_grid(start, stop, rate=DEFAULT_UNIFORM_RATE):
+    """
+    Uniform time grid from `start` to `stop` (inclusive, where it falls on the grid).
+    """
+    n = int(np.floor((stop - start) * rate)) + 1 if stop >= start else 0
+    return start + np.arange(n) / rate
+
+
+def gap_mask(timestamps, target_times, max_gap):
+    """
+    True for target times inside the recording and not inside a gap longer than `max_gap`.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    target_times = np.asarray(target_times, dtype=np.float64)
+    if len(timestamps) < 2:
+        return np.zeros(len(target_times), dtype=bool)
+    idx = np.clip(np.searchsorted(timestamps, target_times), 1, len(timestamps) - 1)
+    return ((target_times >= timestamps[0]) & (target_times <= timestamps[-1])
+            & (timestamps[idx] - timestamps[idx - 1] <= max_gap))
+
+
+def interpolate_angles(timestamps, values, target_times, max_gap=None, rewrap=True):
+    """
+    Interpolate angles (degrees) onto target times.
+
+    Args:
+        timestamps (array): Sample times (s), increasing, without NaN
+        values (array): Angles, shape (n_samples,) or (n_samples, n_axes)
+        target_times (array): Times to interpolate at (NaN targets give NaN)
+        max_gap (float, optional): Longest gap (s) to interpolate across; defaults to
+            GAP_FACTOR median sample intervals
+        rewrap (bool): Wrap the result back to [-180, 180); False keeps the unwrapped angles
+
+    Returns:
+        tuple: (resampled, valid) - resampled has the shape of target_times (plus the axis
+               dimension) with NaN where valid is False
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    target_times = np.asarray(target_times, dtype=np.float64)
+    squeeze = values.ndim == 1
+    if squeeze:
+        values = values[:, None]
+
+    if max_gap is None:
+        max_gap = GAP_FACTOR * float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 0.0
+
+    valid = gap_mask(timestamps, target_times, max_gap)
+    resampled = np.full((len(target_times), values.shape[1]), np.nan)
+    if valid.any():
+        unwrapped = np.unwrap(values, period=360.0, axis=0)
+        targets = target_times[valid]
+        resampled[valid] = np.column_stack([np.interp(targets, timestamps, unwrapped[:, axis])
+                                            for axis in range(values.shape[1])])
+        if rewrap:
+            resampled[valid] = wrap_angles(resampled[valid])
+
+    return (resampled[:, 0] if squeeze else resampled), valid
+
+
+def sensor_samples(stream_data):
+    """
+    Synced, time-sorted samples of one sensor stream from the synced data.
+
+    Returns:
+        tuple: (timestamps, values) - values has one column per ANGLE_FIELDS entry
+    """
+    timestamps = np.asarray(stream_data["synced_timestamps"], dtype=np.float64)
+    valid = np.asarray(stream_data.get("synced_valid", np.isfinite(timestamps)), dtype=bool)
+    timestamps = timestamps[valid]
+    values = np.column_stack([np.asarray(stream_data[field], dtype=np.float64)[valid] for field in ANGLE_FIELDS])
+    order = np.argsort(timestamps, kind='stable')
+    return timestamps[order], values[order]
+
+
+def resample_sensor(stream_data, target_times, prefix, max_gap=None):
+    """
+    Resample one sensor stream's yaw / roll / pitch onto target times.
+
+    Args:
+        stream_data (dict): One sensor entry of the synced data (e.g. synced_data['head_sensor'])
+        target_times (array): Times to resample onto
+        prefix (str): Field name prefix, e.g. 'head' gives head_yaw_data, ..., head_valid
+        max_gap (float, optional): Longest gap (s) to interpolate across
+
+    Returns:
+        dict: {f"{prefix}_yaw_data", f"{prefix}_roll_data", f"{prefix}_pitch_data", f"{prefix}_valid"}
+    """
+    timestamps, values = sensor_samples(stream_data)
+    resampled, valid = interpolate_angles(timestamps, values, target_times, max_gap=max_gap)
+    result = {f"{prefix}_{field}": resampled[:, axis] for axis, field in enumerate(ANGLE_FIELDS)}
+    result[f"{prefix}_valid"] = valid
+    return result
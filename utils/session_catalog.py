@@ -0,0 +1,325 @@
+"""
+session_catalog.py - SQLite catalog of a cohort's sessions, files and processing status
+
+`Cohort_folder` scans the cohort folder and stores what it found in
+`<cohort>/cohort_catalog.sqlite` (replacing `cohort_info.json`):
+
+    sessions     one row per session: mouse, date, directory, body sensor, raw data present,
+                 processed, synced data / NWB file, metadata (JSON), full session dict (JSON)
+    files        (session_id, key) -> path, required, present - every raw / processed file
+    powers       (session_id, power_mW) - laser powers at the brain from the metadata
+    status       (session_id, stage) -> status, detail, duration, updated - processing results
+    listings     session_id -> directory mtime and entry names at the last scan, so a rescan
+                 only lists folders whose mtime changed (see Cohort_folder)
+
+Lookups by session ID are primary-key reads and queries such as "processed sessions with a
+body sensor at 10 mW after 2025-03-01" go through indexes (`find_sessions`) instead of loading
+and walking the nested cohort dictionary.
+"""
+
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+CATALOG_NAME = "cohort_catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    cohort TEXT NOT NULL,
+    mouse_id TEXT,
+    session_date TEXT,
+    directory TEXT,
+    body_sensor INTEGER,
+    raw_data_present INTEGER,
+    processed INTEGER,
+    synced_data_file TEXT,
+    nwb_file TEXT,
+    metadata TEXT,
+    session_dict TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_mouse ON sessions (mouse_id);
+CREATE INDEX IF NOT EXISTS sessions_date ON sessions (session_date);
+CREATE INDEX IF NOT EXISTS sessions_state ON sessions (raw_data_present, processed, body_sensor);
+
+CREATE TABLE IF NOT EXISTS files (
+    session_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    path TEXT,
+    required INTEGER,
+    present INTEGER,
+    PRIMARY KEY (session_id, key)
+);
+
+CREATE TABLE IF NOT EXISTS powers (
+    session_id TEXT NOT NULL,
+    power_mW REAL NOT NULL,
+    PRIMARY KEY (session_id, power_mW)
+);
+CREATE INDEX IF NOT EXISTS powers_power ON powers (power_mW);
+
+CREATE TABLE IF NOT EXISTS status (
+    session_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT,
+    detail TEXT,
+    duration REAL,
+    updated TEXT,
+    PRIMARY KEY (session_id, stage)
+);
+
+CREATE TABLE IF NOT EXISTS listings (
+    session_id TEXT PRIMARY KEY,
+    directory TEXT,
+    mtime REAL,
+    names TEXT
+);
+"""
+
+
+def catalog_path(cohort_directory):
+    """Path of the catalog of a cohort folder."""
+    return Path(cohort_directory) / CATALOG_NAME
+
+
+def session_date(session_id):
+    """ISO date-time from a session ID (format: YYMMDD_HHMMSS_mouseID), or None."""
+    try:
+        return datetime.strptime(session_id[:13], '%y%m%d_%H%M%S').isoformat(sep=' ')
+    except ValueError:
+        return None
+
+
+def _load_metadata(session_dict):
+    path = session_dict.get("raw_data", {}).get("metadata", "None")
+    if not path or path == "None" or not Path(path).exists():
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+class SessionCatalog:
+    """
+    Read / write access to one cohort catalog.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str or Path): Catalog file (created if missing)
+        """
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+    def sync_cohort(self, cohort, required_keys=(), changed=None, listings=None, max_workers=1):
+        """
+        Replace the catalog's view of a cohort with a freshly scanned cohort dictionary.
+
+        Args:
+            cohort (dict): Cohort_folder.cohort ({"Cohort name": str, "mice": {...}})
+            required_keys (iterable): raw_data keys of required files (for the files table)
+            changed (set, optional): Session IDs whose rows need rewriting; the others are
+                unchanged since the last scan and keep their rows. None rewrites every session.
+            listings (dict, optional): {session_id: (directory, mtime, names)} to store for
+                the next incremental scan
+            max_workers (int): Threads reading the changed sessions' metadata files concurrently
+        """
+        cohort_name = cohort["Cohort name"]
+        now = str(datetime.now())
+        required_keys = set(required_keys)
+        current = set()
+        to_write = []
+        for mouse_id, mouse_data in cohort["mice"].items():
+            for session_id, session_dict in mouse_data["sessions"].items():
+                current.add(session_id)
+                if changed is None or session_id in changed:
+                    to_write.append((mouse_id, session_id, session_dict))
+
+        # Metadata files live on the (slow) session folders; read them concurrently, in order
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            metadatas = list(executor.map(lambda item: _load_metadata(item[2]), to_write))
+
+        session_rows, file_rows, power_rows = [], [], []
+        for (mouse_id, session_id, session_dict), metadata in zip(to_write, metadatas):
+            raw_data = session_dict.get("raw_data", {})
+            processed_data = session_dict.get("processed_data", {})
+            session_rows.append((
+                session_id, cohort_name, mouse_id, session_date(session_id), session_dict.get("directory"),
+                int(bool(session_dict.get("body_sensor", False))),
+                int(bool(raw_data.get("is_all_raw_data_present?", False))),
+                int(bool(processed_data.get("processed_data_present?", False))),
+                processed_data.get("synced_data_file"), processed_data.get("NWB_file"),
+                json.dumps(metadata), json.dumps(session_dict), now,
+            ))
+
+            for group in (raw_data, processed_data):
+                for key, path in group.items():
+                    if isinstance(path, str) and not key.endswith("?"):
+                        file_rows.append((session_id, key, path, int(key in required_keys), int(path != "None")))
+
+            powers = metadata.get("brain_laser_power_mW", [])
+            for power in powers if isinstance(powers, list) else [powers]:
+                try:
+                    power_rows.append((session_id, float(power)))
+                except (TypeError, ValueError):
+                    pass
+
+        session_ids = [row[0] for row in session_rows]
+        with self.connection:
+            stale = [row["session_id"] for row in self.connection.execute(
+                "SELECT session_id FROM sessions WHERE cohort = ?", (cohort_name,))
+                if row["session_id"] not in current]
+            for table in ("sessions", "files", "powers", "status", "listings"):
+                self.connection.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(s,) for s in stale])
+            for table in ("files", "powers"):
+                self.connection.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(s,) for s in session_ids])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", session_rows)
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", file_rows)
+            self.connection.executemany("INSERT OR IGNORE INTO powers VALUES (?, ?)", power_rows)
+            if listings:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                    [(session_id, str(directory), mtime, json.dumps(names))
+                     for session_id, (directory, mtime, names) in listings.items()])
+
+    def load_listings(self, cohort_name):
+        """
+        Directory listings stored by the last scan of a cohort.
+
+        Returns:
+            dict: {directory: (mtime, names)}
+        """
+        rows = self.connection.execute(
+            "SELECT l.directory, l.mtime, l.names FROM listings l JOIN sessions s USING (session_id) "
+            "WHERE s.cohort = ?", (cohort_name,))
+        return {row["directory"]: (row["mtime"], json.loads(row["names"])) for row in rows}
+
+    def set_status(self, session_id, stage, status, detail=None, duration=None):
+        """
+        Record the outcome of a processing stage for a session.
+        """
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?, ?)",
+                                    (session_id, stage, status, detail, duration, str(datetime.now())))
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+    def get_session(self, session_id):
+        """
+        The session dictionary (as built by Cohort_folder) for a session ID, or None.
+        """
+        row = self.connection.execute("SELECT session_dict FROM sessions WHERE session_id = ?",
+                                      (session_id,)).fetchone()
+        return json.loads(row["session_dict"]) if row else None
+
+    def find_sessions(self, cohort=None, mouse_id=None, body_sensor=None, raw_data_present=None,
+                      processed=None, power_mW=None, after=None, before=None):
+        """
+        Session dictionaries matching all given filters, ordered by date.
+
+        Args:
+            cohort (str, optional): Cohort name
+            mouse_id (str or list, optional): Mouse ID(s)
+            body_sensor (bool, optional): Sessions with / without a body sensor
+            raw_data_present (bool, optional): All required raw files present
+            processed (bool, optional): NWB file present
+            power_mW (float or list, optional): Sessions that used any of these laser powers
+            after, before (datetime or str, optional): Session start bounds ('YYYY-MM-DD ...')
+
+        Returns:
+            list: Session dictionaries
+        """
+        clauses, params = [], []
+        if cohort is not None:
+            clauses.append("s.cohort = ?")
+            params.append(cohort)
+        if mouse_id is not None:
+            mouse_ids = [mouse_id] if isinstance(mouse_id, str) else list(mouse_id)
+            clauses.append(f"s.mouse_id IN ({', '.join('?' * len(mouse_ids))})")
+            params.extend(mouse_ids)
+        for column, value in (("body_sensor", body_sensor), ("raw_data_present", raw_data_present),
+                              ("processed", processed)):
+            if value is not None:
+                clauses.append(f"s.{column} = ?")
+                params.append(int(bool(value)))
+        if power_mW is not None:
+            powers = [power_mW] if isinstance(power_mW, (int, float)) else list(power_mW)
+            clauses.append("s.session_id IN (SELECT session_id FROM powers WHERE "
+                           + " OR ".join("ABS(power_mW - ?) < 1e-6" for _ in powers) + ")")
+            params.extend(float(p) for p in powers)
+        if after is not None:
+            clauses.append("s.session_date >= ?")
+            params.append(_as_date(after))
+        if before is not None:
+            clauses.append("s.session_date < ?")
+            params.append(_as_date(before))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.connection.execute(
+            f"SELECT s.session_dict FROM sessions s {where} ORDER BY s.session_date, s.session_id", params)
+        return [json.loads(row["session_dict"]) for row in rows]
+
+    def status(self, session_id):
+        """
+        {stage: {"status", "detail", "duration", "updated"}} for a session.
+        """
+        rows = self.connection.execute("SELECT * FROM status WHERE session_id = ?", (session_id,))
+        return {row["stage"]: {key: row[key] for key in ("status", "detail", "duration", "updated")}
+                for row in rows}
+
+
+def record_results(sessions, results, stage="postprocessing"):
+    """
+    Store session_pool results as processing status in each session's cohort catalog.
+
+    Args:
+        sessions (list): Session dictionaries that were processed
+        results (list): Result dictionaries from session_pool.process_session
+        stage (str): Stage name to record
+    """
+    directories = {s.get("session_id"): Path(s.get("directory", "")) for s in sessions}
+    by_catalog = {}
+    for result in results:
+        directory = directories.get(result["session_id"])
+        if directory is None:
+            continue
+        path = catalog_path(directory.parent)
+        if path.exists():
+            by_catalog.setdefault(path, []).append(result)
+
+    for path, catalog_results in by_catalog.items():
+        try:
+            with SessionCatalog(path) as catalog:
+                for result in catalog_results:
+                    catalog.set_status(result["session_id"], stage, result["status"],
+                                       detail=result.get("error"), duration=result.get("duration"))
+        except sqlite3.Error as e:
+            print(f"Could not record processing status in {path}: {e}")
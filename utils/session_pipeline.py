@@ -0,0 +1,165 @@
+"""
+session_pipeline.py - Run video conversion, post-processing and transfer as a per-session pipeline
+
+`post_processing.main` used to convert every session's video, then sync every session, then
+transfer everything, so the CPU-bound conversion and the I/O-bound syncing never overlapped and
+no session was finished before the slowest video was. Here each session moves on to the next
+stage as soon as its own previous stage is done:
+
+    video conversion  ->  sync / NWB (session_pool.process_session)  ->  transfer (optional)
+
+Each stage has its own executor and concurrency limit. Video conversions share one
+VideoScheduler, i.e. one long-lived encoder pool sized to the cores, so several sessions'
+videos are encoded at once without oversubscribing the machine; sync/NWB runs in worker
+processes; transfers are threads waiting on rsync. A failed video conversion does not hold the
+session back (syncing does not need the video), but a session is only transferred once its
+post-processing succeeded.
+"""
+
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from .session_catalog import record_results
+from .session_pool import process_session, print_summary_table, DEFAULT_WORKERS
+from .video_processor import VideoProcessor, VideoScheduler, VIDEO_ENCODER, DEFAULT_ACTIVE_VIDEOS
+
+DEFAULT_VIDEO_WORKERS = DEFAULT_ACTIVE_VIDEOS
+DEFAULT_TRANSFER_WORKERS = 1
+
+
+def convert_session_video(session_dict, force=False, encoder=VIDEO_ENCODER, scheduler=None):
+    """
+    Video stage: convert the session's binary video, if it has one.
+
+    Returns:
+        dict: status ("processed", "skipped", "no binary" or "failed"), duration, video
+    """
+    start = time.perf_counter()
+    session_dir = Path(session_dict.get("directory", ""))
+    if not list(session_dir.glob("*binary_video*")):
+        return {"status": "no binary", "duration": 0.0, "video": None}
+
+    processor = VideoProcessor(session_dir, force=force, encoder=encoder, scheduler=scheduler)
+    status = processor.process_session() or "failed"
+    return {
+        "status": status,
+        "duration": time.perf_counter() - start,
+        "video": str(processor.output_video) if processor.output_video else None,
+    }
+
+
+def transfer_session(transfer, session_dict):
+    """
+    Transfer stage: run the `transfer` callable for one session.
+
+    Returns:
+        dict: status ("ok" or "failed"), duration
+    """
+    start = time.perf_counter()
+    ok = transfer(session_dict) is not False
+    return {"status": "ok" if ok else "failed", "duration": time.perf_counter() - start}
+
+
+def print_stage_table(stages, wall_time):
+    """
+    Print the status and duration of each stage per session, and the pipeline's wall time
+    against the time the stages would have taken back to back.
+    """
+    def fmt(stage):
+        if stage is None:
+            return "-"
+        return f"{stage['status']} ({stage['duration']:.0f}s)"
+
+    width = max([len("Session")] + [len(str(session_id)) for session_id in stages])
+    print(f"\n{'Session':<{width}}  {'Video':<20}  {'Sync/NWB':<20}  {'Transfer':<20}")
+    print("-" * (width + 66))
+    for session_id in sorted(stages, key=str):
+        row = stages[session_id]
+        print(f"{str(session_id):<{width}}  {fmt(row['video']):<20}  {fmt(row['postprocess']):<20}  "
+              f"{fmt(row['transfer']):<20}")
+
+    stage_time = sum(stage["duration"] for row in stages.values() for stage in row.values() if stage)
+    print(f"\nPipeline wall time {wall_time:.0f}s (stages took {stage_time:.0f}s back to back).")
+
+
+def run_session_pipeline(sessions, video_workers=DEFAULT_VIDEO_WORKERS, postprocess_workers=DEFAULT_WORKERS,
+                         transfer=None, transfer_workers=DEFAULT_TRANSFER_WORKERS, create_nwb=True, force=False,
+                         video_encoder=VIDEO_ENCODER):
+    """
+    Convert, post-process and (optionally) transfer sessions, each session advancing as soon as
+    its previous stage is done.
+
+    Args:
+        sessions (list): Session dictionaries from Cohort_folder
+        video_workers (int): Sessions whose videos are converted at the same time, all on one
+            shared encoder pool
+        postprocess_workers (int): Sessions synced / converted to NWB at the same time
+        transfer (callable, optional): transfer(session_dict) copying a finished session
+            (returning False on failure). No transfer stage if None.
+        transfer_workers (int): Sessions transferred at the same time
+        create_nwb (bool): Whether to create NWB files
+        force (bool): Rerun every stage, ignoring the stage manifests
+        video_encoder (str): 'mjpg' or one of video_processor.FFMPEG_ENCODERS
+
+    Returns:
+        list: Post-processing result dictionaries (see session_pool.process_session)
+    """
+    if not sessions:
+        return []
+
+    print(f"Pipelining {len(sessions)} sessions: {video_workers} video, {postprocess_workers} sync/NWB"
+          f"{f', {transfer_workers} transfer' if transfer else ''} worker(s)...")
+
+    stages = {s.get("session_id"): {"video": None, "postprocess": None, "transfer": None} for s in sessions}
+    results = []
+    start = time.perf_counter()
+
+    with VideoScheduler(max_active_videos=video_workers) as scheduler, \
+            ThreadPoolExecutor(max_workers=video_workers) as video_pool, \
+            ProcessPoolExecutor(max_workers=postprocess_workers) as postprocess_pool, \
+            ThreadPoolExecutor(max_workers=transfer_workers) as transfer_pool:
+
+        pending = {video_pool.submit(convert_session_video, session_dict, force, video_encoder, scheduler): ("video", session_dict)
+                   for session_dict in sessions}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, session_dict = pending.pop(future)
+                session_id = session_dict.get("session_id")
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The stage itself died (e.g. a worker ran out of memory); other sessions carry on
+                    print(f"{session_id}: {stage} stage crashed: {e}")
+                    traceback.print_exc()
+                    result = {"status": "crashed", "duration": 0.0, "error": str(e)}
+                stages[session_id][stage] = result
+
+                if stage == "video":
+                    print(f"{session_id}: video {result['status']} ({result['duration']:.0f}s)")
+                    if result.get("video"):
+                        # The NWB file links the video, which did not exist when the session was scanned
+                        session_dict.setdefault("raw_data", {})["video"] = result["video"]
+                    next_future = postprocess_pool.submit(process_session, session_dict, create_nwb, force)
+                    pending[next_future] = ("postprocess", session_dict)
+
+                elif stage == "postprocess":
+                    if "session_id" not in result:
+                        result.update({"session_id": session_id, "stages": [], "log_file": "-",
+                                       "synced_data_mb": None, "nwb_mb": None})
+                    results.append(result)
+                    print(f"{session_id}: sync/NWB {result['status']} ({result['duration']:.0f}s)")
+                    if transfer is not None and result["status"] == "ok":
+                        next_future = transfer_pool.submit(transfer_session, transfer, session_dict)
+                        pending[next_future] = ("transfer", session_dict)
+
+                else:
+                    print(f"{session_id}: transfer {result['status']} ({result['duration']:.0f}s)")
+
+    print_summary_table(results)
+    print_stage_table(stages, time.perf_counter() - start)
+    record_results(sessions, results)
+    return results
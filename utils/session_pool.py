@@ -0,0 +1,149 @@
+"""
+session_pool.py - Run session post-processing in parallel worker processes
+
+Syncing and NWB creation are independent per session and mostly file I/O plus NumPy, so
+sessions are handed to a `ProcessPoolExecutor`. Each session writes its console output to its
+own `<session_id>_postprocessing.log` in the session folder, a failing session is recorded as
+failed without affecting the others, and a summary table (status, stages run, duration, output
+sizes) is printed once all sessions are done. Each session's outcome is also recorded in its
+cohort catalog's status table (see session_catalog.py). Stages that are up to date according to
+the session's stage manifest (see stage_manifest.py) are skipped unless `force` is set.
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+from pathlib import Path
+
+# Each worker holds one session's arrays in memory, so stay well below the core count by default
+DEFAULT_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+
+def _file_size_mb(path):
+    try:
+        return os.path.getsize(path) / 1e6 if path else None
+    except OSError:
+        return None
+
+
+def process_session(session_dict, create_nwb=True, force=False):
+    """
+    Sync one session and create its NWB file, logging to the session folder.
+
+    Args:
+        session_dict (dict): Session information from Cohort_folder
+        create_nwb (bool): Whether to create an NWB file after synchronization
+        force (bool): Rerun stages even if the stage manifest says they are up to date
+
+    Returns:
+        dict: session_id, status, stages, duration, error, log_file, synced_data_mb, nwb_mb
+    """
+    from openfield_analysis_manager import Analysis_manager_openfield
+
+    session_id = session_dict.get("session_id")
+    session_dir = Path(session_dict.get("directory", ""))
+    log_file = session_dir / f"{session_id}_postprocessing.log"
+    result = {
+        "session_id": session_id,
+        "status": "failed",
+        "stages": [],
+        "duration": 0.0,
+        "error": None,
+        "log_file": str(log_file),
+        "synced_data_mb": None,
+        "nwb_mb": None,
+    }
+
+    start = time.perf_counter()
+    try:
+        with open(log_file, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+            manager = Analysis_manager_openfield(session_dict, create_nwb=create_nwb, force=force)
+        result["status"] = manager.status
+        result["stages"] = manager.stages_run
+        result["error"] = manager.error
+        result["synced_data_mb"] = _file_size_mb(manager.synced_data_file)
+        result["nwb_mb"] = _file_size_mb(manager.nwb_path)
+    except Exception as e:
+        result["error"] = f"{e}\n{traceback.format_exc()}"
+    result["duration"] = time.perf_counter() - start
+    return result
+
+
+def print_summary_table(results):
+    """
+    Print one line per session with status, stages run, duration and output sizes.
+    """
+    def fmt_mb(value):
+        return f"{value:.1f}" if value is not None else "-"
+
+    width = max([len("Session")] + [len(str(r["session_id"])) for r in results])
+    print(f"\n{'Session':<{width}}  {'Status':<10}  {'Stages run':<10}  {'Time (s)':>9}  {'Synced (MB)':>11}  {'NWB (MB)':>9}")
+    print("-" * (width + 61))
+    for r in sorted(results, key=lambda r: str(r["session_id"])):
+        stages = ",".join(r.get("stages") or []) or "-"
+        print(f"{str(r['session_id']):<{width}}  {r['status']:<10}  {stages:<10}  {r['duration']:>9.1f}  "
+              f"{fmt_mb(r['synced_data_mb']):>11}  {fmt_mb(r['nwb_mb']):>9}")
+
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"\n{len(results) - len(failed)}/{len(results)} sessions processed successfully.")
+    for r in failed:
+        first_line = (r["error"] or "see log").strip().splitlines()[0]
+        print(f"  {r['session_id']}: {r['status']} - {first_line} (log: {r['log_file']})")
+
+
+def run_sessions_in_pool(sessions, n_workers=DEFAULT_WORKERS, create_nwb=True, force=False):
+    """
+    Process sessions in parallel and print a summary table at the end.
+
+    Args:
+        sessions (list): Session dictionaries to process
+        n_workers (int): Number of worker processes (1 runs the sessions in this process)
+        create_nwb (bool): Whether to create NWB files
+        force (bool): Rerun every stage, ignoring the stage manifests
+
+    Returns:
+        list: Result dictionaries from `process_session`
+    """
+    results = []
+    if not sessions:
+        return results
+
+    n_workers = max(1, min(n_workers, len(sessions)))
+    print(f"Processing {len(sessions)} sessions with {n_workers} worker(s)...")
+
+    if n_workers == 1:
+        for i, session_dict in enumerate(sessions):
+            result = process_session(session_dict, create_nwb, force)
+            results.append(result)
+            print(f"[{i + 1}/{len(sessions)}] {result['session_id']}: {result['status']} ({result['duration']:.1f}s)")
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(process_session, session_dict, create_nwb, force): session_dict
+                       for session_dict in sessions}
+            for i, future in enumerate(as_completed(futures)):
+                session_dict = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. out of memory); the other sessions carry on
+                    result = {
+                        "session_id": session_dict.get("session_id"),
+                        "status": "crashed",
+                        "stages": [],
+                        "duration": 0.0,
+                        "error": str(e),
+                        "log_file": "-",
+                        "synced_data_mb": None,
+                        "nwb_mb": None,
+                    }
+                results.append(result)
+                print(f"[{i + 1}/{len(sessions)}] {result['session_id']}: {result['status']} ({result['duration']:.1f}s)")
+
+    print_summary_table(results)
+
+    # Record each session's outcome in its cohort catalog
+    from session_catalog import record_results
+    record_results(sessions, results)
+    return results
@@ -0,0 +1,221 @@
+"""
+stage_manifest.py - Per-session record of what each post-processing stage was computed from
+
+Each stage (video conversion, sync, NWB) records in `<session_id>_stage_manifest.json`:
+
+    - its input files with size, modification time and content hash
+    - a hash of the source files implementing the stage (the code version)
+    - the parameters it ran with
+    - the output files it produced
+
+On a rerun a stage is skipped when its outputs still exist and its inputs, code version and
+parameters match the record, so a cohort-wide refresh only recomputes what a change actually
+invalidated. Hashes are only recomputed for inputs whose size or mtime changed; a file that was
+merely touched (or rewritten with identical content) still counts as unchanged. Files larger
+than `FULL_HASH_LIMIT` are hashed from their size plus samples at the start, middle and end,
+which is enough to tell recordings apart without reading gigabytes of video.
+"""
+
+import ast
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+MANIFEST_SUFFIX = "_stage_manifest.json"
+FULL_HASH_LIMIT = 64 * 1024 * 1024
+SAMPLE_SIZE = 4 * 1024 * 1024
+
+
+def file_hash(path):
+    """
+    Content hash of a file (sampled for files above FULL_HASH_LIMIT).
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if size <= FULL_HASH_LIMIT:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        else:
+            digest.update(str(size).encode())
+            for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                f.seek(offset)
+                digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Size, mtime and content hash of a file. The hash is reused from `previous` when the
+    size and mtime are unchanged.
+
+    Args:
+        path (Path): File to fingerprint
+        previous (dict, optional): Earlier fingerprint of the same file
+
+    Returns:
+        dict or None: {"size", "mtime", "hash"}, or None if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        fingerprint["hash"] = previous.get("hash")
+    else:
+        fingerprint["hash"] = file_hash(path)
+    return fingerprint
+
+
+def input_fingerprint(path, previous=None):
+    """
+    Fingerprint of an optional stage input. No path, Cohort_folder's "None" placeholder for a
+    missing raw file and a file that does not exist all give None, so an absent optional
+    input is recorded and checked the same way.
+    """
+    if path is None or str(path) in ("", "None"):
+        return None
+    return file_fingerprint(path, previous)
+
+
+def local_modules(*source_files):
+    """
+    The source files plus every module they import, directly or indirectly, from their own
+    directory (e.g. `from daq_reader import DAQReader` or `from .daq_clock import ...` inside
+    utils/). Third-party and standard library imports are ignored.
+
+    Args:
+        *source_files (Path): Python files to start from
+
+    Returns:
+        list: Paths of the source files and their local imports, sorted
+    """
+    found = set()
+    pending = [Path(f).resolve() for f in source_files]
+    while pending:
+        source_file = pending.pop()
+        if source_file in found or not source_file.is_file():
+            continue
+        found.add(source_file)
+        tree = ast.parse(source_file.read_text(encoding='utf-8'), filename=str(source_file))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                # `from . import x` names modules; `from x import y` / `from .x import y` name x
+                names = [alias.name for alias in node.names] if node.module is None else [node.module]
+            else:
+                continue
+            for name in names:
+                candidate = source_file.parent / f"{name.split('.')[0]}.py"
+                if candidate.is_file():
+                    pending.append(candidate)
+    return sorted(found)
+
+
+def code_version(*source_files):
+    """
+    Hash of the source files implementing a stage.
+
+    Args:
+        *source_files (Path): Python files (e.g. a module's __file__)
+    """
+    digest = hashlib.sha1()
+    for source_file in sorted(str(Path(f)) for f in source_files):
+        digest.update(Path(source_file).name.encode())
+        with open(source_file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class StageManifest:
+    """
+    Reads and updates the stage manifest of one session.
+    """
+
+    def __init__(self, session_dir, session_id):
+        """
+        Args:
+            session_dir (Path): Session directory
+            session_id (str): Session ID
+        """
+        self.path = Path(session_dir) / f"{session_id}{MANIFEST_SUFFIX}"
+        self.stages = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.stages = json.load(f).get("stages", {})
+            except (OSError, ValueError) as e:
+                print(f"Could not read stage manifest {self.path}, all stages will run: {e}")
+
+    def check(self, stage, inputs, params, code):
+        """
+        Decide whether `stage` has to run.
+
+        Args:
+            stage (str): Stage name
+            inputs (dict): {name: path} of the stage's input files (None or "None" if absent)
+            params (dict): Parameters the stage would run with (JSON-serialisable)
+            code (str): Code version from `code_version`
+
+        Returns:
+            tuple: (up_to_date, reason)
+        """
+        record = self.stages.get(stage)
+        if record is None:
+            return False, "no previous run recorded"
+        if record.get("code") != code:
+            return False, "code changed"
+        if record.get("params") != json.loads(json.dumps(params)):
+            return False, "parameters changed"
+        for output in record.get("outputs", {}).values():
+            if not Path(output).exists():
+                return False, f"output missing: {Path(output).name}"
+
+        recorded_inputs = record.get("inputs", {})
+        if set(recorded_inputs) != set(inputs):
+            return False, "inputs changed"
+        for name, path in inputs.items():
+            previous = recorded_inputs[name]
+            current = input_fingerprint(path, previous)
+            if (current is None) != (previous is None):
+                return False, f"input changed: {name}"
+            if current is not None and current["hash"] != previous.get("hash"):
+                return False, f"input changed: {name}"
+        return True, "inputs, code and parameters unchanged"
+
+    def record(self, stage, inputs, params, code, outputs):
+        """
+        Record a completed stage run and save the manifest.
+
+        Args:
+            stage (str): Stage name
+            inputs (dict): {name: path} of the stage's input files (None or "None" if absent)
+            params (dict): Parameters the stage ran with
+            code (str): Code version from `code_version`
+            outputs (dict): {name: path} of the files the stage produced
+        """
+        previous = self.stages.get(stage, {}).get("inputs", {})
+        self.stages[stage] = {
+            "inputs": {name: input_fingerprint(path, previous.get(name)) for name, path in inputs.items()},
+            "params": params,
+            "code": code,
+            "outputs": {name: str(path) for name, path in outputs.items()},
+            "completed": str(datetime.now()),
+        }
+        self.save()
+
+    def invalidate(self, stage):
+        """Forget a stage, so it runs next time."""
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({"stages": self.stages}, f, indent=4)
@@ -0,0 +1,193 @@
+"""
+stim_trials.py - Build the stimulation trial table from the LASER_SYNC edges
+
+The laser Arduino delivers, for each power level in turn, `num_cycles` cycles of every
+duration in `stim_times_ms`, starting one every `stim_delay` ms. With `pulse_freq` > 0 each
+stimulus is a train of `pulse_on_time` ms pulses, so the LASER_SYNC channel shows many short
+pulses per stimulus. The trial extractor:
+
+    1. pairs rising and falling edges into pulses,
+    2. groups pulses into stimulation epochs wherever the gap between two pulses is longer than
+       the gap expected inside a pulse train (from `pulse_freq`, `stim_delay` and the stimulus
+       durations in the metadata),
+    3. assigns each epoch the nearest expected stimulus duration (binary search over the sorted
+       `stim_times_ms`), and the power of its block of `num_cycles * len(stim_times_ms)` epochs.
+
+All steps are vectorised. The trial table has one entry per epoch:
+
+    onset_times, offset_times, durations (s), duration_class_ms, power_mW, set_power_mW, n_pulses
+"""
+
+import numpy as np
+
+TRIAL_FIELDS = ("onset_times", "offset_times", "durations", "duration_class_ms",
+                "power_mW", "set_power_mW", "n_pulses")
+
+
+def pair_edges(rising_times, falling_times):
+    """
+    Pair rising and falling edges into pulses.
+
+    Args:
+        rising_times (array): Times of rising edges
+        falling_times (array): Times of falling edges
+
+    Returns:
+        tuple: (onsets, offsets) - equal length arrays; a leading falling edge (signal already
+               high at the start) and a trailing rising edge (still high at the end) are dropped
+    """
+    rising_times = np.asarray(rising_times, dtype=np.float64)
+    falling_times = np.asarray(falling_times, dtype=np.float64)
+    if len(falling_times) > 0 and len(rising_times) > 0 and falling_times[0] < rising_times[0]:
+        falling_times = falling_times[1:]
+    n = min(len(rising_times), len(falling_times))
+    return rising_times[:n], falling_times[:n]
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    return [value]
+
+
+def _seconds(value_ms):
+    """Metadata times are in ms, but older sessions may store strings such as "5s"."""
+    if value_ms is None:
+        return None
+    if isinstance(value_ms, str):
+        value = value_ms.strip().lower()
+        try:
+            if value.endswith("ms"):
+                return float(value[:-2]) / 1000.0
+            if value.endswith("s"):
+                return float(value[:-1])
+            return float(value) / 1000.0
+        except ValueError:
+            return None
+    return float(value_ms) / 1000.0
+
+
+def epoch_gap_threshold(metadata):
+    """
+    Longest gap (s) between two pulses that still belong to the same stimulation epoch.
+
+    Inside a pulse train pulses are at most one pulse period apart; consecutive stimuli are
+    separated by about `stim_delay` minus the stimulus duration (the Arduino counts the delay
+    from stimulus onset). The threshold sits halfway between the two, or at 1.5 pulse periods
+    if the metadata does not give a usable inter-stimulus gap.
+    """
+    metadata = metadata or {}
+    pulse_freq = float(metadata.get("pulse_freq") or 0)
+    period = 1.0 / pulse_freq if pulse_freq > 0 else 0.0
+
+    stim_delay = _seconds(metadata.get("stim_delay"))
+    stim_times = [t / 1000.0 for t in _as_list(metadata.get("stim_times_ms"))]
+    inter_gap = stim_delay - max(stim_times, default=0.0) if stim_delay is not None else None
+
+    if inter_gap is not None and inter_gap > 2 * period:
+        return (period + inter_gap) / 2
+    return 1.5 * period
+
+
+def group_pulses(onsets, offsets, max_gap):
+    """
+    Group pulses into epochs separated by gaps longer than `max_gap`.
+
+    Returns:
+        tuple: (epoch_onsets, epoch_offsets, n_pulses)
+    """
+    if len(onsets) == 0:
+        return np.array([]), np.array([]), np.array([], dtype=np.int64)
+    gaps = onsets[1:] - offsets[:-1]
+    starts = np.concatenate(([0], np.flatnonzero(gaps > max_gap) + 1))
+    ends = np.concatenate((starts[1:], [len(onsets)]))
+    return onsets[starts], offsets[ends - 1], (ends - starts).astype(np.int64)
+
+
+def nearest_class(values, classes):
+    """
+    Nearest entry of `classes` for each value, by binary search over the sorted classes.
+
+    Returns:
+        np.ndarray: The matched class for each value (NaN if there are no classes)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    classes = np.unique(np.asarray(classes, dtype=np.float64))
+    if len(classes) == 0:
+        return np.full(len(values), np.nan)
+    idx = np.clip(np.searchsorted(classes, values), 1, max(len(classes) - 1, 1))
+    lower = classes[idx - 1]
+    upper = classes[np.minimum(idx, len(classes) - 1)]
+    return np.where(np.abs(values - lower) <= np.abs(upper - values), lower, upper)
+
+
+def extract_stim_trials(rising_times, falling_times, metadata=None, max_gap=None):
+    """
+    Build the trial table from laser edge times and the session metadata.
+
+    Args:
+        rising_times (array): LASER_SYNC rising edge times
+        falling_times (array): LASER_SYNC falling edge times
+        metadata (dict, optional): Session metadata (stim_times_ms, num_cycles, stim_delay,
+            pulse_freq, brain_laser_power_mW, set_laser_power_mW)
+        max_gap (float, optional): Override the epoch gap threshold (s)
+
+    Returns:
+        dict: {field: array} for TRIAL_FIELDS
+    """
+    metadata = metadata or {}
+    onsets, offsets = pair_edges(rising_times, falling_times)
+    if max_gap is None:
+        max_gap = epoch_gap_threshold(metadata)
+    epoch_onsets, epoch_offsets, n_pulses = group_pulses(onsets, offsets, max_gap)
+    durations = epoch_offsets - epoch_onsets
+    n_epochs = len(epoch_onsets)
+
+    stim_times_ms = [float(t) for t in _as_list(metadata.get("stim_times_ms"))]
+    duration_class_ms = nearest_class(durations * 1000.0, stim_times_ms)
+
+    # Powers are delivered in blocks of num_cycles * len(stim_times_ms) stimuli
+    brain_powers = [float(p) for p in _as_list(metadata.get("brain_laser_power_mW"))]
+    set_powers = [float(p) for p in _as_list(metadata.get("set_laser_power_mW"))]
+    epochs_per_power = int(metadata.get("num_cycles") or 0) * len(stim_times_ms)
+    power_mW = np.full(n_epochs, np.nan)
+    set_power_mW = np.full(n_epochs, np.nan)
+    if epochs_per_power > 0 and brain_powers:
+        block = np.arange(n_epochs) // epochs_per_power
+        in_schedule = block < len(brain_powers)
+        power_mW[in_schedule] = np.asarray(brain_powers)[block[in_schedule]]
+        if len(set_powers) == len(brain_powers):
+            set_power_mW[in_schedule] = np.asarray(set_powers)[block[in_schedule]]
+
+        expected = epochs_per_power * len(brain_powers)
+        if n_epochs != expected:
+            print(f"Warning: found {n_epochs} stimulation epochs but the metadata describes {expected}; "
+                  f"power assignment by block order may be off")
+
+    return {
+        "onset_times": epoch_onsets,
+        "offset_times": epoch_offsets,
+        "durations": durations,
+        "duration_class_ms": duration_class_ms,
+        "power_mW": power_mW,
+        "set_power_mW": set_power_mW,
+        "n_pulses": n_pulses,
+    }
+
+
+def print_trial_summary(trials):
+    """
+    Print the number of trials per (duration class, power) combination.
+    """
+    n_trials = len(trials["onset_times"])
+    print(f"  {n_trials} stimulation trials ({int(np.sum(trials['n_pulses']))} pulses)")
+    if n_trials == 0:
+        return
+    combos, counts = np.unique(np.column_stack((trials["duration_class_ms"], trials["power_mW"])),
+                               axis=0, return_counts=True)
+    for (duration_ms, power), count in zip(combos, counts):
+        duration_label = f"{duration_ms:g}ms" if np.isfinite(duration_ms) else "unclassified"
+        power_label = f"{power:g}mW" if np.isfinite(power) else "unknown power"
+        print(f"    {duration_label} @ {power_label}: {count} trials")
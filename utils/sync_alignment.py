@@ -0,0 +1,192 @@
+"""
+sync_alignment.py - Find which DAQ sync pulse belongs to which message / frame id
+
+Syncing assumes message (or frame) id n was sent with the n-th rising edge on its sync channel.
+That breaks when the DAQ starts late (the first pulses are missing), the device starts counting
+from a non-zero id, or the device restarts mid-session (ids start again from 0). This module
+estimates the id -> pulse index offset from the data instead:
+
+    1. The ids are split into segments wherever they decrease (a restart).
+    2. For each segment the device's inter-message intervals are laid out by id (NaN for
+       missing ids) and cross-correlated with the DAQ inter-pulse intervals using FFTs; the
+       masked, per-lag Pearson correlation is O(n log n) over all lags at once. Host receive
+       timestamps are used as device times when available (IMU). Without them (camera frames)
+       the only information is where the ids skip, so the id increments of consecutive frames
+       (np.diff(ids)) are correlated with the pulse intervals in units of the pulse period: a
+       frame whose id jumps by d follows a gap of d periods in the pulses.
+    3. The lag with the highest correlation gives the offset: pulse_index = id + offset with
+       device times, and the pulse following the lag frame by frame for id increments. Host
+       receive jitter keeps the correlation at the true lag modest, so the peak is judged by
+       how far it stands above the correlation at all other lags; if it does not stand out
+       (e.g. perfectly regular data, or frames that never skip), the identity mapping is kept.
+    4. Device times are fitted linearly against the matched pulse times; the residuals and the
+       fraction of matched ids measure the alignment quality, and a warning is printed when
+       it is poor.
+"""
+
+import numpy as np
+
+MIN_PROMINENCE = 8.0          # best lag must stand this many robust SDs above the other lags
+MIN_OVERLAP_FRACTION = 0.5    # lags must overlap at least this fraction of a segment's intervals
+MAX_RESIDUAL_FRACTION = 0.25  # residual std above this fraction of the pulse interval is poor
+MIN_MATCHED_FRACTION = 0.9
+
+
+def _xcorr(a, b):
+    """
+    c[k + len(a) - 1] = sum_i a[i] * b[i + k] for k in [-(len(a) - 1), len(b) - 1], via FFT.
+    """
+    n = len(a) + len(b) - 1
+    nfft = 1 << (n - 1).bit_length()
+    return np.fft.irfft(np.fft.rfft(a[::-1], nfft) * np.fft.rfft(b, nfft), nfft)[:n]
+
+
+def lag_correlation(x, y):
+    """
+    Pearson correlation of `x` (NaN = missing) against `y` shifted by every lag.
+
+    Args:
+        x (array): Device intervals, indexed by id, NaN where unknown
+        y (array): DAQ pulse intervals
+
+    Returns:
+        tuple: (lags, correlation, overlap) - correlation[i] compares x[j] with y[j + lags[i]]
+    """
+    w = np.isfinite(x).astype(np.float64)
+    x = np.where(w > 0, x, 0.0)
+    y = np.asarray(y, dtype=np.float64)
+    ones = np.ones_like(y)
+
+    n = np.rint(_xcorr(w, ones))
+    s_x = _xcorr(x, ones)
+    s_y = _xcorr(w, y)
+    s_xy = _xcorr(x, y)
+    s_xx = _xcorr(x * x, ones)
+    s_yy = _xcorr(w, y * y)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n_safe = np.maximum(n, 1)
+        cov = s_xy - s_x * s_y / n_safe
+        var = (s_xx - s_x ** 2 / n_safe) * (s_yy - s_y ** 2 / n_safe)
+        correlation = np.where((n > 1) & (var > 1e-12 * np.maximum(s_xx * s_yy, 1e-300)),
+                               cov / np.sqrt(np.abs(var)), np.nan)
+    lags = np.arange(-(len(x) - 1), len(y))
+    return lags, correlation, n
+
+
+def _best_lag(intervals, pulse_intervals):
+    """
+    Lag of the pulse intervals that best matches `intervals` (interval i <-> pulse interval
+    i + lag), or None if it cannot be estimated or does not stand out, and its correlation.
+    """
+    n_valid = np.count_nonzero(np.isfinite(intervals))
+    if n_valid < 2 or len(pulse_intervals) < 2:
+        return None, np.nan
+    lags, correlation, overlap = lag_correlation(intervals, pulse_intervals)
+    correlation[overlap < max(2, MIN_OVERLAP_FRACTION * n_valid)] = np.nan
+    if not np.isfinite(correlation).any():
+        return None, np.nan
+    best = int(np.nanargmax(correlation))
+    finite = correlation[np.isfinite(correlation)]
+    spread = 1.4826 * np.median(np.abs(finite - np.median(finite)))
+    if spread > 0 and (correlation[best] - np.median(finite)) / spread < MIN_PROMINENCE:
+        return None, float(correlation[best])
+    return int(lags[best]), float(correlation[best])
+
+
+def _segment_pulse_index(ids, device_times, pulse_intervals, period):
+    """
+    Pulse index of every id in one segment of increasing unique ids, the segment's offset
+    (pulse index - id of its first id) and the correlation.
+    """
+    id_min = int(ids[0])
+    if device_times is None:
+        # Frame k follows frame k - 1 by ids[k] - ids[k - 1] periods
+        lag, correlation = _best_lag(np.diff(ids).astype(np.float64), pulse_intervals / period)
+        if lag is None:
+            return ids.copy(), 0, correlation
+        return np.arange(len(ids)) + lag, lag - id_min, correlation
+
+    times = np.full(int(ids[-1]) - id_min + 1, np.nan)
+    times[ids - id_min] = device_times
+    lag, correlation = _best_lag(np.diff(times), pulse_intervals)
+    offset = 0 if lag is None else lag - id_min
+    return ids + offset, offset, correlation
+
+
+def align_ids_to_pulses(ids, pulse_times, device_times=None, name="stream"):
+    """
+    Estimate the pulse index of every id.
+
+    Args:
+        ids (array): Message or frame ids, in recording order
+        pulse_times (array): DAQ rising edge times of the stream's sync channel
+        device_times (array, optional): Host receive times of the ids (any clock); without
+            them the ids' increments are matched against the pulse intervals, and the ids'
+            nominal times at the median pulse interval are used for the residuals
+        name (str): Stream name for the report
+
+    Returns:
+        dict: pulse_index (int64 per id, -1 if the id has no pulse), offsets (per segment),
+              correlations (per segment, NaN if not estimable), residual_std_ms,
+              residual_max_ms, matched_fraction, poor (bool)
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    pulse_times = np.asarray(pulse_times, dtype=np.float64)
+    pulse_intervals = np.diff(pulse_times)
+    period = float(np.median(pulse_intervals)) if len(pulse_intervals) else np.nan
+    nominal = device_times is None
+    if nominal:
+        device_times = ids * (period if np.isfinite(period) else 1.0)
+    device_times = np.asarray(device_times, dtype=np.float64)
+
+    # Segments end wherever the ids go backwards (device restart)
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(ids) < 0) + 1, [len(ids)]))
+    pulse_index = np.full(len(ids), -1, dtype=np.int64)
+    offsets, correlations = [], []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        segment_ids, first, inverse = np.unique(ids[start:stop], return_index=True, return_inverse=True)
+        if len(segment_ids) == 0:
+            continue
+        segment_index, offset, correlation = _segment_pulse_index(
+            segment_ids, None if nominal else device_times[start:stop][first], pulse_intervals, period)
+        offsets.append(offset)
+        correlations.append(correlation)
+        pulse_index[start:stop] = segment_index[inverse]
+
+    pulse_index[(pulse_index < 0) | (pulse_index >= len(pulse_times))] = -1
+    matched = pulse_index >= 0
+    matched_fraction = float(np.count_nonzero(matched) / len(ids)) if len(ids) else 0.0
+
+    # Residuals of a linear device-clock -> DAQ-clock fit over the matched ids
+    residual_std_ms = residual_max_ms = np.nan
+    if np.count_nonzero(matched) > 2:
+        x = device_times[matched]
+        y = pulse_times[pulse_index[matched]]
+        slope, intercept = np.polyfit(x - x[0], y, 1)
+        residuals = y - (slope * (x - x[0]) + intercept)
+        residual_std_ms = float(np.std(residuals) * 1000)
+        residual_max_ms = float(np.max(np.abs(residuals)) * 1000)
+
+    poor = bool(matched_fraction < MIN_MATCHED_FRACTION
+                or not np.isfinite(residual_std_ms)
+                or residual_std_ms > MAX_RESIDUAL_FRACTION * period * 1000)
+
+    print(f"{name} alignment: offset(s) {offsets} (pulse index - id), correlation "
+          f"{', '.join('n/a' if not np.isfinite(c) else f'{c:.2f}' for c in correlations)}, "
+          f"{matched_fraction * 100:.1f}% of ids matched, residuals {residual_std_ms:.2f} ms std / "
+          f"{residual_max_ms:.2f} ms max")
+    if len(offsets) > 1:
+        print(f"  {name}: ids restart {len(offsets) - 1} time(s); each segment aligned separately")
+    if poor:
+        print(f"Warning: poor {name} alignment - check the sync channel and the {name} recording")
+
+    return {
+        "pulse_index": pulse_index,
+        "offsets": np.array(offsets, dtype=np.int64),
+        "correlations": np.array(correlations, dtype=np.float64),
+        "residual_std_ms": residual_std_ms,
+        "residual_max_ms": residual_max_ms,
+        "matched_fraction": matched_fraction,
+        "poor": poor,
+    }
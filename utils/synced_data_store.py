@@ -0,0 +1,145 @@
+"""
+synced_data_store.py - HDF5 store for the synchronised session data
+
+The synchronised head sensor, body sensor, camera and laser data used to be written as one
+indented JSON file (`<session_id>_synced_data.json`) with every sample as a list entry, which
+made it the largest and slowest file in the pipeline. It is now written to
+`<session_id>_synced_data.h5` with one group per stream and one typed, chunked and compressed
+dataset per field:
+
+    <session_id>_synced_data.h5
+    ├── attrs: session_id
+    ├── head_sensor/   message_ids, yaw_data, roll_data, pitch_data, head_sensor_timestamps,
+    │                  pulse_times, synced_timestamps (NaN = no matching pulse), synced_valid,
+    │                  pulse_index, alignment_offsets, alignment_residual_std_ms, alignment_poor
+    │                  (see sync_alignment.py)
+    ├── body_sensor/   (same fields, only for sessions with a body sensor)
+    ├── camera/        frame_ids, pulse_times, synced_timestamps, synced_valid, pulse_index,
+    │                  alignment_offsets, alignment_residual_std_ms, alignment_poor
+    ├── laser/         rising_times, falling_times, durations
+    ├── trials/        onset_times, offset_times, durations, duration_class_ms, power_mW,
+    │                  set_power_mW, n_pulses (one entry per stimulation epoch, see stim_trials.py)
+    ├── camera_aligned/  frame_ids, timestamps, <head|body>_yaw_data, _roll_data, _pitch_data,
+    │                    <head|body>_valid - sensor angles interpolated onto each camera frame
+    └── uniform/       timestamps, <head|body>_yaw_data, ..., <head|body>_valid - sensor angles
+                       on a uniform time grid (see resampling.py)
+
+A small `<session_id>_synced_data_manifest.json` lists the groups, dataset shapes and dtypes
+for people browsing the session folder. `load_synced_data` reads either the HDF5 store or a
+legacy JSON file into the same nested dict layout.
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+SYNCED_DATA_SUFFIX = "_synced_data.h5"
+MANIFEST_SUFFIX = "_synced_data_manifest.json"
+LEGACY_JSON_SUFFIX = "_synced_data.json"
+STREAM_GROUPS = ("head_sensor", "body_sensor", "camera", "laser", "trials", "camera_aligned", "uniform")
+
+# Arrays shorter than this are stored contiguously; chunking and compression are not worth it
+MIN_CHUNKED_LENGTH = 1024
+
+
+def synced_data_paths(session_dir, session_id):
+    """
+    Paths of the synced data store and its manifest for one session.
+
+    Returns:
+        tuple: (h5_path, manifest_path)
+    """
+    session_dir = Path(session_dir)
+    return session_dir / f"{session_id}{SYNCED_DATA_SUFFIX}", session_dir / f"{session_id}{MANIFEST_SUFFIX}"
+
+
+def _write_array(group, name, values, compression):
+    data = np.asarray(values)
+    if data.dtype == object:
+        # Lists that may contain None (e.g. legacy synced timestamps)
+        data = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if data.ndim > 0 and len(data) >= MIN_CHUNKED_LENGTH:
+        return group.create_dataset(name, data=data, chunks=True, compression=compression, shuffle=True)
+    return group.create_dataset(name, data=data)
+
+
+def save_synced_data(synced_data, h5_path, manifest_path=None, compression='gzip'):
+    """
+    Write synced data to the HDF5 store and, optionally, its JSON manifest.
+
+    Args:
+        synced_data (dict): {"session_id": str, "<stream>": {field: array} or None, ...}
+        h5_path (Path): Output HDF5 file
+        manifest_path (Path, optional): Output JSON manifest
+        compression (str): HDF5 compression filter for the larger datasets
+
+    Returns:
+        dict: The manifest
+    """
+    manifest = {
+        "session_id": synced_data.get("session_id"),
+        "file": Path(h5_path).name,
+        "created": str(datetime.now()),
+        "groups": {},
+    }
+
+    with h5py.File(h5_path, 'w') as h5f:
+        h5f.attrs['session_id'] = str(synced_data.get("session_id"))
+        for stream in STREAM_GROUPS:
+            if stream not in synced_data:
+                continue
+            stream_data = synced_data[stream]
+            if stream_data is None:
+                manifest["groups"][stream] = None
+                continue
+
+            group = h5f.create_group(stream)
+            group_manifest = {}
+            for name, values in stream_data.items():
+                dataset = _write_array(group, name, values, compression)
+                group_manifest[name] = {"shape": list(dataset.shape), "dtype": str(dataset.dtype)}
+            if "synced_valid" in stream_data:
+                group_manifest["n_synced"] = int(np.count_nonzero(stream_data["synced_valid"]))
+            manifest["groups"][stream] = group_manifest
+
+    if manifest_path is not None:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+    return manifest
+
+
+def load_synced_data(path, streams=None):
+    """
+    Load synced data from the HDF5 store, or from a legacy `_synced_data.json` file.
+
+    Args:
+        path (Path): Synced data file (.h5 or legacy .json)
+        streams (sequence, optional): Only load these stream groups
+
+    Returns:
+        dict: {"session_id": str, "<stream>": {field: np.ndarray} or None, ...}
+    """
+    path = Path(path)
+    if path.suffix == '.json':
+        with open(path, 'r') as f:
+            synced_data = json.load(f)
+        if streams is not None:
+            synced_data = {key: value for key, value in synced_data.items()
+                           if key == "session_id" or key in streams}
+        return synced_data
+
+    synced_data = {}
+    with h5py.File(path, 'r') as h5f:
+        synced_data["session_id"] = h5f.attrs.get('session_id')
+        for stream in STREAM_GROUPS:
+            if streams is not None and stream not in streams:
+                continue
+            if stream not in h5f:
+                synced_data[stream] = None
+                continue
+            synced_data[stream] = {name: dataset[()] for name, dataset in h5f[stream].items()}
+    return synced_data
@@ -2,44 +2,142 @@ import multiprocessing as mp
 from pathlib import Path
 import json
 import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-def process_cohort_videos(cohort_directory: str | Path, num_processes: int = None):
+from .stage_manifest import StageManifest, code_version
+
+VIDEO_CODEC = 'MJPG'
+
+# Encoder used for new conversions. 'mjpg' is the chunked OpenCV path (one MJPG AVI per CPU core,
+# joined with ffmpeg -f concat); the others stream the raw frames into a single multithreaded
+# ffmpeg process over stdin, with no temporary files. MJPG and FFV1 are written as *_output.avi;
+# h264 and hevc go into *_output.mp4, since AVI has no decode order for their B-frames (and no
+# tag for hevc), so players and OpenCV cannot read or seek them frame-accurately there.
+VIDEO_ENCODER = 'mjpg'
+FFMPEG_ENCODERS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-pix_fmt', 'gray'],
+    'hevc': ['-c:v', 'libx265', '-preset', 'fast', '-crf', '20', '-pix_fmt', 'gray', '-tag:v', 'hvc1'],
+    'ffv1': ['-c:v', 'ffv1', '-level', '3', '-slices', '16', '-slicecrc', '1', '-pix_fmt', 'gray'],  # lossless
+}
+FFMPEG_BATCH_FRAMES = 256  # frames per write into the ffmpeg pipe
+VIDEO_EXTENSIONS = {'h264': '.mp4', 'hevc': '.mp4'}  # others: .avi
+VIDEO_SUFFIXES = ('.avi', '.mp4')
+
+# Binary videos read / converted at the same time by a VideoScheduler (the disk budget)
+DEFAULT_ACTIVE_VIDEOS = 3
+
+
+class VideoScheduler:
+    """
+    One long-lived worker pool shared by every video conversion in a batch.
+
+    Each session's MJPG chunk tasks go to the same `mp.Pool`, so chunks from several sessions
+    are encoded at once and the pool never spins down between sessions; while one session's
+    chunks are concatenated with ffmpeg, the pool keeps encoding the others'. At most
+    `max_active_videos` sessions are converted at once, which bounds how many binary files are
+    streamed from disk concurrently. ffmpeg pipe encoders share the same core budget: each gets
+    `num_processes // max_active_videos` threads.
+
+    Use as a context manager, or call `close()` when the batch is done:
+
+        with VideoScheduler() as scheduler:
+            VideoProcessor(session_dir, scheduler=scheduler).process_session()
+    """
+
+    def __init__(self, num_processes: int = None, max_active_videos: int = DEFAULT_ACTIVE_VIDEOS):
+        """
+        Args:
+            num_processes (int, optional): Total encoder processes (core budget). Defaults to CPU count.
+            max_active_videos (int): Sessions converted at the same time (disk budget).
+        """
+        self.num_processes = num_processes or mp.cpu_count()
+        self.max_active_videos = max(1, max_active_videos)
+        self.ffmpeg_threads = max(1, self.num_processes // self.max_active_videos)
+        self._slots = threading.BoundedSemaphore(self.max_active_videos)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def session_slot(self):
+        """Context manager holding one of the max_active_videos conversion slots."""
+        return self._slots
+
+    def run_chunks(self, args):
+        """
+        Encode chunk tasks (process_video_chunk arguments) on the shared pool and wait for them.
+        Safe to call from several threads at once.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = mp.Pool(processes=self.num_processes)
+            pool = self._pool
+        pool.starmap_async(process_video_chunk, args).get()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+def process_cohort_videos(cohort_directory: str | Path | list, num_processes: int = None, force: bool = False,
+                          encoder: str = VIDEO_ENCODER, max_active_videos: int = DEFAULT_ACTIVE_VIDEOS):
     """
-    Process all videos in a cohort directory. Skips already processed videos.
+    Process all videos in one or more cohort directories. Skips already processed videos.
+    All sessions share one VideoScheduler, so up to max_active_videos sessions are converted
+    at once on a single pool of num_processes workers.
     
     Args:
-        cohort_directory (str | Path): Root directory containing all session folders
+        cohort_directory (str | Path | list): Root directory (or directories) containing all session folders
         num_processes (int, optional): Number of processes for multiprocessing. Defaults to CPU count.
+        force (bool): Reconvert videos even if the stage manifest says they are up to date.
+        encoder (str): 'mjpg' or one of FFMPEG_ENCODERS.
+        max_active_videos (int): Sessions converted at the same time.
     """
-    cohort_directory = Path(cohort_directory)
+    cohort_directories = cohort_directory if isinstance(cohort_directory, (list, tuple)) else [cohort_directory]
     processed_count = 0
     skipped_count = 0
     error_count = 0
     
     # Find all session directories (assuming they contain binary video files)
-    session_dirs = [d for d in cohort_directory.glob("**/") if list(d.glob("*binary_video*"))]
+    session_dirs = [d for directory in cohort_directories for d in Path(directory).glob("**/")
+                    if list(d.glob("*binary_video*"))]
     
     if not session_dirs:
         print("No sessions with binary video files found.")
         return
     
     print(f"Found {len(session_dirs)} sessions with binary video files")
+
+    def process(session_dir):
+        processor = VideoProcessor(session_dir, num_processes, force=force, encoder=encoder, scheduler=scheduler)
+        return processor.process_session()
     
-    # Process each session
-    for session_dir in session_dirs:
-        try:
-            processor = VideoProcessor(session_dir, num_processes)
-            result = processor.process_session()
-            
-            if result == "processed":
-                processed_count += 1
-            elif result == "skipped":
-                skipped_count += 1
+    # Process the sessions concurrently on the shared scheduler
+    with VideoScheduler(num_processes, max_active_videos) as scheduler, \
+            ThreadPoolExecutor(max_workers=scheduler.max_active_videos) as executor:
+        futures = {executor.submit(process, session_dir): session_dir for session_dir in session_dirs}
+        for future, session_dir in futures.items():
+            try:
+                result = future.result()
                 
-        except Exception as e:
-            print(f"Error processing session {session_dir}: {e}")
-            error_count += 1
+                if result == "processed":
+                    processed_count += 1
+                elif result == "skipped":
+                    skipped_count += 1
+                    
+            except Exception as e:
+                print(f"Error processing session {session_dir}: {e}")
+                error_count += 1
     
     print(f"\nProcessing complete:")
     print(f"Successfully processed: {processed_count} sessions")
@@ -47,22 +145,34 @@ def process_cohort_videos(cohort_directory: str | Path, num_processes: int = Non
     print(f"Errors encountered: {error_count} sessions")
 
 class VideoProcessor:
-    def __init__(self, session_directory: Path, num_processes: int = None):
+    def __init__(self, session_directory: Path, num_processes: int = None, force: bool = False,
+                 encoder: str = VIDEO_ENCODER, scheduler: VideoScheduler = None):
         """
         Initialize the video processor for a session directory.
         
         Args:
             session_directory (Path): Directory containing the session data
             num_processes (int, optional): Number of processes for multiprocessing. Defaults to CPU count.
+            force (bool): Reconvert even if the stage manifest says the video is up to date.
+            encoder (str): 'mjpg' or one of FFMPEG_ENCODERS.
+            scheduler (VideoScheduler, optional): Shared pool to encode on; without one the
+                conversion starts its own pool.
         """
+        if encoder != 'mjpg' and encoder not in FFMPEG_ENCODERS:
+            raise ValueError(f"Unknown video encoder '{encoder}'. Use 'mjpg' or one of {list(FFMPEG_ENCODERS)}")
         self.session_directory = Path(session_directory)
         self.num_processes = num_processes or mp.cpu_count()
+        self.force = force
+        self.encoder = encoder
+        self.scheduler = scheduler
+        self.output_video = None
 
     def process_session(self):
         """
         Process video data in the session directory.
         Detects binary video files and processes them using the binary conversion method.
-        Skips processing if video already exists.
+        Skips processing if a video already exists, unless the stage manifest shows it was
+        converted from a different binary file, tracker data, codec or converter version.
         
         Returns:
             str: "processed" if video was processed, "skipped" if already processed, None if error
@@ -88,11 +198,29 @@ class VideoProcessor:
             print(f"Metadata file {metadata_file} not found. Skipping...")
             return None
             
-        # Check if video already exists (look for any .avi files)
-        video_files = list(self.session_directory.glob('*.avi'))
+        manifest = StageManifest(self.session_directory, self.session_directory.name)
+        inputs = {"binary_video": binary_file, "tracker_json": metadata_file}
+        params = {"codec": VIDEO_CODEC if self.encoder == 'mjpg' else self.encoder}
+        code = code_version(__file__)
+
+        # Check if video already exists (look for any .avi / .mp4 files)
+        video_files = [f for suffix in VIDEO_SUFFIXES for f in self.session_directory.glob(f'*{suffix}')]
         if video_files:
-            print(f"Video file already exists in {self.session_directory}. Skipping conversion...")
-            return "skipped"
+            if "video" not in manifest.stages and not self.force:
+                # Converted before the stage manifest existed
+                print(f"Video file already exists in {self.session_directory}. Skipping conversion...")
+                self.output_video = max(video_files, key=lambda x: x.stat().st_mtime)
+                return "skipped"
+            up_to_date, reason = (False, "forced") if self.force else manifest.check("video", inputs, params, code)
+            if up_to_date:
+                print(f"Video in {self.session_directory} is up to date. Skipping conversion...")
+                self.output_video = max(video_files, key=lambda x: x.stat().st_mtime)
+                return "skipped"
+            print(f"Reconverting video in {self.session_directory} ({reason})")
+            # Remove the stale video so it is not picked up instead of the new one
+            stale_video = manifest.stages.get("video", {}).get("outputs", {}).get("video")
+            if stale_video and Path(stale_video).exists():
+                Path(stale_video).unlink()
 
         # Process the video
         print(f"Processing video in {self.session_directory}...")
@@ -100,15 +228,20 @@ class VideoProcessor:
             convert_binary_to_video(
                 str(binary_file),
                 str(metadata_file),
-                self.session_directory
+                self.session_directory,
+                encoder=self.encoder,
+                scheduler=self.scheduler
             )
             print(f"Successfully processed video in {self.session_directory}")
 
             # Check if the video was created successfully
-            new_video_files = list(self.session_directory.glob("*_output.avi"))
+            new_video_files = [f for suffix in VIDEO_SUFFIXES
+                               for f in self.session_directory.glob(f"*_output{suffix}")]
             if new_video_files:
                 latest_video = max(new_video_files, key=lambda x: x.stat().st_mtime)
                 if latest_video.exists() and latest_video.stat().st_size > 0:
+                    manifest.record("video", inputs, params, code, {"video": latest_video})
+                    self.output_video = latest_video
                     # Remove the binary video file
                     binary_file.unlink()
                     print(f"Successfully processed video and removed binary file in {self.session_directory}")
@@ -125,7 +258,22 @@ class VideoProcessor:
             return None
 
 
-def convert_binary_to_video(binary_filename, json_filename, output_directory):
+def convert_binary_to_video(binary_filename, json_filename, output_directory, encoder=VIDEO_ENCODER,
+                            scheduler=None):
+    """
+    Converts a raw Mono8 binary video to `<date_time>_output.avi` (`.mp4` for h264 / hevc) in
+    output_directory, with the chunked OpenCV MJPG path (encoder='mjpg') or a single ffmpeg pipe
+    (FFMPEG_ENCODERS), and prints the output size, encode rate and wall time. With a
+    VideoScheduler the conversion waits for one of its slots and encodes on its shared pool /
+    thread budget.
+    """
+    if scheduler is not None:
+        with scheduler.session_slot():
+            return _convert_binary_to_video(binary_filename, json_filename, output_directory, encoder, scheduler)
+    return _convert_binary_to_video(binary_filename, json_filename, output_directory, encoder, None)
+
+def _convert_binary_to_video(binary_filename, json_filename, output_directory, encoder, scheduler):
+    start_time = time.perf_counter()
     # Load metadata from JSON file
     try:
         with open(json_filename, 'r') as json_file:
@@ -147,29 +295,32 @@ def convert_binary_to_video(binary_filename, json_filename, output_directory):
 
         number_of_images = len(frame_IDs)
 
-        # Since images are always Mono8, set bytes_per_pixel accordingly
-        bytes_per_pixel = 1
-
         # Generate output video filename
         date_time = f"{datetime.now():%y%m%d_%H%M%S}"
-        video_filename = output_directory / f"{date_time}_output.avi"
+        video_filename = output_directory / f"{date_time}_output{VIDEO_EXTENSIONS.get(encoder, '.avi')}"
 
     except KeyError as e:
         print(f"Missing key in JSON file: {e}")
         return
 
-    # Calculate image size
-    image_size = image_width * image_height * bytes_per_pixel
+    if encoder != 'mjpg':
+        # One ffmpeg process reads the frames from stdin and encodes them with its own threads
+        if not encode_with_ffmpeg(binary_filename, image_width, image_height, frame_rate,
+                                  frame_IDs[0], number_of_images, video_filename, encoder,
+                                  threads=scheduler.ffmpeg_threads if scheduler else 0):
+            return
+        print_conversion_stats(video_filename, number_of_images, encoder, time.perf_counter() - start_time)
+        return
 
-    # Determine the number of CPU cores
-    num_cores = mp.cpu_count()
+    # Determine the number of CPU cores (the scheduler's shared budget if there is one)
+    num_cores = scheduler.num_processes if scheduler else mp.cpu_count()
     # num_cores = 4  # You can set this manually if desired
     print(f"Number of CPU cores available: {num_cores}")
 
     # Calculate chunk size
     chunk_size = max(number_of_images // num_cores, 1)
 
-    # Split frame indices into chunks
+    # Split frame indices into chunks; workers only need each chunk's first frame and length
     chunks = [frame_IDs[i:i + chunk_size] for i in range(0, number_of_images, chunk_size)]
 
     # Create a temporary directory for intermediate video chunks
@@ -179,12 +330,15 @@ def convert_binary_to_video(binary_filename, json_filename, output_directory):
     # Prepare arguments for multiprocessing
     args = []
     for idx, chunk in enumerate(chunks):
-        args.append((binary_filename, image_size, image_width, image_height,
-                     chunk, idx, temp_video_dir, bytes_per_pixel, frame_rate))
+        args.append((binary_filename, image_width, image_height,
+                     chunk[0], len(chunk), idx, temp_video_dir, frame_rate))
 
     # Use multiprocessing to process chunks in parallel
-    with mp.Pool(processes=min(num_cores, len(chunks))) as pool:
-        pool.starmap(process_video_chunk, args)
+    if scheduler is not None:
+        scheduler.run_chunks(args)
+    else:
+        with mp.Pool(processes=min(num_cores, len(chunks))) as pool:
+            pool.starmap(process_video_chunk, args)
 
     # Concatenate all chunked videos into one final video
     concatenate_videos(temp_video_dir, video_filename)
@@ -195,60 +349,110 @@ def convert_binary_to_video(binary_filename, json_filename, output_directory):
     temp_video_dir.rmdir()
 
     print(f"Video saved as {video_filename}")
+    print_conversion_stats(video_filename, number_of_images, encoder, time.perf_counter() - start_time)
 
-def process_video_chunk(binary_filename, image_size, image_width, image_height,
-                        frame_IDs_chunk, chunk_index, temp_video_dir, bytes_per_pixel, frame_rate):
+def print_conversion_stats(video_filename, n_frames, encoder, wall_time):
     """
-    Processes a chunk of images and writes them to a temporary video file.
+    Prints the output size, encode rate and wall time of a conversion.
     """
-    import numpy as np
-    import cv2
+    size_mb = os.path.getsize(video_filename) / 1e6 if os.path.exists(video_filename) else 0.0
+    print(f"{encoder} conversion: {n_frames} frames, {size_mb:.1f} MB, "
+          f"{n_frames / wall_time if wall_time > 0 else 0:.0f} frames/s, {wall_time:.1f}s wall time")
 
-    # Open binary file
-    try:
-        with open(binary_filename, 'rb') as binary_file:
-            # Calculate the position to start reading from
-            start_frame = frame_IDs_chunk[0]
-            start_pos = start_frame * image_size
-            binary_file.seek(start_pos)
-
-            # Set up VideoWriter for grayscale images
-            is_color = False  # Mono8 images are grayscale
-            fourcc = cv2.VideoWriter_fourcc(*'MJPG')  # Change codec if needed
-            temp_video_filename = temp_video_dir / f"chunk_{chunk_index:03}.avi"
-            video_writer = cv2.VideoWriter(
-                str(temp_video_filename),
-                fourcc,
-                frame_rate,  # Use the correct frame rate
-                (image_width, image_height),
-                isColor=is_color
-            )
+def encode_with_ffmpeg(binary_filename, image_width, image_height, frame_rate,
+                       start_frame, n_frames, video_filename, encoder, threads=0):
+    """
+    Streams frames [start_frame, start_frame + n_frames) of the binary file into one ffmpeg
+    process over stdin. Batches are written straight from the memory-mapped file.
+    threads=0 lets ffmpeg use every core.
+
+    Returns:
+        bool: True if ffmpeg finished successfully
+    """
+    frames = open_binary_frames(binary_filename, image_width, image_height)
+    frames = frames[start_frame:start_frame + n_frames]
+    if len(frames) < n_frames:
+        print(f"Error: End of file reached unexpectedly ({len(frames)} of {n_frames} frames present)")
+
+    ffmpeg_cmd = [
+        'ffmpeg', '-y', '-hide_banner', '-nostats', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', f"{image_width}x{image_height}",
+        '-framerate', str(frame_rate), '-i', 'pipe:0',
+        *FFMPEG_ENCODERS[encoder], '-threads', str(threads), str(video_filename)
+    ]
+    # stderr goes to a file so a chatty ffmpeg can never block on a full pipe while we write
+    log_file = Path(video_filename).with_suffix('.ffmpeg.log')
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=log)
+        try:
+            for batch_start in range(0, len(frames), FFMPEG_BATCH_FRAMES):
+                process.stdin.write(memoryview(frames[batch_start:batch_start + FFMPEG_BATCH_FRAMES]))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+
+    if returncode != 0:
+        print(f"ffmpeg error (encode_with_ffmpeg):\n{log_file.read_text()}")
+        return False
+    log_file.unlink()
+    print(f"Video saved as {video_filename}")
+    return True
 
-            if not video_writer.isOpened():
-                print(f"Error: Could not open temporary video file for writing: {temp_video_filename}")
-                return
+def open_binary_frames(binary_filename, image_width, image_height):
+    """
+    Maps a raw Mono8 binary video file as a read-only (n_frames, height, width) uint8 array.
+
+    Frames are read from the page cache on access, so workers slicing neighbouring frame
+    ranges share the cached pages and no per-frame buffers are allocated. A trailing partial
+    frame is left out.
+    """
+    import numpy as np
 
-            # Process images in the chunk
-            for _ in frame_IDs_chunk:
-                buffer = binary_file.read(image_size)
-                if not buffer:
-                    print(f"Error: End of file reached unexpectedly in chunk {chunk_index}")
-                    break
-                elif len(buffer) < image_size:
-                    print(f"Error: Incomplete image data in chunk {chunk_index}")
-                    break
+    image_size = image_width * image_height  # Mono8: one byte per pixel
+    n_frames = os.path.getsize(binary_filename) // image_size
+    if n_frames == 0:
+        return np.zeros((0, image_height, image_width), dtype=np.uint8)
+    return np.memmap(binary_filename, dtype=np.uint8, mode='r', shape=(n_frames, image_height, image_width))
 
-                # Convert buffer to NumPy array
-                image = np.frombuffer(buffer, dtype=np.uint8)
+def process_video_chunk(binary_filename, image_width, image_height,
+                        start_frame, n_frames, chunk_index, temp_video_dir, frame_rate):
+    """
+    Processes a chunk of images and writes them to a temporary video file.
+    """
+    import numpy as np
+    import cv2
 
-                # Reshape the image to 2D array
-                image = image.reshape((image_height, image_width))
+    # Map the binary file and take this chunk's frames as a view (no copy)
+    try:
+        frames = open_binary_frames(binary_filename, image_width, image_height)
+        chunk = frames[start_frame:start_frame + n_frames]
+        if len(chunk) < n_frames:
+            print(f"Error: End of file reached unexpectedly in chunk {chunk_index} "
+                  f"({len(chunk)} of {n_frames} frames present)")
+
+        # Set up VideoWriter for grayscale images
+        is_color = False  # Mono8 images are grayscale
+        fourcc = cv2.VideoWriter_fourcc(*VIDEO_CODEC)
+        temp_video_filename = temp_video_dir / f"chunk_{chunk_index:03}.avi"
+        video_writer = cv2.VideoWriter(
+            str(temp_video_filename),
+            fourcc,
+            frame_rate,  # Use the correct frame rate
+            (image_width, image_height),
+            isColor=is_color
+        )
+
+        if not video_writer.isOpened():
+            print(f"Error: Could not open temporary video file for writing: {temp_video_filename}")
+            return
 
-                # Write frame to video
-                video_writer.write(image)
+        # Write each frame straight from the mapped file
+        for image in chunk:
+            video_writer.write(np.asarray(image))
 
-            # Clean up
-            video_writer.release()
+        # Clean up
+        video_writer.release()
 
     except Exception as e:
         print(f"Error processing chunk {chunk_index}: {e}")